@@ -8,5 +8,10 @@ apt-get update && apt-get install -y libjpeg-dev zlib1g-dev
 # Install Python dependencies
 pip install -r requirements.txt
 
+# Resized WebP/PNG copies of the large images, then collect them with the
+# rest of the static files
+python manage.py build_image_derivatives
+python manage.py collectstatic --no-input
+
 # Add any other build steps here (e.g., running Django migrations)
 # python manage.py migrate
\ No newline at end of file
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Item, Purchase, ChatMessage, UserProfile, ChatRoom, BenchInvite, DailyChallenge, CoinTransaction, UserChatHistory
+from .models import Item, Purchase, ChatMessage, UserProfile, ChatRoom, BenchInvite, DailyChallenge, CoinTransaction, CoinDailyTotal, UserChatHistory, Inventory
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
@@ -27,15 +27,11 @@ class UserProfileAdmin(admin.ModelAdmin):
 
 @admin.register(ChatRoom)
 class ChatRoomAdmin(admin.ModelAdmin):
-    list_display = ['get_display_name', 'room_type', 'created_by', 'get_participant_count', 'max_users', 'is_active', 'created_at']
+    list_display = ['get_display_name', 'room_type', 'created_by', 'participant_count', 'max_users', 'is_active', 'created_at']
     list_filter = ['room_type', 'is_active', 'created_at']
     search_fields = ['name', 'bench_name', 'created_by__username']
     filter_horizontal = ['participants']
-    readonly_fields = ['room_id', 'created_at']
-    
-    def get_participant_count(self, obj):
-        return obj.participants.count()
-    get_participant_count.short_description = 'Participants'
+    readonly_fields = ['room_id', 'created_at', 'participant_count']
 
 @admin.register(BenchInvite)
 class BenchInviteAdmin(admin.ModelAdmin):
@@ -74,11 +70,20 @@ class ItemAdmin(admin.ModelAdmin):
 
 @admin.register(Purchase)
 class PurchaseAdmin(admin.ModelAdmin):
-    list_display = ['user', 'item', 'quantity', 'total_price', 'timestamp', 'shared_in_chat']
-    list_filter = ['timestamp', 'item__category', 'shared_in_chat']
+    list_display = ['user', 'item', 'quantity', 'total_price', 'timestamp']
+    list_filter = ['timestamp', 'item__category']
     search_fields = ['user__username', 'item__name']
     readonly_fields = ['timestamp']
 
+@admin.register(Inventory)
+class InventoryAdmin(admin.ModelAdmin):
+    list_display = ['user', 'item', 'owned', 'remaining', 'shared']
+    list_filter = ['item__category']
+    search_fields = ['user__username', 'item__name']
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user', 'item')
+
 @admin.register(DailyChallenge)
 class DailyChallengeAdmin(admin.ModelAdmin):
     list_display = ['user', 'challenge_type', 'completed_date', 'coins_earned']
@@ -96,6 +101,15 @@ class CoinTransactionAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('user')
 
+@admin.register(CoinDailyTotal)
+class CoinDailyTotalAdmin(admin.ModelAdmin):
+    list_display = ['user', 'day', 'transaction_type', 'total', 'count']
+    list_filter = ['transaction_type', 'day']
+    search_fields = ['user__username']
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user')
+
 @admin.register(UserChatHistory)
 class UserChatHistoryAdmin(admin.ModelAdmin):
     list_display = ['user', 'chatted_with', 'chat_date']
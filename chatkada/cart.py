@@ -0,0 +1,75 @@
+from django.db import transaction
+from django.db.models import F, Q
+from .models import Item, Purchase, CoinTransaction, CoinDailyTotal
+from .coins import InsufficientCoins, update_profile
+from . import inventory
+
+MAX_LINES = 20
+MAX_QUANTITY = 99
+
+
+class InvalidCart(Exception):
+    """The cart had a bad line, or an item that can't be bought"""
+
+
+def parse_lines(lines):
+    """{item_id: quantity} from a list of {'item_id', 'quantity'} dicts.
+
+    Repeated items are merged. Raises InvalidCart.
+    """
+    if not isinstance(lines, list) or not lines:
+        raise InvalidCart('Your cart is empty')
+    if len(lines) > MAX_LINES:
+        raise InvalidCart(f'At most {MAX_LINES} items per order')
+    quantities = {}
+    for line in lines:
+        try:
+            item_id = int(line['item_id'])
+            quantity = int(line.get('quantity', 1))
+        except (TypeError, ValueError, KeyError, AttributeError):
+            raise InvalidCart('Invalid cart line')
+        if quantity < 1:
+            raise InvalidCart('Invalid quantity')
+        quantities[item_id] = quantities.get(item_id, 0) + quantity
+        if quantities[item_id] > MAX_QUANTITY:
+            raise InvalidCart(f'At most {MAX_QUANTITY} of one item')
+    return quantities
+
+
+def checkout(user, quantities):
+    """Buy a whole cart in one transaction.
+
+    The items are priced from one query and the balance is debited once,
+    with a conditional UPDATE; the Purchase and CoinTransaction rows (one
+    per line) are bulk inserted. Returns (new balance, purchases). Raises
+    InvalidCart or InsufficientCoins, in which case nothing is written.
+    """
+    items = Item.objects.filter(available=True).in_bulk(quantities)
+    missing = set(quantities) - set(items)
+    if missing:
+        raise InvalidCart('Some items are no longer available')
+
+    lines = [(items[item_id], quantity) for item_id, quantity in quantities.items()]
+    total = sum(item.price * quantity for item, quantity in lines)
+
+    with transaction.atomic():
+        row = update_profile(user, when=Q(coins__gte=total), coins=F('coins') - total)
+        if row is None:
+            raise InsufficientCoins(f'balance below {total}')
+        purchases = Purchase.objects.bulk_create([
+            Purchase(user_id=user.pk, item=item, quantity=quantity, total_price=item.price * quantity)
+            for item, quantity in lines
+        ])
+        coin_transactions = CoinTransaction.objects.bulk_create([
+            CoinTransaction(
+                user_id=user.pk,
+                amount=-item.price * quantity,
+                transaction_type='purchase',
+                description=f'Bought {quantity}x {item.name}'
+            )
+            for item, quantity in lines
+        ])
+        # bulk_create skips the post_save rollup receiver
+        CoinDailyTotal.record(coin_transactions)
+        inventory.add_many(user, quantities)
+    return row['coins'], purchases
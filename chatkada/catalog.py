@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import namedtuple
+from .models import Item
+from .versions import get_version, catalog_version_key
+
+# How often a process asks the cache whether the catalog changed; edits made
+# in this process are seen at once, others' within this many seconds
+VERSION_CHECK_SECONDS = 1.0
+
+Snapshot = namedtuple('Snapshot', ['version', 'items', 'menu'])
+
+
+class Catalog:
+    """The Item table held in this process, rebuilt when its version changes.
+
+    ``items`` maps id to Item (available or not) and ``menu`` maps each
+    category to its available items. Item saves and deletes bump the
+    version (see bump_catalog_version in models.py), so the kada page and
+    shared-item messages are served without catalog queries.
+    """
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._checked_at = 0
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - self._checked_at < self.check_interval:
+            return snapshot
+        # Version before data, so a snapshot is never tagged newer than it is
+        version = get_version(catalog_version_key())
+        if snapshot is None or snapshot.version != version:
+            snapshot = self._load(version)
+        self._checked_at = now
+        return snapshot
+
+    def _load(self, version):
+        items = {item.pk: item for item in Item.objects.order_by('pk')}
+        menu = {category: [] for category, _ in Item.CATEGORY_CHOICES}
+        for item in items.values():
+            if item.available:
+                menu[item.category].append(item)
+        snapshot = Snapshot(version, items, menu)
+        with self._lock:
+            self._snapshot = snapshot
+        return snapshot
+
+    def item(self, item_id):
+        """An Item by id. Raises Item.DoesNotExist."""
+        item = self.snapshot().items.get(int(item_id))
+        if item is None:
+            # Newer than the snapshot (or gone); ask the database
+            item = Item.objects.get(pk=item_id)
+        return item
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+
+catalog = Catalog(check_interval=VERSION_CHECK_SECONDS)
@@ -0,0 +1,81 @@
+from datetime import date
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from .models import UserProfile, DailyChallenge
+from .versions import bump_version, coins_version_key
+
+# Snapshots are dropped or replaced on every change we make; the TTL only
+# bounds how long an admin edit or a lost race can leave one stale
+PROGRESS_TTL = 300
+
+
+def progress_key(user_id, day):
+    # Per day, so the midnight reset needs no write
+    return f"coin_progress:{user_id}:{day.isoformat()}"
+
+
+def get_coin_progress_payload(user):
+    """Coin and challenge progress, shared by get_coin_progress and the event stream.
+
+    Served from a per-user, per-day snapshot in the cache; on a miss it is
+    built with one query and stored.
+    """
+    today = date.today()
+    key = progress_key(user.pk, today)
+    data = cache.get(key)
+    if data is None:
+        data = load_coin_progress(user.pk, today)
+        # add, not set: never overwrite a fresher write-through snapshot
+        cache.add(key, data, PROGRESS_TTL)
+    return data
+
+
+def load_coin_progress(user_id, today=None):
+    """The progress payload straight from the database, in one query"""
+    today = today or date.today()
+
+    def completed(challenge_type):
+        return Exists(DailyChallenge.objects.filter(
+            user_id=OuterRef('user_id'),
+            challenge_type=challenge_type,
+            completed_date=today
+        ))
+
+    profile = UserProfile.objects.filter(user_id=user_id).annotate(
+        daily_login_completed=completed('daily_login'),
+        friends_challenge_completed=completed('make_friends'),
+    ).values(
+        'coins', 'daily_friends_made', 'friends_challenge_date', 'login_streak',
+        'daily_login_completed', 'friends_challenge_completed'
+    ).get()
+    return {
+        'total_coins': profile['coins'],
+        'daily_login_completed': profile['daily_login_completed'],
+        # A count from an earlier day is read as zero instead of reset on GET
+        'friends_progress': profile['daily_friends_made'] if profile['friends_challenge_date'] == today else 0,
+        'friends_challenge_completed': profile['friends_challenge_completed'],
+        'login_streak': profile['login_streak'],
+    }
+
+
+def coin_progress_changed(user_id, data=None):
+    """Mark a user's progress as changed once the transaction commits.
+
+    Bumps the ETag version and either drops the snapshot or, given the
+    fresh payload, writes it straight through.
+    """
+    bump_version(coins_version_key(user_id))
+    key = progress_key(user_id, date.today())
+    if data is None:
+        transaction.on_commit(lambda: cache.delete(key))
+    else:
+        transaction.on_commit(lambda: cache.set(key, data, PROGRESS_TTL))
+
+
+def coin_progress_changed_many(user_ids):
+    """coin_progress_changed for a bulk write: one cache round trip on commit"""
+    today = date.today()
+    keys = [coins_version_key(user_id) for user_id in user_ids]
+    keys += [progress_key(user_id, today) for user_id in user_ids]
+    transaction.on_commit(lambda: cache.delete_many(keys))
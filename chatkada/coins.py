@@ -0,0 +1,131 @@
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.db.models.sql import UpdateQuery
+from .models import UserProfile, CoinTransaction
+from .coin_progress import coin_progress_changed
+from .leaderboard import record_earnings
+
+
+class InsufficientCoins(Exception):
+    """The balance was lower than the amount being spent"""
+
+
+def _update_returning_sql(queryset, returning, values):
+    """The UPDATE for ``queryset`` with a RETURNING clause, as (sql, params)"""
+    model = queryset.model
+    query = queryset.query.chain(UpdateQuery)
+    query.add_update_values(values)
+    sql, params = query.get_compiler(queryset.db).as_sql()
+    columns = ', '.join(connection.ops.quote_name(model._meta.get_field(name).column) for name in returning)
+    return f'{sql} RETURNING {columns}', params
+
+
+def update_returning(queryset, returning, **values):
+    """One UPDATE of the single row ``queryset`` matches, returning ``returning``.
+
+    Uses UPDATE ... RETURNING where the backend has it (PostgreSQL, SQLite
+    3.35+), otherwise reads the row back in the same transaction. Returns
+    a dict, or None if no row matched and nothing was written.
+    """
+    model = queryset.model
+    # Backends that can RETURNING on INSERT can on UPDATE too
+    if connection.features.can_return_columns_from_insert:
+        with connection.cursor() as cursor:
+            cursor.execute(*_update_returning_sql(queryset, returning, values))
+            result = cursor.fetchone()
+    else:
+        with transaction.atomic():
+            result = None
+            pks = list(queryset.values_list('pk', flat=True)[:1])
+            if pks and queryset.filter(pk=pks[0]).update(**values):
+                result = model.objects.filter(pk=pks[0]).values_list(*returning).get()
+    if result is None:
+        return None
+    return dict(zip(returning, result))
+
+
+def update_returning_all(queryset, field, **values):
+    """One UPDATE of every row ``queryset`` matches; returns ``field`` of the rows written.
+
+    Elsewhere than RETURNING backends the rows are locked and listed
+    first, then updated by primary key.
+    """
+    if connection.features.can_return_columns_from_insert:
+        with connection.cursor() as cursor:
+            cursor.execute(*_update_returning_sql(queryset, [field], values))
+            return [row[0] for row in cursor.fetchall()]
+    with transaction.atomic():
+        rows = list(queryset.select_for_update().values_list('pk', field))
+        queryset.model.objects.filter(pk__in=[pk for pk, _ in rows]).update(**values)
+    return [value for _, value in rows]
+
+
+def update_profile(user, when=None, returning=('coins',), **values):
+    """One UPDATE of a user's profile, returning the new values of ``returning``.
+
+    ``values`` may use F() and Case() so the database does the arithmetic.
+    ``when`` is an extra Q() the row must match; if it doesn't, nothing is
+    written and None is returned. The user's cached profile, if any, is
+    updated and their coin progress snapshot dropped on commit.
+    """
+    profiles = UserProfile.objects.filter(user_id=user.pk)
+    if when is not None:
+        profiles = profiles.filter(when)
+
+    row = update_returning(profiles, returning, **values)
+    if row is None:
+        return None
+    coin_progress_changed(user.pk)
+
+    if 'userprofile' in user._state.fields_cache:
+        for name, value in row.items():
+            setattr(user.userprofile, name, value)
+    return row
+
+
+def post(user, amount, transaction_type, description, when=None, returning=('coins',), **values):
+    """Move ``amount`` coins (negative to spend) and record the CoinTransaction.
+
+    Both writes happen in one short transaction. ``description`` is stored
+    as given; pass a callable instead to build it from the returned row,
+    e.g. ``lambda row: f"Day {row['login_streak']}"``. Returns the row, or
+    None (nothing written) if ``when`` didn't match.
+    """
+    return _post(user, amount, transaction_type, description, when, returning, **values)[0]
+
+
+def _post(user, amount, transaction_type, description, when, returning, **values):
+    """post(), also returning the CoinTransaction written (or None)"""
+    with transaction.atomic():
+        row = update_profile(user, when=when, returning=returning, coins=F('coins') + amount, **values)
+        if row is None:
+            return None, None
+        coin_transaction = CoinTransaction.objects.create(
+            user_id=user.pk,
+            amount=amount,
+            transaction_type=transaction_type,
+            description=description(row) if callable(description) else description
+        )
+    return row, coin_transaction
+
+
+def credit(user, amount, transaction_type, description, when=None, returning=('coins',), **values):
+    """Award coins, counting them towards total_coins_earned and the leaderboards"""
+    row, coin_transaction = _post(
+        user, amount, transaction_type, description,
+        when=when,
+        returning=returning,
+        total_coins_earned=F('total_coins_earned') + amount,
+        **values
+    )
+    if row is not None:
+        record_earnings([coin_transaction])
+    return row
+
+
+def debit(user, amount, transaction_type, description, returning=('coins',), **values):
+    """Spend coins, only if the balance covers it. Raises InsufficientCoins."""
+    row = post(user, -amount, transaction_type, description, when=Q(coins__gte=amount), returning=returning, **values)
+    if row is None:
+        raise InsufficientCoins(f'balance below {amount}')
+    return row
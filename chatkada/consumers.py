@@ -0,0 +1,326 @@
+from channels.db import database_sync_to_async
+from channels.generic.http import AsyncHttpConsumer
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from django.conf import settings
+from urllib.parse import parse_qs
+from .longpoll import waiters, room_key, user_key
+from .models import ChatRoom, ChatMessage
+from .presence import presence
+from .realtime import room_group_name, user_group_name
+from .views import (
+    get_messages_payload, get_match_status, get_coin_progress_payload, count_online_users
+)
+import asyncio
+import json
+
+
+class ChatRoomConsumer(AsyncJsonWebsocketConsumer):
+    """Pushes new room messages to connected members.
+
+    Sending still goes through ``send_chat_message`` so the HTTP and
+    WebSocket clients share one write path; this socket is receive-only
+    apart from a keep-alive ping.
+    """
+
+    async def connect(self):
+        self.room_id = self.scope['url_route']['kwargs']['room_id']
+        self.group_name = room_group_name(self.room_id)
+        user = self.scope.get('user')
+
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
+
+        if not await self.is_participant(user):
+            await self.close()
+            return
+
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def receive_json(self, content, **kwargs):
+        if content.get('type') == 'ping':
+            await self.send_json({'type': 'pong'})
+
+    async def chat_message(self, event):
+        await self.send_json({
+            'type': 'message',
+            'message': event['message'],
+        })
+
+    async def chat_participants(self, event):
+        await self.send_json({
+            'type': 'participants',
+            'participant_count': event['participant_count'],
+        })
+
+    @database_sync_to_async
+    def is_participant(self, user):
+        return ChatRoom.objects.filter(
+            room_id=self.room_id,
+            is_active=True,
+            participants=user
+        ).exists()
+
+
+class LongPollConsumer(AsyncHttpConsumer):
+    """Base for long-poll endpoints served straight from the ASGI app.
+
+    These skip the Django middleware stack on purpose: a parked request
+    only holds a coroutine, never a worker thread.
+    """
+
+    async def send_json(self, data, status=200):
+        await self.send_response(
+            status,
+            json.dumps(data).encode('utf-8'),
+            headers=[
+                (b'Content-Type', b'application/json'),
+                (b'Cache-Control', b'no-store'),
+            ],
+        )
+
+    def get_query(self):
+        return parse_qs(self.scope.get('query_string', b'').decode('utf-8'))
+
+    def get_int_param(self, name, default=0):
+        values = self.get_query().get(name)
+        if not values or not values[0]:
+            return default
+        return int(values[0])
+
+    def get_timeout(self):
+        timeout = self.get_int_param('timeout', settings.LONG_POLL_TIMEOUT)
+        return max(0, min(timeout, settings.LONG_POLL_TIMEOUT))
+
+    async def handle(self, body):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.send_json({'success': False, 'error': 'Login required'}, status=403)
+            return
+        try:
+            await self.poll(user)
+        except ValueError:
+            await self.send_json({'success': False, 'error': 'Invalid parameter'}, status=400)
+
+
+class ChatMessagesLongPollConsumer(LongPollConsumer):
+    """Long-poll version of get_chat_messages.
+
+    Returns straight away if there is anything newer than ``since``,
+    otherwise waits up to ``timeout`` seconds for the next message.
+    """
+
+    async def poll(self, user):
+        room_id = self.scope['url_route']['kwargs']['room_id']
+        since = self.get_int_param('since')
+        timeout = self.get_timeout()
+
+        room = await self.get_room(room_id, user)
+        if room is None:
+            await self.send_json({'success': False, 'error': 'Access denied'})
+            return
+
+        with waiters.listen(room_key(room_id)) as waiter:
+            payload = await database_sync_to_async(get_messages_payload)(room, since=since)
+            if not payload['messages'] and since > 0:
+                if await waiter.wait(timeout):
+                    payload = await database_sync_to_async(get_messages_payload)(room, since=since)
+
+        await self.send_json(payload)
+
+    @database_sync_to_async
+    def get_room(self, room_id, user):
+        return ChatRoom.objects.filter(room_id=room_id, participants=user).first()
+
+
+class MatchStatusLongPollConsumer(LongPollConsumer):
+    """Long-poll version of check_match_status.
+
+    Holds the request while the user is still waiting and answers as soon
+    as they are matched, or with the current status after ``timeout``.
+    """
+
+    async def poll(self, user):
+        timeout = self.get_timeout()
+
+        with waiters.listen(user_key(user.id)) as waiter:
+            status = await database_sync_to_async(get_match_status)(user)
+            if status['status'] == 'waiting':
+                if await waiter.wait(timeout):
+                    status = await database_sync_to_async(get_match_status)(user)
+
+        await self.send_json(status)
+
+
+class UserEventStream:
+    """Server-Sent Events stream of everything a logged-in page polls for.
+
+    One stream per tab carries typed events:
+
+    * ``message`` - a new message in any room the user is in (with ``id:``)
+    * ``participants`` - a room's participant count changed
+    * ``coins`` - the get_coin_progress payload after a coin change
+    * ``online`` - the get_online_status counter, when it changes
+
+    Only ``message`` events carry an id, so a reconnect with
+    ``Last-Event-ID`` replays just the messages that were missed. The
+    counters are state, so the current values are re-sent instead.
+
+    This is a plain ASGI app rather than an AsyncHttpConsumer, because it
+    must keep reading the channel layer and watch for the client going away
+    while the response is still open.
+    """
+
+    def __init__(self, scope, receive, send):
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        self.user = None
+        self.online_users = None
+
+    @classmethod
+    def as_asgi(cls):
+        async def app(scope, receive, send):
+            await cls(scope, receive, send).run()
+        return app
+
+    async def run(self):
+        user = self.user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.send({
+                'type': 'http.response.start',
+                'status': 403,
+                'headers': [(b'Content-Type', b'text/plain')],
+            })
+            await self.send({'type': 'http.response.body', 'body': b'Login required'})
+            return
+
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        room_ids = await self.get_room_ids(user)
+        groups = [room_group_name(room_id) for room_id in room_ids]
+        groups.append(user_group_name(user.id))
+
+        # Join the groups before reading any state so nothing slips in between
+        for group in groups:
+            await channel_layer.group_add(group, channel)
+
+        disconnect_task = asyncio.ensure_future(self.wait_for_disconnect())
+        receive_task = asyncio.ensure_future(channel_layer.receive(channel))
+        try:
+            await self.send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [
+                    (b'Content-Type', b'text/event-stream'),
+                    (b'Cache-Control', b'no-cache'),
+                    (b'X-Accel-Buffering', b'no'),
+                ],
+            })
+            await self.write(f'retry: {settings.SSE_RETRY_MS}\n\n')
+
+            last_event_id = self.get_last_event_id()
+            if last_event_id:
+                for message in await self.get_missed_messages(room_ids, last_event_id):
+                    await self.send_event('message', message, event_id=message['id'])
+
+            await self.send_event('coins', await database_sync_to_async(get_coin_progress_payload)(user))
+            await self.send_online_count(user)
+
+            while not disconnect_task.done():
+                done, _ = await asyncio.wait(
+                    [receive_task, disconnect_task],
+                    timeout=settings.SSE_HEARTBEAT_INTERVAL,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if receive_task in done:
+                    await self.forward(receive_task.result())
+                    receive_task = asyncio.ensure_future(channel_layer.receive(channel))
+                elif not done:
+                    await self.write(': heartbeat\n\n')
+                    await self.touch_presence()
+                    await self.send_online_count(user)
+        finally:
+            receive_task.cancel()
+            disconnect_task.cancel()
+            for group in groups:
+                await channel_layer.group_discard(group, channel)
+
+    async def wait_for_disconnect(self):
+        while True:
+            message = await self.receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    async def forward(self, event):
+        if event['type'] == 'chat.message':
+            message = dict(event['message'], room_id=event['room_id'])
+            await self.send_event('message', message, event_id=message['id'])
+        elif event['type'] == 'chat.participants':
+            await self.send_event('participants', {
+                'room_id': event['room_id'],
+                'participant_count': event['participant_count'],
+            })
+        elif event['type'] == 'user.event':
+            await self.send_event(event['event'], event['data'])
+
+    async def send_online_count(self, user):
+        online_users = await database_sync_to_async(count_online_users)(exclude_user=user)
+        if online_users != self.online_users:
+            self.online_users = online_users
+            await self.send_event('online', {'online_users': online_users})
+
+    async def send_event(self, name, data, event_id=None):
+        frame = ''
+        if event_id is not None:
+            frame += f'id: {event_id}\n'
+        frame += f'event: {name}\ndata: {json.dumps(data)}\n\n'
+        await self.write(frame)
+        await self.touch_presence()
+
+    async def touch_presence(self):
+        # An open stream means an open tab, even if it makes no requests.
+        # The recorder throttles this to one stamp per user per period.
+        await database_sync_to_async(presence.touch)(self.user.id)
+
+    async def write(self, text):
+        await self.send({
+            'type': 'http.response.body',
+            'body': text.encode('utf-8'),
+            'more_body': True,
+        })
+
+    def get_last_event_id(self):
+        for name, value in self.scope.get('headers', []):
+            if name == b'last-event-id':
+                try:
+                    return int(value)
+                except ValueError:
+                    return 0
+        # EventSource can't set headers on the first connect, so allow a query param too
+        values = parse_qs(self.scope.get('query_string', b'').decode('utf-8')).get('last_event_id')
+        if values and values[0].isdigit():
+            return int(values[0])
+        return 0
+
+    @database_sync_to_async
+    def get_room_ids(self, user):
+        return list(
+            ChatRoom.objects.filter(participants=user, is_active=True)
+            .values_list('room_id', flat=True)
+        )
+
+    @database_sync_to_async
+    def get_missed_messages(self, room_ids, last_event_id):
+        missed = ChatMessage.objects.filter(
+            room__room_id__in=room_ids,
+            is_deleted=False,
+            id__gt=last_event_id
+        ).select_related('user', 'room').order_by('id')[:settings.SSE_REPLAY_LIMIT]
+        return [dict(msg.to_dict(), room_id=str(msg.room.room_id)) for msg in missed]
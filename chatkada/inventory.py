@@ -0,0 +1,70 @@
+from django.db import transaction, IntegrityError
+from django.db.models import F, Case, When, Value
+from .models import Inventory
+from .coins import update_returning
+
+
+def add(user, item, quantity):
+    """Count ``quantity`` newly bought ``item`` into the user's inventory"""
+    add_one(user, item.pk, quantity)
+
+
+def add_one(user, item_id, quantity):
+    rows = Inventory.objects.filter(user_id=user.pk, item_id=item_id)
+    values = {'owned': F('owned') + quantity, 'remaining': F('remaining') + quantity}
+    if rows.update(**values):
+        return
+    try:
+        with transaction.atomic():
+            Inventory.objects.create(user_id=user.pk, item_id=item_id, owned=quantity, remaining=quantity)
+    except IntegrityError:
+        # A concurrent first purchase of the same item created the row
+        rows.update(**values)
+
+
+def add_many(user, quantities):
+    """add() for a whole cart: ``quantities`` maps item id to quantity.
+
+    Rows the user already has move in one UPDATE; new ones are created in
+    one bulk INSERT.
+    """
+    rows = Inventory.objects.filter(user_id=user.pk, item_id__in=quantities)
+    existing = set(rows.values_list('item_id', flat=True))
+    if existing:
+        added = Case(*[When(item_id=item_id, then=Value(quantities[item_id])) for item_id in existing])
+        rows.filter(item_id__in=existing).update(owned=F('owned') + added, remaining=F('remaining') + added)
+    missing = [item_id for item_id in quantities if item_id not in existing]
+    if not missing:
+        return
+    try:
+        with transaction.atomic():
+            Inventory.objects.bulk_create([
+                Inventory(user_id=user.pk, item_id=item_id, owned=quantities[item_id], remaining=quantities[item_id])
+                for item_id in missing
+            ])
+    except IntegrityError:
+        # Some were created by a concurrent purchase in the meantime
+        for item_id in missing:
+            add_one(user, item_id, quantities[item_id])
+
+
+def share(user, item_id):
+    """Take one of an item the user still holds, in one conditional UPDATE.
+
+    Returns how many are left, or None if they had none to share.
+    """
+    row = update_returning(
+        Inventory.objects.filter(user_id=user.pk, item_id=item_id, remaining__gt=0),
+        ('remaining',),
+        remaining=F('remaining') - 1,
+        shared=F('shared') + 1
+    )
+    return None if row is None else row['remaining']
+
+
+def holdings(user, shareable_only=False):
+    """The user's inventory with items, from the (user, item) index"""
+    rows = Inventory.objects.filter(user_id=user.pk).select_related('item').order_by('item__name')
+    if shareable_only:
+        rows = rows.filter(remaining__gt=0, item__can_be_shared=True)
+    return rows
@@ -0,0 +1,384 @@
+import threading
+import uuid
+from bisect import bisect_left, insort
+from datetime import date, timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Subquery, Sum
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+BOARDS = ('global', 'weekly')
+BOARD_TITLES = {'global': 'All Time', 'weekly': 'This Week'}
+
+
+def week_start(day=None):
+    day = day or timezone.localdate()
+    return day - timedelta(days=day.weekday())
+
+
+def board_key(board):
+    """'global', or the weekly board for the current (Monday-based) week"""
+    if board == 'weekly':
+        return f"weekly:{week_start().isoformat()}"
+    return board
+
+
+def read_scores(key):
+    """Every user's score on a board and the newest CoinTransaction id, from the database.
+
+    Both come from one statement, so the id is a watermark: credits with a
+    higher transaction id aren't in the scores, the rest are. That holds
+    as long as ids are handed out in commit order, as with SQLite's single
+    writer; rebuild() repairs a board if an older transaction commits late.
+    """
+    from .models import UserProfile, CoinDailyTotal, CoinTransaction
+    newest = Subquery(CoinTransaction.objects.order_by('-id').values('id')[:1])
+    if key == 'global':
+        rows = UserProfile.objects.filter(total_coins_earned__gt=0).values_list('user_id', 'total_coins_earned', newest)
+    else:
+        start = date.fromisoformat(key.split(':', 1)[1])
+        rows = CoinDailyTotal.objects.filter(
+            day__gte=start,
+            day__lt=start + timedelta(days=7),
+            total__gt=0
+        ).values('user_id').annotate(score=Sum('total')).values_list('user_id', 'score', newest)
+    rows = list(rows)
+    # No rows means no credit the board counts had committed
+    watermark = rows[0][2] if rows else 0
+    return {user_id: score for user_id, score, _ in rows}, watermark
+
+
+def scores_from_db(key):
+    """Every user's score on a board, straight from the database"""
+    return read_scores(key)[0]
+
+
+class RankedScores:
+    """Scores kept in a list sorted by (-score, user_id).
+
+    Rank is a binary search and the top N a slice; changing a score moves
+    one entry, a memmove over the list (~50us at 200k users, against
+    ~4us for a rank).
+    """
+
+    def __init__(self, scores=None):
+        self._scores = dict(scores or {})
+        self._order = sorted((-score, user_id) for user_id, score in self._scores.items())
+
+    def add(self, user_id, amount):
+        old = self._scores.get(user_id)
+        if old is not None:
+            del self._order[bisect_left(self._order, (-old, user_id))]
+        score = (old or 0) + amount
+        self._scores[user_id] = score
+        insort(self._order, (-score, user_id))
+
+    def rank(self, user_id):
+        score = self._scores.get(user_id)
+        if score is None:
+            return None
+        return bisect_left(self._order, (-score, user_id)) + 1, score
+
+    def top(self, limit):
+        return [(user_id, -negative) for negative, user_id in self._order[:limit]]
+
+    def scores(self):
+        return dict(self._scores)
+
+    def __len__(self):
+        return len(self._scores)
+
+
+class LocalLeaderboard:
+    """Boards held in this process, loaded from the database on first use.
+
+    Fine for the single Daphne process; use the Redis backend with several
+    workers so they all rank from the same scores.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._boards = {}
+        # key -> [(user_id, transaction_id, amount)] credited while that board is being read
+        self._pending = {}
+
+    def _board(self, key):
+        board = self._boards.get(key)
+        if board is not None:
+            return board
+        with self._lock:
+            # Credits from now on are buffered, so none are lost between the
+            # read below and the board going live
+            self._pending.setdefault(key, [])
+
+        scores, watermark = read_scores(key)
+        with self._lock:
+            if key in self._boards:
+                # Loaded meanwhile by another thread or a rebuild
+                return self._boards[key]
+            return self._install(key, scores, watermark)
+
+    def _install(self, key, scores, watermark):
+        board = RankedScores(scores)
+        # Credits at or below the watermark committed before the read and
+        # are in the scores already
+        for user_id, transaction_id, amount in self._pending.pop(key, ()):
+            if transaction_id > watermark:
+                board.add(user_id, amount)
+        # Last week's board isn't needed any more
+        for old in [k for k in self._boards if k.startswith('weekly:') and k != key]:
+            del self._boards[old]
+        self._boards[key] = board
+        return board
+
+    def add(self, key, credits):
+        """Apply (user_id, transaction_id, amount) credits to a board"""
+        with self._lock:
+            board = self._boards.get(key)
+            if board is None:
+                if key in self._pending:
+                    self._pending[key].extend(credits)
+                # Otherwise loading will read these from the database
+                return
+            for user_id, _, amount in credits:
+                board.add(user_id, amount)
+
+    def top(self, key, limit):
+        board = self._board(key)
+        with self._lock:
+            return board.top(limit)
+
+    def rank(self, key, user_id):
+        board = self._board(key)
+        with self._lock:
+            return board.rank(user_id)
+
+    def size(self, key):
+        return len(self._board(key))
+
+    def scores(self, key):
+        board = self._board(key)
+        with self._lock:
+            return board.scores()
+
+    def load(self, key, scores, watermark):
+        with self._lock:
+            self._install(key, scores, watermark)
+
+    def clear(self):
+        with self._lock:
+            self._boards.clear()
+            self._pending.clear()
+
+
+class RedisLeaderboard:
+    """Sorted sets shared by every worker (ZINCRBY / ZREVRANK / ZREVRANGE)
+
+    A board is live once its ``:loaded`` marker exists; an empty board has
+    the marker but no sorted set, since Redis drops empty ones.
+    """
+
+    # KEYS: board, pending, loaded. ARGV: user id, transaction id, amount,
+    # repeated. Credits go to a live board, onto the pending list while the
+    # board is being read from the database, and nowhere otherwise (the
+    # read will include them).
+    ADD_SCRIPT = """
+    if redis.call('EXISTS', KEYS[3]) == 1 then
+        local created = redis.call('EXISTS', KEYS[1]) == 0
+        for i = 1, #ARGV, 3 do redis.call('ZINCRBY', KEYS[1], ARGV[i + 2], ARGV[i]) end
+        local ttl = redis.call('PTTL', KEYS[3])
+        if created and ttl > 0 then redis.call('PEXPIRE', KEYS[1], ttl) end
+    elseif redis.call('EXISTS', KEYS[2]) == 1 then
+        for i = 1, #ARGV, 3 do
+            redis.call('RPUSH', KEYS[2], ARGV[i] .. ' ' .. ARGV[i + 1] .. ' ' .. ARGV[i + 2])
+        end
+    end
+    """
+    # KEYS: temporary, board, pending, loaded. ARGV: 1 to keep a board that
+    # went live meanwhile, TTL (0 for none), watermark. Replays the pending
+    # credits newer than the watermark into the freshly read scores and
+    # renames them into place.
+    INSTALL_SCRIPT = """
+    local pending = redis.call('LRANGE', KEYS[3], 0, -1)
+    redis.call('DEL', KEYS[3])
+    if ARGV[1] == '1' and redis.call('EXISTS', KEYS[4]) == 1 then
+        redis.call('DEL', KEYS[1])
+        return 0
+    end
+    local watermark = tonumber(ARGV[3])
+    for _, credit in ipairs(pending) do
+        local user_id, transaction_id, amount = string.match(credit, '(%S+) (%S+) (%S+)')
+        if user_id and tonumber(transaction_id) > watermark then
+            redis.call('ZINCRBY', KEYS[1], amount, user_id)
+        end
+    end
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        redis.call('RENAME', KEYS[1], KEYS[2])
+    else
+        redis.call('DEL', KEYS[2])
+    end
+    redis.call('SET', KEYS[4], ARGV[3])
+    if tonumber(ARGV[2]) > 0 then
+        redis.call('EXPIRE', KEYS[2], ARGV[2])
+        redis.call('EXPIRE', KEYS[4], ARGV[2])
+    else
+        redis.call('PERSIST', KEYS[2])
+    end
+    return 1
+    """
+    # Bounds how long a crashed load leaves its leftovers behind
+    LOAD_TIMEOUT = 300
+
+    def __init__(self, url, prefix='leaderboard'):
+        import redis
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url)
+        self._add = self.client.register_script(self.ADD_SCRIPT)
+        self._install = self.client.register_script(self.INSTALL_SCRIPT)
+
+    def _key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def _keys(self, key):
+        return [self._key(key), self._key(f"{key}:pending"), self._key(f"{key}:loaded")]
+
+    def _ensure(self, key):
+        if self.client.exists(self._key(f"{key}:loaded")):
+            return
+        # Credits from now on are buffered, so none are lost between the
+        # read below and the board going live
+        pending = self._key(f"{key}:pending")
+        pipe = self.client.pipeline()
+        pipe.rpush(pending, '-')
+        pipe.expire(pending, self.LOAD_TIMEOUT)
+        pipe.execute()
+        scores, watermark = read_scores(key)
+        self._load(key, scores, watermark, replace=False)
+
+    def add(self, key, credits):
+        """Apply (user_id, transaction_id, amount) credits to a board"""
+        args = [value for credit in credits for value in credit]
+        if args:
+            self._add(keys=self._keys(key), args=args)
+
+    def top(self, key, limit):
+        self._ensure(key)
+        rows = self.client.zrevrange(self._key(key), 0, limit - 1, withscores=True)
+        return [(int(user_id), int(score)) for user_id, score in rows]
+
+    def rank(self, key, user_id):
+        self._ensure(key)
+        pipe = self.client.pipeline()
+        pipe.zrevrank(self._key(key), user_id)
+        pipe.zscore(self._key(key), user_id)
+        rank, score = pipe.execute()
+        if rank is None:
+            return None
+        return rank + 1, int(score)
+
+    def size(self, key):
+        self._ensure(key)
+        return self.client.zcard(self._key(key))
+
+    def scores(self, key):
+        self._ensure(key)
+        return {int(user_id): int(score) for user_id, score in self.client.zrange(self._key(key), 0, -1, withscores=True)}
+
+    def load(self, key, scores, watermark):
+        self._load(key, scores, watermark, replace=True)
+
+    def _load(self, key, scores, watermark, replace):
+        # Built under a temporary name and renamed, so readers never see it half full
+        temporary = self._key(f"{key}:loading:{uuid.uuid4().hex}")
+        pipe = self.client.pipeline()
+        items = list(scores.items())
+        for start in range(0, len(items), 10000):
+            pipe.zadd(temporary, dict(items[start:start + 10000]))
+        pipe.expire(temporary, self.LOAD_TIMEOUT)
+        pipe.execute()
+        ttl = 60 * 60 * 24 * 8 if key.startswith('weekly:') else 0
+        self._install(
+            keys=[temporary, *self._keys(key)],
+            args=[0 if replace else 1, ttl, watermark]
+        )
+
+    def clear(self):
+        for key in self.client.scan_iter(f"{self.prefix}:*"):
+            self.client.delete(key)
+
+
+def get_leaderboard_backend():
+    config = settings.LEADERBOARD_BACKEND
+    backend = import_string(config['BACKEND'])
+    return backend(**config.get('OPTIONS', {}))
+
+
+leaderboard = get_leaderboard_backend()
+
+
+def record_earnings(coin_transactions):
+    """Count the coins these CoinTransactions credited, once the transaction commits"""
+    credits = [
+        (coin_transaction.user_id, coin_transaction.pk, coin_transaction.amount)
+        for coin_transaction in coin_transactions
+        if coin_transaction.amount > 0
+    ]
+    if not credits:
+        return
+
+    def apply():
+        for board in BOARDS:
+            leaderboard.add(board_key(board), credits)
+
+    transaction.on_commit(apply)
+
+
+def rebuild(boards=BOARDS):
+    """Reload boards from the database; returns {board: users ranked}"""
+    counts = {}
+    for board in boards:
+        scores, watermark = read_scores(board_key(board))
+        leaderboard.load(board_key(board), scores, watermark)
+        counts[board] = len(scores)
+    return counts
+
+
+def check(board, limit=None):
+    """Compare a board with the database.
+
+    Returns (user_id, board score, database score) for every user whose
+    scores differ, including users missing from either side.
+    """
+    key = board_key(board)
+    ranked = leaderboard.scores(key)
+    expected = scores_from_db(key)
+    mismatches = [
+        (user_id, ranked.get(user_id), expected.get(user_id))
+        for user_id in sorted(set(ranked) | set(expected))
+        if ranked.get(user_id) != expected.get(user_id)
+    ]
+    return mismatches[:limit] if limit else mismatches
+
+
+def standings(user, limit=10):
+    """(title, board) pairs for templates.
+
+    Each board has ``top``, the first ``limit`` rows, and ``me``, the
+    user's (rank, score) or None if they have earned nothing on it.
+    """
+    from django.contrib.auth.models import User
+    boards = {}
+    user_ids = set()
+    for board in BOARDS:
+        key = board_key(board)
+        top = leaderboard.top(key, limit)
+        user_ids.update(user_id for user_id, _ in top)
+        boards[board] = {'top': top, 'me': leaderboard.rank(key, user.pk)}
+    names = dict(User.objects.filter(pk__in=user_ids).values_list('pk', 'username'))
+    for board in boards.values():
+        board['top'] = [
+            {'rank': position, 'username': names.get(user_id, '?'), 'score': score, 'is_me': user_id == user.pk}
+            for position, (user_id, score) in enumerate(board['top'], start=1)
+        ]
+    return [(BOARD_TITLES[board], boards[board]) for board in BOARDS]
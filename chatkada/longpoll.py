@@ -0,0 +1,83 @@
+import asyncio
+import threading
+from collections import defaultdict
+
+
+def room_key(room_id):
+    return f"room:{room_id}"
+
+
+def user_key(user_id):
+    return f"user:{user_id}"
+
+
+class Waiter:
+    """One parked long-poll request"""
+
+    def __init__(self, registry, key):
+        self.registry = registry
+        self.key = key
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    async def wait(self, timeout):
+        """Sleep until notified or ``timeout`` seconds pass. Returns True if notified."""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.remove(self)
+
+
+class WaiterRegistry:
+    """Per-process map of key -> parked asyncio waiters.
+
+    Register with ``listen()`` *before* reading the database so a write that
+    lands in between still wakes the waiter. ``notify()`` is safe to call
+    from any thread, including sync views running in the thread pool.
+    Waiters only hear about writes made in the same process; everything else
+    is picked up when the request times out and the client polls again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = defaultdict(set)
+
+    def listen(self, key):
+        waiter = Waiter(self, key)
+        with self._lock:
+            self._waiters[key].add(waiter)
+        return waiter
+
+    def remove(self, waiter):
+        with self._lock:
+            waiters = self._waiters.get(waiter.key)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[waiter.key]
+
+    def notify(self, key):
+        with self._lock:
+            waiters = list(self._waiters.get(key, ()))
+        for waiter in waiters:
+            try:
+                waiter.loop.call_soon_threadsafe(waiter.event.set)
+            except RuntimeError:
+                # The waiter's loop already shut down
+                pass
+
+    def waiting_count(self, key=None):
+        with self._lock:
+            if key is not None:
+                return len(self._waiters.get(key, ()))
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+
+waiters = WaiterRegistry()
@@ -0,0 +1,70 @@
+import json
+import time
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.test import RequestFactory
+from chatkada.models import Item, UserProfile
+from chatkada import views
+
+
+class Command(BaseCommand):
+    help = 'Compare kada orders per second: one buy_item request per item vs one cart checkout'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--orders',
+            type=int,
+            default=200,
+            help='Orders to place with each strategy (default: 200)'
+        )
+        parser.add_argument(
+            '--items',
+            type=int,
+            default=5,
+            help='Different items per order (default: 5)'
+        )
+
+    def handle(self, *args, **options):
+        orders = options['orders']
+        line_count = options['items']
+
+        # Real commits on purpose, per-request transactions are what we are
+        # measuring. The user, their orders and the items are deleted afterwards.
+        user = User.objects.create_user(username='__bench_checkout__', password='benchmark-pass')
+        UserProfile.objects.filter(user=user).update(coins=10 ** 9)
+        items = Item.objects.bulk_create([
+            Item(name=f'Benchmark item {i}', price=10, category='chai')
+            for i in range(line_count)
+        ])
+        try:
+            per_item = self.time_per_item(user, items, orders)
+            cart = self.time_checkout(user, items, orders)
+        finally:
+            Item.objects.filter(pk__in=[item.pk for item in items]).delete()
+            user.delete()
+
+        self.stdout.write(f'Orders per strategy: {orders} of {line_count} items')
+        self.stdout.write(f'Per item (buy_item per line): {orders / per_item:,.0f} orders/s')
+        self.stdout.write(f'Cart checkout (one request): {orders / cart:,.0f} orders/s')
+        self.stdout.write(self.style.SUCCESS(f'Checkout is {per_item / cart:.1f}x faster'))
+
+    def post(self, view, user, body):
+        request = RequestFactory().post('/', json.dumps(body), content_type='application/json')
+        request.user = user
+        data = json.loads(view(request).content)
+        if not data['success']:
+            raise RuntimeError(data['message'])
+
+    def time_per_item(self, user, items, orders):
+        start = time.perf_counter()
+        for _ in range(orders):
+            for item in items:
+                self.post(views.buy_item, user, {'item_id': item.pk, 'quantity': 1})
+        return time.perf_counter() - start
+
+    def time_checkout(self, user, items, orders):
+        lines = [{'item_id': item.pk, 'quantity': 1} for item in items]
+        start = time.perf_counter()
+        for _ in range(orders):
+            self.post(views.checkout, user, {'items': lines})
+        return time.perf_counter() - start
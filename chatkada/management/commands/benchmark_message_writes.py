@@ -0,0 +1,65 @@
+import time
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from chatkada.models import ChatRoom, ChatMessage
+from chatkada.write_behind import ChatMessageWriter, IdAllocator
+
+
+class Command(BaseCommand):
+    help = 'Compare chat message inserts per second for one worker: one INSERT each vs write-behind batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--messages',
+            type=int,
+            default=2000,
+            help='Messages to write with each strategy (default: 2000)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=200,
+            help='Write-behind batch size (default: 200)'
+        )
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        batch_size = options['batch_size']
+
+        if not IdAllocator.supported():
+            self.stdout.write(self.style.ERROR('Write-behind needs PostgreSQL or SQLite'))
+            return
+
+        # Real commits on purpose, per-message commits are what we are measuring.
+        # The room and its messages are deleted afterwards.
+        user = User.objects.create_user(username='__bench_writes__', password='benchmark-pass')
+        room = ChatRoom.objects.create(name='Benchmark Room', room_type='private_bench', created_by=user)
+        try:
+            direct = self.time_direct(user, room, count)
+            batched = self.time_batched(user, room, count, batch_size)
+        finally:
+            room.delete()
+            user.delete()
+
+        self.stdout.write(f'Messages per strategy: {count}')
+        self.stdout.write(f'Direct (one INSERT per message): {count / direct:,.0f} messages/s')
+        self.stdout.write(
+            f'Write-behind (batches of {batch_size}): {count / batched:,.0f} messages/s'
+        )
+        self.stdout.write(self.style.SUCCESS(f'Write-behind is {direct / batched:.1f}x faster'))
+
+    def time_direct(self, user, room, count):
+        start = time.perf_counter()
+        for i in range(count):
+            ChatMessage.objects.create(user=user, room=room, content=f'direct {i}')
+        return time.perf_counter() - start
+
+    def time_batched(self, user, room, count, batch_size):
+        writer = ChatMessageWriter(batch_size=batch_size, max_delay=0, start_thread=False)
+        start = time.perf_counter()
+        for i in range(count):
+            writer.submit(user=user, room=room, content=f'batched {i}')
+            if (i + 1) % batch_size == 0:
+                writer.flush()
+        writer.flush()
+        return time.perf_counter() - start
@@ -0,0 +1,110 @@
+import random
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import transaction
+from chatkada import matchmaking
+from chatkada.models import ChatRoom, StrangerChatQueue, UserChatHistory
+from chatkada.recent_partners import RecentPartners
+
+
+class Command(BaseCommand):
+    help = 'Compare batch matcher throughput and repeat matches with recent-partner exclusion off and on'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000, help='Queued users (default: 2000)')
+        parser.add_argument(
+            '--history',
+            type=int,
+            default=8,
+            help='Partners each user picks from their pool; they are also picked by others (default: 8)'
+        )
+        parser.add_argument(
+            '--pool',
+            type=int,
+            default=100,
+            help='Users only ever meet others within pools of this size (default: 100)'
+        )
+        parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.rng = random.Random(options['seed'])
+        original = matchmaking.recent_partners
+        # Everything is rolled back, so no matches are ever remembered between runs
+        try:
+            with transaction.atomic():
+                users = self.create_users(options)
+                for label, per_user in (('off', 0), ('on', settings.STRANGER_RECENT_PARTNERS or 20)):
+                    self.run(label, per_user, users)
+                transaction.set_rollback(True)
+        finally:
+            matchmaking.recent_partners = original
+
+    def create_users(self, options):
+        users = User.objects.bulk_create(
+            [User(username=f'__match_bench_{i}__') for i in range(options['users'])]
+        )
+        pool = options['pool']
+        self.history = set()
+        rows = []
+        for index, user in enumerate(users):
+            start = index - index % pool
+            members = users[start:start + pool]
+            for partner in self.rng.sample(members, min(options['history'], len(members))):
+                if partner.pk != user.pk and (user.pk, partner.pk) not in self.history:
+                    self.history.add((user.pk, partner.pk))
+                    self.history.add((partner.pk, user.pk))
+                    rows.append(UserChatHistory(user=user, chatted_with=partner))
+        UserChatHistory.objects.bulk_create(rows)
+        self.stdout.write(f'Users: {len(users)}  history rows: {len(rows)}')
+        return users
+
+    def run(self, label, per_user, users):
+        matchmaking.recent_partners = RecentPartners(
+            per_user=per_user,
+            max_users=len(users),
+            history_days=settings.STRANGER_RECENT_PARTNER_DAYS
+        )
+        # Arrivals are shuffled within each pool, so neighbours in the queue
+        # have often met before
+        pool = self.options['pool']
+        order = []
+        for start in range(0, len(users), pool):
+            members = users[start:start + pool]
+            self.rng.shuffle(members)
+            order.extend(members)
+        StrangerChatQueue.objects.bulk_create([StrangerChatQueue(user=user) for user in order])
+
+        start = time.perf_counter()
+        for user in order:
+            matchmaking.recent_partners.seed(user.pk)
+        seeded = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rooms = 0
+        while True:
+            matched = matchmaking.match_queue(settings.STRANGER_MATCH_BATCH_SIZE)
+            if not matched:
+                break
+            rooms += matched
+        elapsed = time.perf_counter() - start
+
+        Membership = ChatRoom.participants.through
+        members = {}
+        for room_id, user_id in Membership.objects.filter(
+            chatroom__room_type='stranger'
+        ).values_list('chatroom_id', 'user_id'):
+            members.setdefault(room_id, []).append(user_id)
+        repeats = sum(1 for pair in members.values() if tuple(pair) in self.history)
+        unpaired = StrangerChatQueue.objects.count()
+        StrangerChatQueue.objects.all().delete()
+        ChatRoom.objects.filter(pk__in=members).delete()
+
+        self.stdout.write(
+            f'Exclusion {label}: {rooms} pairs in {elapsed:.2f}s ({rooms / elapsed:,.0f} pairs/s)  '
+            f'repeat partners: {repeats}  left waiting: {unpaired}'
+        )
+        if per_user:
+            self.stdout.write(f'  seeding from history: {seeded / len(users) * 1000:.2f} ms/user (once, at enqueue)')
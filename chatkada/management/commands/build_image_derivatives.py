@@ -0,0 +1,89 @@
+import json
+import os
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def derived_name(path, width, extension):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return f"{settings.IMAGE_DERIVATIVES_DIR}/{stem}-{width}w.{extension}"
+
+
+class Command(BaseCommand):
+    help = 'Write resized WebP and PNG copies of the images in IMAGE_DERIVATIVES, and their manifest'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Rebuild copies that are newer than their source'
+        )
+        parser.add_argument(
+            '--quality',
+            type=int,
+            default=settings.IMAGE_DERIVATIVE_QUALITY,
+            help=f'WebP quality (default: {settings.IMAGE_DERIVATIVE_QUALITY})'
+        )
+
+    def handle(self, *args, **options):
+        manifest = {}
+        output_root = None
+        for path, widths in settings.IMAGE_DERIVATIVES.items():
+            source = finders.find(path)
+            if source is None:
+                raise CommandError(f'{path} is not a static file')
+            # Copies go next to the source, in the same static directory, so
+            # collectstatic picks them up and hashes their names
+            static_root = source[:-len(path)]
+            output_root = output_root or static_root
+            manifest[path] = self.build(path, source, static_root, widths, options)
+
+        if output_root is None:
+            return
+        manifest_path = os.path.join(output_root, settings.IMAGE_DERIVATIVES_DIR, MANIFEST_NAME)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {manifest_path}'))
+
+    def build(self, path, source, static_root, widths, options):
+        original_bytes = os.path.getsize(source)
+        with Image.open(source) as image:
+            image.load()
+        entry = {'width': image.width, 'height': image.height, 'bytes': original_bytes, 'variants': []}
+        os.makedirs(os.path.join(static_root, settings.IMAGE_DERIVATIVES_DIR), exist_ok=True)
+
+        # Never upscale; an image narrower than every width gets one full-size copy
+        for width in sorted({min(width, image.width) for width in widths}):
+            height = round(image.height * width / image.width)
+            variant = {'width': width, 'height': height}
+            resized = None
+            for extension in ('webp', 'png'):
+                name = derived_name(path, width, extension)
+                target = os.path.join(static_root, name)
+                if options['force'] or not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(source):
+                    if resized is None:
+                        resized = image.resize((width, height), Image.LANCZOS)
+                    if extension == 'webp':
+                        resized.save(target, 'WEBP', quality=options['quality'], method=6)
+                    else:
+                        resized.save(target, 'PNG', optimize=True)
+                variant[extension] = name
+                variant[f'{extension}_bytes'] = os.path.getsize(target)
+            entry['variants'].append(variant)
+
+        self.report(path, entry)
+        return entry
+
+    def report(self, path, entry):
+        original = entry['bytes']
+        self.stdout.write(f"{path} ({entry['width']}x{entry['height']}, {original:,} bytes)")
+        for variant in entry['variants']:
+            webp, png = variant['webp_bytes'], variant['png_bytes']
+            self.stdout.write(
+                f"  {variant['width']}w: WebP {webp:,} bytes ({1 - webp / original:.1%} smaller), "
+                f"PNG {png:,} bytes ({1 - png / original:.1%} smaller)"
+            )
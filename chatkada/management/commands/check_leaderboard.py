@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from chatkada import leaderboard
+
+
+class Command(BaseCommand):
+    # With the local backend this only checks a freshly loaded copy; use
+    # /custom-admin/leaderboard/ to check the boards a web process is serving
+    help = 'Compare the top-earner leaderboards with the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--show',
+            type=int,
+            default=20,
+            help='Mismatched users to list per board (default: 20)'
+        )
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='Rebuild any board that has mismatches'
+        )
+
+    def handle(self, *args, **options):
+        broken = []
+        for board in leaderboard.BOARDS:
+            mismatches = leaderboard.check(board)
+            if not mismatches:
+                self.stdout.write(self.style.SUCCESS(f'{board}: consistent'))
+                continue
+            broken.append(board)
+            self.stdout.write(self.style.WARNING(f'{board}: {len(mismatches)} users differ'))
+            for user_id, ranked, expected in mismatches[:options['show']]:
+                self.stdout.write(f'  user {user_id}: board {ranked}, database {expected}')
+
+        if broken and options['fix']:
+            leaderboard.rebuild(broken)
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt {", ".join(broken)}'))
+        elif broken:
+            raise CommandError(f'Leaderboards out of date: {", ".join(broken)}')
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from chatkada.tasks import cleanup_inactive_users
+
+class Command(BaseCommand):
+    help = 'Clean up inactive users and expired queue entries'
+
+    def handle(self, *args, **options):
+        # The same work the scheduled task does (CELERY_BEAT_SCHEDULE / CRONJOBS)
+        self.stdout.write(self.style.SUCCESS(cleanup_inactive_users()))
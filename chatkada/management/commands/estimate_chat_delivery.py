@@ -0,0 +1,102 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.contrib.auth import get_user
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection, transaction
+from django.http import HttpRequest
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from chatkada.models import ChatRoom, ChatMessage
+
+
+class Command(BaseCommand):
+    """An estimate, not a load test.
+
+    One poll of get_chat_messages and one WebSocket connect are run and
+    their queries counted; the queries per second are those counts scaled
+    by the number of users and how often each polls or reconnects.
+    """
+    help = 'Estimate DB queries per second for idle chat users under polling and under WebSocket push'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users',
+            type=int,
+            default=1000,
+            help='Number of idle users sitting in a chat room (default: 1000)'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=2.0,
+            help='Seconds between polls in the old client (default: 2)'
+        )
+        parser.add_argument(
+            '--reconnect-interval',
+            type=float,
+            default=3600.0,
+            help='Average seconds a socket stays open before reconnecting (default: 3600)'
+        )
+
+    def handle(self, *args, **options):
+        users = options['users']
+        poll_interval = options['poll_interval']
+        reconnect_interval = options['reconnect_interval']
+
+        # Everything below is rolled back, nothing is left in the database
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            with transaction.atomic():
+                poll_queries, connect_queries = self.measure()
+                transaction.set_rollback(True)
+
+        polling_qps = users * poll_queries / poll_interval
+        push_qps = users * connect_queries / reconnect_interval
+
+        self.stdout.write(f'Idle users: {users}')
+        self.stdout.write(f'Queries per poll of get_chat_messages: {poll_queries}')
+        self.stdout.write(f'Queries per WebSocket connect: {connect_queries}')
+        self.stdout.write(
+            f'Estimated, polling every {poll_interval:g}s: {polling_qps:,.1f} queries/s'
+        )
+        self.stdout.write(
+            f'Estimated, push (reconnect every {reconnect_interval:g}s): {push_qps:,.1f} queries/s'
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Push should save about {polling_qps - push_qps:,.1f} queries/s for idle rooms'
+            )
+        )
+
+    def measure(self):
+        user = User.objects.create_user(username='__bench_delivery__', password='benchmark-pass')
+        room = ChatRoom.objects.create(
+            name='Benchmark Room',
+            room_type='private_bench',
+            created_by=user
+        )
+        room.participants.add(user)
+        ChatMessage.objects.create(user=user, room=room, content='hello')
+
+        client = Client()
+        client.force_login(user)
+        url = reverse('get_chat_messages', kwargs={'room_id': room.room_id})
+        client.get(url)  # Warm up
+
+        with CaptureQueriesContext(connection) as poll_ctx:
+            client.get(url)
+
+        # What the consumer does on connect: session + user lookup, then membership
+        session_key = client.cookies['sessionid'].value
+        with CaptureQueriesContext(connection) as connect_ctx:
+            request = HttpRequest()
+            request.session = SessionStore(session_key)
+            connected_user = get_user(request)
+            ChatRoom.objects.filter(
+                room_id=room.room_id,
+                is_active=True,
+                participants=connected_user
+            ).exists()
+
+        return len(poll_ctx.captured_queries), len(connect_ctx.captured_queries)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from chatkada import leaderboard
+
+
+class Command(BaseCommand):
+    help = 'Reload the top-earner leaderboards from UserProfile and the daily coin rollup'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--board',
+            choices=leaderboard.BOARDS,
+            action='append',
+            help='Board to rebuild (default: all)'
+        )
+
+    def handle(self, *args, **options):
+        if isinstance(leaderboard.leaderboard, leaderboard.LocalLeaderboard):
+            self.stdout.write(self.style.WARNING(
+                'The local leaderboard backend lives in each web process; this only '
+                'rebuilds the copy in this command. POST to /custom-admin/leaderboard/ instead.'
+            ))
+        counts = leaderboard.rebuild(options['board'] or leaderboard.BOARDS)
+        for board, count in counts.items():
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt {board} leaderboard: {count} users'))
+
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from chatkada.models import CoinDailyTotal, CoinTransaction
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily coin rollup (CoinDailyTotal) from the CoinTransaction log'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Rollup rows per INSERT (default: 1000)'
+        )
+
+    def handle(self, *args, **options):
+        # One GROUP BY over the log; TruncDate uses the current time zone,
+        # like the incremental path
+        totals = CoinTransaction.objects.annotate(day=TruncDate('timestamp')).order_by().values(
+            'user_id', 'day', 'transaction_type'
+        ).annotate(total=Sum('amount'), count=Count('id'))
+
+        # Rebuilt in one transaction, so coin_center never sees it half done
+        with transaction.atomic():
+            deleted, _ = CoinDailyTotal.objects.all().delete()
+            created = CoinDailyTotal.objects.bulk_create(
+                [CoinDailyTotal(**row) for row in totals.iterator()],
+                batch_size=options['batch_size']
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Rebuilt {len(created)} daily coin totals (replaced {deleted})')
+        )
@@ -0,0 +1,233 @@
+import heapq
+import random
+from datetime import timedelta
+from unittest import mock
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from chatkada import matchmaking
+from chatkada.models import ChatRoom, StrangerChatQueue
+from chatkada.recent_partners import recent_partners
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.paused = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if not self.paused:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    """Runs on a simulated clock, so a seed always gives the same matches.
+
+    Searchers take turns on one connection rather than running in threads:
+    the loop jumps from one arrival, poll or matcher tick to the next and
+    timezone.now() is pinned to that moment while the request runs.
+    Latencies are in simulated time; they leave out how long the requests
+    themselves take, which the query counts stand in for.
+    """
+    help = 'Drive simulated searchers through find_stranger_chat and check_match_status and report match latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500, help='Simulated searchers (default: 500)')
+        parser.add_argument('--seed', type=int, default=1, help='Random seed for arrivals and polling (default: 1)')
+        parser.add_argument(
+            '--matcher',
+            choices=['batch', 'request'],
+            default='batch',
+            help='batch: background matcher passes; request: each search pairs itself (default: batch)'
+        )
+        parser.add_argument(
+            '--arrival-window',
+            type=float,
+            default=10.0,
+            help='Seconds over which searchers arrive (default: 10)'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Average seconds between check_match_status polls (default: 1)'
+        )
+        parser.add_argument(
+            '--tick-ms',
+            type=int,
+            default=settings.STRANGER_MATCH_INTERVAL_MS,
+            help='Batch matcher interval (default: STRANGER_MATCH_INTERVAL_MS)'
+        )
+        parser.add_argument(
+            '--min-partner-wait',
+            type=float,
+            default=matchmaking.MIN_PARTNER_WAIT.total_seconds(),
+            help='Seconds a partner must wait on the request path (default: MIN_PARTNER_WAIT)'
+        )
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            default=60.0,
+            help='Give up after this many simulated seconds (default: 60)'
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.rng = random.Random(options['seed'])
+
+        # Passes run from the simulation loop, on this connection, so the
+        # whole run can be rolled back
+        original_matcher = matchmaking.batch_matcher
+        original_wait = matchmaking.MIN_PARTNER_WAIT
+        matchmaking.batch_matcher = matchmaking.BatchMatcher(
+            interval=None,
+            batch_size=settings.STRANGER_MATCH_BATCH_SIZE
+        )
+        matchmaking.MIN_PARTNER_WAIT = timedelta(seconds=options['min_partner_wait'])
+        # Rolled back user ids are handed out again; forget their partners
+        recent_partners.clear()
+        try:
+            with override_settings(
+                STRANGER_BATCH_MATCHER=options['matcher'] == 'batch',
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']
+            ):
+                with transaction.atomic():
+                    self.simulate()
+                    transaction.set_rollback(True)
+        finally:
+            matchmaking.batch_matcher = original_matcher
+            matchmaking.MIN_PARTNER_WAIT = original_wait
+            recent_partners.clear()
+
+    def simulate(self):
+        options = self.options
+        users = [User.objects.create(username=f'__sim_{i}__') for i in range(options['users'])]
+        clients = {}
+        for user in users:
+            clients[user.id] = Client()
+            clients[user.id].force_login(user)
+
+        arrivals = sorted((self.rng.uniform(0, options['arrival_window']), user.id) for user in users)
+        arrivals.reverse()
+        polls = []
+        searched_at, noticed_at, noticed_room, outcomes = {}, {}, {}, {}
+        samples = []
+
+        counter = QueryCounter()
+        tick = options['tick_ms'] / 1000
+        batch = options['matcher'] == 'batch'
+        epoch = timezone.now()
+        now = 0.0
+        next_tick = 0.0
+        next_sample = 0.0
+
+        with connection.execute_wrapper(counter), \
+                mock.patch('django.utils.timezone.now', lambda: epoch + timedelta(seconds=now)):
+            while arrivals or polls:
+                # Straight on to whatever happens next
+                now = min(t for t in (
+                    arrivals[-1][0] if arrivals else None,
+                    polls[0][0] if polls else None,
+                    next_tick if batch else None,
+                    next_sample,
+                ) if t is not None)
+                if now > options['timeout']:
+                    break
+
+                while arrivals and arrivals[-1][0] <= now:
+                    _, user_id = arrivals.pop()
+                    searched_at[user_id] = now
+                    response = clients[user_id].post(reverse('find_stranger_chat'), {'action': 'find_stranger'})
+                    if response.status_code == 302 and '/chat/' in response['Location']:
+                        self.matched(user_id, response['Location'].rstrip('/').split('/')[-1], now, noticed_at, noticed_room)
+                    else:
+                        heapq.heappush(polls, (now + self.poll_delay(), user_id))
+
+                if batch and now >= next_tick:
+                    matchmaking.batch_matcher.tick()
+                    next_tick = now + tick
+
+                while polls and polls[0][0] <= now:
+                    _, user_id = heapq.heappop(polls)
+                    data = clients[user_id].get(reverse('check_match_status')).json()
+                    if data['status'] == 'matched':
+                        self.matched(user_id, data['room_id'], now, noticed_at, noticed_room)
+                    elif data['status'] == 'waiting':
+                        heapq.heappush(polls, (now + self.poll_delay(), user_id))
+                    else:
+                        outcomes[user_id] = data['status']
+
+                if now >= next_sample:
+                    # Measuring isn't part of the workload
+                    counter.paused = True
+                    samples.append((now, StrangerChatQueue.objects.filter(user__in=users).count()))
+                    counter.paused = False
+                    next_sample = now + 1.0
+
+        self.report(users, searched_at, noticed_at, noticed_room, outcomes, samples, counter.count, now)
+
+    def poll_delay(self):
+        return self.options['poll_interval'] * self.rng.uniform(0.5, 1.5)
+
+    def matched(self, user_id, room_id, now, noticed_at, noticed_room):
+        noticed_at[user_id] = now
+        noticed_room[user_id] = room_id
+
+    def report(self, users, searched_at, noticed_at, noticed_room, outcomes, samples, queries, elapsed):
+        Membership = ChatRoom.participants.through
+        user_ids = [user.id for user in users]
+        memberships = Membership.objects.filter(user_id__in=user_ids, chatroom__room_type='stranger')
+        rooms = ChatRoom.objects.filter(pk__in=memberships.values('chatroom_id'))
+        room_count = rooms.count()
+
+        double_matched = memberships.values('user_id').annotate(rooms=Count('chatroom_id')).filter(rooms__gt=1).count()
+        half_rooms = rooms.annotate(members=Count('participants')).exclude(members=2).count()
+        still_queued = StrangerChatQueue.objects.filter(user_id__in=user_ids).count()
+        actual_room = {
+            user_id: str(room_id)
+            for user_id, room_id in memberships.values_list('user_id', 'chatroom__room_id')
+        }
+        wrong_room = sum(1 for user_id, room_id in noticed_room.items() if actual_room.get(user_id) != room_id)
+        latencies = [(noticed_at[user_id] - searched_at[user_id]) * 1000 for user_id in noticed_at]
+
+        self.stdout.write(
+            f"Matcher: {self.options['matcher']}  users: {len(users)}  seed: {self.options['seed']}  "
+            f"simulated: {elapsed:.1f}s"
+        )
+        self.stdout.write(f'Matched (seen by client): {len(noticed_at)}  rooms: {room_count}')
+        if latencies:
+            self.stdout.write(
+                'Time to match (ms): '
+                + '  '.join(f'p{pct}={percentile(latencies, pct):.0f}' for pct in (50, 90, 99))
+                + f'  max={max(latencies):.0f}'
+            )
+        if room_count:
+            self.stdout.write(f'Queries per match: {queries / room_count:.1f}  (total {queries})')
+        self.stdout.write(
+            f'Double-matched users: {double_matched}  rooms without two members: {half_rooms}  '
+            f'client saw the wrong room: {wrong_room}'
+        )
+        self.stdout.write(f'Orphans still queued: {still_queued}  other outcomes: {len(outcomes)}')
+        self.stdout.write('Queue depth over time:')
+        for at, depth in samples:
+            self.stdout.write(f'  {at:6.1f}s  {depth}')
+
+        if double_matched or half_rooms or wrong_room:
+            self.stdout.write(self.style.ERROR('Matching invariants violated'))
+        else:
+            self.stdout.write(self.style.SUCCESS('No double matches'))
@@ -0,0 +1,265 @@
+import logging
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction, OperationalError
+from django.utils import timezone
+from .models import StrangerChatQueue, ChatRoom, ChatMessage, UserProfile
+from .realtime import publish_chat_message, publish_match
+from .recent_partners import recent_partners
+from .room_pool import room_pool, PoolRoomLost
+from .wait_estimator import wait_estimator
+from .write_behind import create_chat_messages
+
+logger = logging.getLogger(__name__)
+
+# A partner has to have been waiting this long before they can be picked
+MIN_PARTNER_WAIT = timedelta(seconds=30)
+
+# After this long in the queue a user will take a recent partner over nobody
+RECENT_PARTNER_GRACE = timedelta(seconds=60)
+
+# Lock timeouts, deadlocks and serialization failures are retried this many times
+CLAIM_ATTEMPTS = 3
+
+
+class ClaimLost(Exception):
+    """Somebody else dequeued one of the pair first"""
+
+
+def enqueue(user):
+    """Put a user in the stranger queue (committed, so other searchers see them)"""
+    queue_entry, created = StrangerChatQueue.objects.get_or_create(
+        user=user,
+        defaults={'connection_attempts': 0}
+    )
+    if not created:
+        queue_entry.connection_attempts += 1
+        update_fields = ['connection_attempts', 'last_attempt']
+        if queue_entry.is_expired():
+            # Searching again after the entry went stale starts a fresh wait
+            queue_entry.joined_at = timezone.now()
+            update_fields.append('joined_at')
+        queue_entry.save(update_fields=update_fields)
+    # One history query here, so pairing never has to look it up
+    recent_partners.seed(user.id)
+    wait_estimator.arrived(user.id)
+    return queue_entry
+
+
+def find_match(user):
+    """Pair a queued user with the longest-waiting partner.
+
+    Returns the new ChatRoom, or None if the user should keep waiting.
+    """
+    for _ in range(CLAIM_ATTEMPTS):
+        try:
+            return pair(user)
+        except (ClaimLost, PoolRoomLost, OperationalError) as e:
+            logger.warning(f'Match attempt for {user.id} lost a race, retrying: {str(e)}')
+    return None
+
+
+def pair(user):
+    """One pairing attempt, all in a single short transaction.
+
+    Both queue rows are locked before anything is written: our own with
+    SKIP LOCKED (if it's locked, another searcher is pairing with us right
+    now), and the partner's the same way, so concurrent searchers step
+    past rows that are being claimed instead of queueing up behind them.
+    The claim itself is a DELETE that has to remove exactly both rows, which
+    also keeps backends without row locks (SQLite) from double-matching.
+    """
+    with transaction.atomic():
+        now = timezone.now()
+        me = StrangerChatQueue.objects.select_for_update(skip_locked=True).filter(
+            user=user,
+            joined_at__gte=now - StrangerChatQueue.TTL
+        ).first()
+        if me is None:
+            return None
+
+        # Abandoned entries are never picked, even before the sweep deletes them
+        candidates = StrangerChatQueue.objects.select_for_update(skip_locked=True, of=('self',)).filter(
+            joined_at__lte=now - MIN_PARTNER_WAIT,
+            joined_at__gte=now - StrangerChatQueue.TTL
+        ).exclude(user=user)
+        if me.joined_at > now - RECENT_PARTNER_GRACE:
+            candidates = candidates.exclude(user_id__in=recent_partners.get(user.id))
+        partner = candidates.select_related('user').order_by('joined_at').first()
+        if partner is None:
+            return None
+
+        claimed, _ = StrangerChatQueue.objects.filter(pk__in=[me.pk, partner.pk]).delete()
+        if claimed != 2:
+            raise ClaimLost(f'claimed {claimed} of 2 queue entries')
+
+        return create_match_room(user, partner.user)
+
+
+def create_match_rooms(pairs):
+    """Rooms, memberships and connect messages for freshly claimed pairs.
+
+    Rooms come from the idle pool where it has enough, otherwise from one
+    bulk INSERT; the other tables get one bulk INSERT each, however many
+    pairs there are. Callers must already have taken the users off the queue.
+    """
+    now = timezone.now()
+    rooms = room_pool.claim(pairs, now) if settings.STRANGER_ROOM_POOL else []
+    rooms += ChatRoom.objects.bulk_create([
+        # bulk_create skips ChatRoom.save(), so expires_at is set here
+        ChatRoom(
+            name=f"Stranger Chat {now.strftime('%H:%M')}",
+            room_type='stranger',
+            created_by=user,
+            expires_at=now + timedelta(hours=1),
+            participant_count=2
+        )
+        for user, partner in pairs[len(rooms):]
+    ])
+    # Straight into the through table; participant_count is already right
+    Membership = ChatRoom.participants.through
+    Membership.objects.bulk_create([
+        Membership(chatroom_id=room.pk, user_id=member.pk)
+        for room, pair in zip(rooms, pairs)
+        for member in pair
+    ])
+    user_ids = [member.pk for pair in pairs for member in pair]
+    UserProfile.objects.filter(user_id__in=user_ids).update(looking_for_stranger_chat=False)
+
+    connect_messages = create_chat_messages([
+        ChatMessage(
+            room=room,
+            user=user,
+            message_type='system',
+            content=f"Connected with {partner.username}! Say hello! 👋",
+            expires_at=now + timedelta(hours=24)
+        )
+        for room, (user, partner) in zip(rooms, pairs)
+    ])
+    for message in connect_messages:
+        publish_chat_message(message)
+    publish_match([member for pair in pairs for member in pair])
+    transaction.on_commit(lambda: wait_estimator.matched(user_ids))
+    transaction.on_commit(lambda: remember_partners(pairs))
+    return rooms
+
+
+def remember_partners(pairs):
+    for user, partner in pairs:
+        recent_partners.record(user.pk, partner.pk)
+
+
+def create_match_room(user, partner):
+    return create_match_rooms([(user, partner)])[0]
+
+
+def match_queue(limit):
+    """Pair everyone waiting, oldest first, in one transaction.
+
+    Rows another searcher is pairing right now are skipped and picked up
+    on the next pass. Returns the number of rooms created.
+    """
+    with transaction.atomic():
+        entries = list(
+            # Lock only the queue rows, not the joined auth_user rows
+            StrangerChatQueue.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(joined_at__gte=timezone.now() - StrangerChatQueue.TTL)
+            .select_related('user').order_by('joined_at')[:limit]
+        )
+        entry_pairs = pair_entries(entries)
+        if not entry_pairs:
+            return 0
+
+        pairs = [(first.user, second.user) for first, second in entry_pairs]
+        claimed_ids = [entry.pk for pair in entry_pairs for entry in pair]
+        claimed, _ = StrangerChatQueue.objects.filter(pk__in=claimed_ids).delete()
+        if claimed != len(claimed_ids):
+            raise ClaimLost(f'claimed {claimed} of {len(claimed_ids)} queue entries')
+
+        create_match_rooms(pairs)
+        return len(pairs)
+
+
+def pair_entries(entries):
+    """Pair queue entries oldest first, skipping recent partners.
+
+    Each entry goes with the oldest still-unpaired entry it wasn't recently
+    matched with; anyone left over waits for the next pass. With exclusion
+    off (or nobody excluded) this is plain neighbour pairing. Somebody who
+    has waited RECENT_PARTNER_GRACE will be paired with anyone.
+    """
+    if not recent_partners.enabled:
+        return list(zip(entries[0::2], entries[1::2]))
+
+    patient_before = timezone.now() - RECENT_PARTNER_GRACE
+    pairs = []
+    unpaired = []
+    for entry in entries:
+        for index, other in enumerate(unpaired):
+            if other.joined_at <= patient_before or not recent_partners.excludes(other.user_id, entry.user_id):
+                pairs.append((other, entry))
+                del unpaired[index]
+                break
+        else:
+            unpaired.append(entry)
+    return pairs
+
+
+class BatchMatcher:
+    """Background thread that runs ``match_queue`` every ``interval`` seconds.
+
+    Started by the first search in a process. Several processes may each
+    run one, since claims are atomic. Clients hear about their match through
+    check_match_status / the match long-poll, which publish_match wakes.
+    """
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.ticks = 0
+        self.matched = 0
+
+    def start(self):
+        # interval=None is manual mode: passes only run when tick() is called
+        if self._thread is not None or self.interval is None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='stranger-matcher', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        """Run the next pass now rather than at the next tick"""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f'Error in stranger matcher: {str(e)}')
+            finally:
+                connection.close_if_unusable_or_obsolete()
+
+    def tick(self):
+        self.ticks += 1
+        try:
+            matched = match_queue(self.batch_size)
+        except (ClaimLost, PoolRoomLost, OperationalError) as e:
+            logger.warning(f'Matcher pass lost a race, retrying next tick: {str(e)}')
+            return 0
+        self.matched += matched
+        return matched
+
+
+batch_matcher = BatchMatcher(
+    interval=settings.STRANGER_MATCH_INTERVAL_MS / 1000,
+    batch_size=settings.STRANGER_MATCH_BATCH_SIZE,
+)
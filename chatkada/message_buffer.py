@@ -0,0 +1,201 @@
+import bisect
+import json
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+
+
+class RoomBuffer:
+    """Newest messages of one room, oldest first"""
+
+    def __init__(self, capacity, filled_at):
+        self.capacity = capacity
+        self.filled_at = filled_at
+        self.ids = []
+        self.entries = []  # (expires_at, message dict, approx bytes)
+        self.bytes = 0
+        # False once we have dropped older messages, so a cursor before
+        # the oldest buffered id can't be answered from here
+        self.complete = True
+
+    def insert(self, message_id, expires_at, data, size):
+        if self.ids and message_id <= self.ids[-1]:
+            position = bisect.bisect_left(self.ids, message_id)
+            if position < len(self.ids) and self.ids[position] == message_id:
+                return 0
+        else:
+            position = len(self.ids)
+        self.ids.insert(position, message_id)
+        self.entries.insert(position, (expires_at, data, size))
+        self.bytes += size
+        freed = 0
+        while len(self.ids) > self.capacity:
+            self.ids.pop(0)
+            freed += self.entries.pop(0)[2]
+            self.complete = False
+        self.bytes -= freed
+        return size - freed
+
+    def since(self, since, now):
+        """Messages newer than ``since``, or None if the gap reaches past the buffer"""
+        # Room ids aren't contiguous, so anything before the oldest buffered
+        # message may have been dropped
+        if since > 0 and not self.complete and self.ids and since < self.ids[0]:
+            return None
+        start = bisect.bisect_right(self.ids, since)
+        return [
+            data for expires_at, data, _ in self.entries[start:]
+            if expires_at is None or expires_at > now
+        ]
+
+
+class MessageBuffer:
+    """Per-process LRU of per-room ring buffers of serialized chat messages.
+
+    Writes go through ``publish_chat_message`` and are appended here once
+    committed; reads from ``get_messages_payload`` and ``chat_room`` are
+    served from it when possible. A room is loaded from the database on its
+    first read (``get_or_fill``), and writes that commit while that load is
+    running are merged in so nothing is lost.
+
+    The buffer only sees writes made in this process, so it assumes one
+    process per deployment (the default Daphne setup). Set
+    ``MESSAGE_BUFFER_ENABLED = False`` when running several workers. Rooms
+    are reloaded after ``ttl`` so deletes made by cleanup jobs in other
+    processes don't linger.
+    """
+
+    def __init__(self, room_capacity, max_bytes, ttl):
+        self.room_capacity = room_capacity
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rooms = OrderedDict()
+        self._filling = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def entry_for(message):
+        data = message.to_dict()
+        return message.id, message.expires_at, data, len(json.dumps(data))
+
+    def append(self, room_id, message):
+        """Record a committed message. Rooms that aren't cached are left alone."""
+        message_id, expires_at, data, size = self.entry_for(message)
+        with self._lock:
+            filling = self._filling.get(room_id)
+            if filling is not None:
+                filling[1][message_id] = (expires_at, data, size)
+            room = self._rooms.get(room_id)
+            if room is not None:
+                self._bytes += room.insert(message_id, expires_at, data, size)
+                self._rooms.move_to_end(room_id)
+                self._evict()
+
+    def get_since(self, room_id, since=0):
+        """Serialized messages newer than ``since`` (the newest page when 0), or None on a miss"""
+        now = timezone.now()
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is not None and now - room.filled_at > self.ttl:
+                self._rooms.pop(room_id)
+                self._bytes -= room.bytes
+                room = None
+            result = room.since(since, now) if room is not None else None
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._rooms.move_to_end(room_id)
+            return result
+
+    def get_or_fill(self, room_id, since, loader):
+        """Like ``get_since``, loading the room on a miss.
+
+        ``loader`` returns the room's newest ``room_capacity`` live messages.
+        Still returns None when ``since`` is older than anything the buffer
+        can hold, so the caller should go to the database.
+        """
+        result = self.get_since(room_id, since)
+        if result is not None:
+            return result
+
+        with self._lock:
+            filling = self._filling.setdefault(room_id, [0, {}])
+            filling[0] += 1
+        try:
+            messages = loader()
+        except Exception:
+            with self._lock:
+                self._end_fill(room_id)
+            raise
+
+        room = RoomBuffer(self.room_capacity, timezone.now())
+        for message in messages:
+            room.insert(*self.entry_for(message))
+        room.complete = len(messages) < self.room_capacity
+        with self._lock:
+            # Merge in anything committed while we were reading
+            for message_id, (expires_at, data, size) in self._end_fill(room_id).items():
+                room.insert(message_id, expires_at, data, size)
+            old = self._rooms.pop(room_id, None)
+            if old is not None:
+                self._bytes -= old.bytes
+            self._rooms[room_id] = room
+            self._bytes += room.bytes
+            self._evict()
+            return room.since(since, timezone.now())
+
+    def _end_fill(self, room_id):
+        filling = self._filling.get(room_id)
+        if filling is None:
+            return {}
+        filling[0] -= 1
+        if filling[0] <= 0:
+            del self._filling[room_id]
+        return dict(filling[1])
+
+    def invalidate(self, room_id):
+        with self._lock:
+            room = self._rooms.pop(room_id, None)
+            if room is not None:
+                self._bytes -= room.bytes
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._filling.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def _evict(self):
+        # Always keep the most recently used room
+        while self._bytes > self.max_bytes and len(self._rooms) > 1:
+            _, room = self._rooms.popitem(last=False)
+            self._bytes -= room.bytes
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'rooms': len(self._rooms),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+message_buffer = MessageBuffer(
+    room_capacity=settings.MESSAGE_BUFFER_ROOM_SIZE,
+    max_bytes=settings.MESSAGE_BUFFER_MAX_BYTES,
+    ttl=timedelta(seconds=settings.MESSAGE_BUFFER_TTL),
+)
@@ -1,18 +1,28 @@
-from django.utils import timezone
-from .models import UserProfile
+from django.conf import settings
+from .presence import presence
 
 class OnlineStatusMiddleware:
+    """Marks logged-in users as online.
+
+    Writes are throttled and batched by ``presence``. Paths starting with
+    one of ``PRESENCE_EXEMPT_PATHS`` and views wrapped in
+    ``presence_exempt`` don't count as activity.
+    """
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self.exempt_paths = tuple(settings.PRESENCE_EXEMPT_PATHS)
 
     def __call__(self, request):
-        if request.user.is_authenticated:
-            try:
-                profile = request.user.userprofile
-                profile.update_activity()
-            except UserProfile.DoesNotExist:
-                # Create profile if it doesn't exist
-                UserProfile.objects.create(user=request.user)
-        
         response = self.get_response(request)
+
+        if request.user.is_authenticated and not getattr(request, 'presence_exempt', False):
+            if not request.path.startswith(self.exempt_paths):
+                presence.touch(request.user.id)
+
         return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, 'presence_exempt', False):
+            request.presence_exempt = True
+        return None
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatkada', '0002_alter_userprofile_coins'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room', 'is_deleted', 'id'], name='chatmsg_room_live_id_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:27
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_participant_count(apps, schema_editor):
+    ChatRoom = apps.get_model('chatkada', 'ChatRoom')
+    Membership = ChatRoom.participants.through
+    members = Membership.objects.filter(chatroom_id=OuterRef('pk')).values('chatroom_id').annotate(
+        total=Count('pk')
+    ).values('total')
+    ChatRoom.objects.update(participant_count=Coalesce(Subquery(members), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatkada', '0003_chatmessage_cursor_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='participant_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_participant_count, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['room_type', 'is_active', 'participant_count'], name='chatroom_open_idx'),
+        ),
+    ]
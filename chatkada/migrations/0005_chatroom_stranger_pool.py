@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:42
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chatkada', '0004_chatroom_participant_count'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatroom',
+            name='created_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='created_rooms', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='chatroom',
+            name='room_type',
+            field=models.CharField(choices=[('stranger', 'Stranger Chat'), ('private_bench', 'Private Bench'), ('stranger_pool', 'Pooled Stranger Room')], default='stranger', max_length=15),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:47
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+
+def fill_daily_totals(apps, schema_editor):
+    # Roll up the existing log, as rollup_coin_transactions does, so
+    # coin_center has history from the start
+    CoinTransaction = apps.get_model('chatkada', 'CoinTransaction')
+    CoinDailyTotal = apps.get_model('chatkada', 'CoinDailyTotal')
+    totals = CoinTransaction.objects.annotate(day=TruncDate('timestamp')).order_by().values(
+        'user_id', 'day', 'transaction_type'
+    ).annotate(total=Sum('amount'), count=Count('id'))
+    CoinDailyTotal.objects.bulk_create([CoinDailyTotal(**row) for row in totals.iterator()], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chatkada', '0005_chatroom_stranger_pool'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoinDailyTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('transaction_type', models.CharField(choices=[('daily_login', 'Daily Login Bonus'), ('make_friends', 'Make 5 Friends Challenge'), ('purchase', 'Item Purchase'), ('signup_bonus', 'Signup Bonus')], max_length=20)),
+                ('total', models.IntegerField(default=0)),
+                ('count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'day', 'transaction_type')},
+            },
+        ),
+        migrations.RunPython(fill_daily_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:57
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Sum
+import django.db.models.deletion
+
+
+def fill_inventory(apps, schema_editor):
+    # Sum each user's purchases of an item into one row, before the
+    # per-purchase share counts are dropped
+    Purchase = apps.get_model('chatkada', 'Purchase')
+    Inventory = apps.get_model('chatkada', 'Inventory')
+    totals = Purchase.objects.order_by().values('user_id', 'item_id').annotate(
+        owned=Sum('quantity'),
+        remaining=Sum('remaining_quantity'),
+        shared=Sum(F('quantity') - F('remaining_quantity'))
+    )
+    Inventory.objects.bulk_create([Inventory(**row) for row in totals.iterator()], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chatkada', '0006_coindailytotal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Inventory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('owned', models.IntegerField(default=0)),
+                ('remaining', models.IntegerField(default=0)),
+                ('shared', models.IntegerField(default=0)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chatkada.item')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inventory', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'inventories',
+                'unique_together': {('user', 'item')},
+            },
+        ),
+        migrations.RunPython(fill_inventory, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='purchase',
+            name='remaining_quantity',
+        ),
+        migrations.RemoveField(
+            model_name='purchase',
+            name='shared_in_chat',
+        ),
+    ]
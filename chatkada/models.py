@@ -1,11 +1,15 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models import F, Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.utils import timezone
 from datetime import timedelta
 import uuid
 import secrets
+from .versions import bump_version, match_version_key, catalog_version_key
+from .online import online_users
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -24,9 +28,7 @@ class UserProfile(models.Model):
     
     def is_currently_online(self):
         """Check if user is online (active within last 5 minutes)"""
-        if not self.is_online:
-            return False
-        return timezone.now() - self.last_activity < timedelta(minutes=5)
+        return online_users.is_online(self.user_id)
     
     def update_activity(self):
         """Update user's last activity timestamp"""
@@ -44,12 +46,16 @@ class StrangerChatQueue(models.Model):
     connection_attempts = models.IntegerField(default=0)
     last_attempt = models.DateTimeField(auto_now=True)
     
+    # Entries older than this are abandoned: never matched, and deleted by
+    # cleanup_inactive_users
+    TTL = timedelta(minutes=10)
+    
     class Meta:
         ordering = ['joined_at']
     
     def is_expired(self):
-        """Check if queue entry is expired (older than 10 minutes)"""
-        return timezone.now() - self.joined_at > timedelta(minutes=10)
+        """Check if queue entry is expired (older than TTL)"""
+        return timezone.now() - self.joined_at > self.TTL
 
 class DailyChallenge(models.Model):
     CHALLENGE_TYPES = [
@@ -68,6 +74,34 @@ class DailyChallenge(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.get_challenge_type_display()}"
 
+class ChallengeJob(models.Model):
+    """Progress of an assign_daily_challenge run, for the custom admin to poll.
+
+    A row rather than a cache entry, so progress written by a Celery worker
+    is seen by every web process whatever cache backend they use.
+    """
+    STATUSES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    
+    job_id = models.CharField(max_length=32, unique=True)
+    challenge_type = models.CharField(max_length=20, choices=DailyChallenge.CHALLENGE_TYPES)
+    coins_earned = models.IntegerField()
+    day = models.DateField()
+    status = models.CharField(max_length=10, choices=STATUSES, default='queued')
+    total = models.IntegerField(null=True, blank=True)
+    processed = models.IntegerField(default=0)
+    assigned = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"{self.job_id} {self.challenge_type} {self.day}: {self.status}"
+
 class CoinTransaction(models.Model):
     TRANSACTION_TYPES = [
         ('daily_login', 'Daily Login Bonus'),
@@ -88,6 +122,69 @@ class CoinTransaction(models.Model):
     def __str__(self):
         return f"{self.user.username}: {self.amount} coins ({self.get_transaction_type_display()})"
 
+class CoinDailyTotal(models.Model):
+    """Per user, day and type: the sum and number of CoinTransactions.
+
+    Kept up to date as transactions are saved or deleted (bulk writers call
+    ``record`` themselves) and rebuilt by the rollup_coin_transactions
+    command, so coin_center reads a week as one index range instead of
+    aggregating the transaction log.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    day = models.DateField()
+    transaction_type = models.CharField(max_length=20, choices=CoinTransaction.TRANSACTION_TYPES)
+    total = models.IntegerField(default=0)
+    count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['user', 'day', 'transaction_type']
+    
+    def __str__(self):
+        return f"{self.user_id} {self.day} {self.transaction_type}: {self.total} ({self.count})"
+    
+    @classmethod
+    def record(cls, transactions, sign=1):
+        """Add (or with sign=-1, take away) saved CoinTransactions"""
+        deltas = {}
+        for coin_transaction in transactions:
+            key = (coin_transaction.user_id, timezone.localdate(coin_transaction.timestamp), coin_transaction.transaction_type)
+            total, count = deltas.get(key, (0, 0))
+            deltas[key] = (total + sign * coin_transaction.amount, count + sign)
+        
+        # Rows moving by the same amount share one UPDATE, so a bulk award
+        # to many users costs a few queries rather than one per user
+        groups = {}
+        for (user_id, day, transaction_type), delta in deltas.items():
+            groups.setdefault((day, transaction_type, delta), []).append(user_id)
+        
+        for (day, transaction_type, (total, count)), user_ids in groups.items():
+            rollups = cls.objects.filter(day=day, transaction_type=transaction_type, user_id__in=user_ids)
+            if rollups.update(total=F('total') + total, count=F('count') + count) == len(user_ids):
+                continue
+            existing = set(rollups.values_list('user_id', flat=True))
+            missing = [user_id for user_id in user_ids if user_id not in existing]
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create([
+                        cls(user_id=user_id, day=day, transaction_type=transaction_type, total=total, count=count)
+                        for user_id in missing
+                    ])
+            except IntegrityError:
+                # Some were created by a concurrent transaction in the meantime
+                for user_id in missing:
+                    cls._add(user_id, day, transaction_type, total, count)
+    
+    @classmethod
+    def _add(cls, user_id, day, transaction_type, total, count):
+        rollup = cls.objects.filter(user_id=user_id, day=day, transaction_type=transaction_type)
+        if rollup.update(total=F('total') + total, count=F('count') + count):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(user_id=user_id, day=day, transaction_type=transaction_type, total=total, count=count)
+        except IntegrityError:
+            rollup.update(total=F('total') + total, count=F('count') + count)
+
 class UserChatHistory(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     chatted_with = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_chats')
@@ -106,14 +203,38 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
+    # Only make sure the profile exists: re-saving the whole row here (on
+    # every login) would write back a stale coin balance
     if not hasattr(instance, 'userprofile'):
         UserProfile.objects.create(user=instance)
-    instance.userprofile.save()
+
+@receiver(post_save, sender=CoinTransaction)
+def roll_up_coin_transaction(sender, instance, created, **kwargs):
+    if created:
+        CoinDailyTotal.record([instance])
+
+@receiver(post_delete, sender=CoinTransaction)
+def roll_back_coin_transaction(sender, instance, **kwargs):
+    # Only ever subtracts: when a user is deleted their rollup rows can go
+    # before their transactions, and must not be recreated
+    CoinDailyTotal.objects.filter(
+        user_id=instance.user_id,
+        day=timezone.localdate(instance.timestamp),
+        transaction_type=instance.transaction_type
+    ).update(total=F('total') - instance.amount, count=F('count') - 1)
+
+@receiver(post_save, sender=StrangerChatQueue)
+@receiver(post_delete, sender=StrangerChatQueue)
+def bump_match_version(sender, instance, **kwargs):
+    # Joining or leaving the queue changes what check_match_status returns
+    bump_version(match_version_key(instance.user_id))
     
 class ChatRoom(models.Model):
     ROOM_TYPES = [
         ('stranger', 'Stranger Chat'),
         ('private_bench', 'Private Bench'),
+        # Pre-allocated and idle until the matcher claims it (chatkada/room_pool.py)
+        ('stranger_pool', 'Pooled Stranger Room'),
     ]
     
     room_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
@@ -123,10 +244,19 @@ class ChatRoom(models.Model):
     max_users = models.IntegerField(default=4)
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField(null=True, blank=True)  # Add expiration field
-    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='created_rooms')
+    # Empty while a room is in the stranger pool
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='created_rooms', null=True, blank=True)
     participants = models.ManyToManyField(User, related_name='chat_rooms', blank=True)
+    # Kept in step with participants by add_participant/remove_participant
+    # and the m2m_changed receiver below
+    participant_count = models.PositiveIntegerField(default=0)
     is_active = models.BooleanField(default=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['room_type', 'is_active', 'participant_count'], name='chatroom_open_idx'),
+        ]
+    
     def save(self, *args, **kwargs):
         # Set expiration for stranger chats
         if self.room_type == 'stranger' and not self.expires_at:
@@ -138,7 +268,46 @@ class ChatRoom(models.Model):
     
     @property
     def is_full(self):
-        return self.participants.count() >= self.max_users
+        return self.participant_count >= self.max_users
+    
+    def has_participant(self, user):
+        # Single probe on the (chatroom, user) unique index
+        return ChatRoom.participants.through.objects.filter(
+            chatroom_id=self.pk,
+            user_id=user.pk
+        ).exists()
+    
+    def add_participant(self, user):
+        """Join the room if there is space. Returns False when it is full."""
+        if self.has_participant(user):
+            return True
+        try:
+            with transaction.atomic():
+                # Claim a seat first so two joins can't both take the last one
+                claimed = ChatRoom.objects.filter(
+                    pk=self.pk,
+                    participant_count__lt=F('max_users')
+                ).update(participant_count=F('participant_count') + 1)
+                if not claimed:
+                    return False
+                ChatRoom.participants.through.objects.create(chatroom_id=self.pk, user_id=user.pk)
+        except IntegrityError:
+            # Joined at the same time from another request
+            return True
+        self.refresh_from_db(fields=['participant_count'])
+        return True
+    
+    def remove_participant(self, user):
+        """Leave the room. Returns False if the user wasn't in it."""
+        with transaction.atomic():
+            removed, _ = ChatRoom.participants.through.objects.filter(
+                chatroom_id=self.pk,
+                user_id=user.pk
+            ).delete()
+            if removed:
+                ChatRoom.objects.filter(pk=self.pk).update(participant_count=F('participant_count') - 1)
+        self.refresh_from_db(fields=['participant_count'])
+        return bool(removed)
     
     @property
     def is_expired(self):
@@ -147,7 +316,7 @@ class ChatRoom(models.Model):
         return False
     
     def get_participant_count(self):
-        return self.participants.count()
+        return self.participant_count
     
     def get_display_name(self):
         if self.room_type == 'stranger':
@@ -163,6 +332,35 @@ class ChatRoom(models.Model):
                 return f"{minutes} min"
         return "Expired"
 
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def sync_participant_count(sender, instance, action, reverse, pk_set, **kwargs):
+    """Recount after participants.add/remove/clear (admin, new rooms).
+
+    add_participant/remove_participant write the through table directly and
+    keep the counter themselves, so they don't come through here.
+    """
+    if reverse and action == 'pre_clear':
+        instance._cleared_room_ids = list(instance.chat_rooms.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    
+    if not reverse:
+        room_ids = [instance.pk]
+    elif action == 'post_clear':
+        room_ids = getattr(instance, '_cleared_room_ids', [])
+    else:
+        room_ids = pk_set
+    
+    members = sender.objects.filter(chatroom_id=OuterRef('pk')).values('chatroom_id').annotate(
+        total=Count('pk')
+    ).values('total')
+    ChatRoom.objects.filter(pk__in=room_ids).update(
+        participant_count=Coalesce(Subquery(members), 0)
+    )
+    if not reverse:
+        instance.refresh_from_db(fields=['participant_count'])
+
 class BenchInvite(models.Model):
     INVITE_STATUS = [
         ('active', 'Active'),
@@ -218,36 +416,44 @@ class Item(models.Model):
     def __str__(self):
         return self.name
 
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def bump_catalog_version(sender, instance, **kwargs):
+    # Every process rebuilds its catalog snapshot (chatkada/catalog.py) once
+    # the token changes; this one drops its own straight away
+    from .catalog import catalog
+    bump_version(catalog_version_key())
+    transaction.on_commit(catalog.invalidate)
+
 class Purchase(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=1)
     total_price = models.IntegerField()
     timestamp = models.DateTimeField(auto_now_add=True)
-    shared_in_chat = models.BooleanField(default=False)
-    remaining_quantity = models.IntegerField(default=1)  # Track remaining items after sharing
     
     def __str__(self):
         return f"{self.user.username} bought {self.quantity}x {self.item.name}"
+
+class Inventory(models.Model):
+    """What a user holds of an item: bought, still to share, and shared.
+
+    One row per user and item, moved with F() updates by chatkada/inventory.py
+    as items are bought and shared, so neither sharing nor the profile page
+    has to look through a user's Purchase rows.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='inventory')
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    owned = models.IntegerField(default=0)
+    remaining = models.IntegerField(default=0)
+    shared = models.IntegerField(default=0)
     
-    def save(self, *args, **kwargs):
-        # Set remaining_quantity to quantity on first save
-        if not self.pk:
-            self.remaining_quantity = self.quantity
-        super().save(*args, **kwargs)
-    
-    def can_share(self):
-        """Check if user has remaining items to share"""
-        return self.remaining_quantity > 0
+    class Meta:
+        unique_together = ['user', 'item']
+        verbose_name_plural = 'inventories'
     
-    def share_item(self):
-        """Share one item and decrease remaining quantity"""
-        if self.can_share():
-            self.remaining_quantity -= 1
-            self.shared_in_chat = True
-            self.save()
-            return True
-        return False
+    def __str__(self):
+        return f"{self.user_id} {self.item_id}: {self.remaining}/{self.owned} left"
 
 class ChatMessage(models.Model):
     MESSAGE_TYPES = [
@@ -268,6 +474,10 @@ class ChatMessage(models.Model):
     
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            # Cursor pagination in get_chat_messages
+            models.Index(fields=['room', 'is_deleted', 'id'], name='chatmsg_room_live_id_idx'),
+        ]
     
     def save(self, *args, **kwargs):
         # Set expiration time for stranger chat messages (24 hours)
@@ -275,5 +485,28 @@ class ChatMessage(models.Model):
             self.expires_at = timezone.now() + timedelta(hours=24)
         super().save(*args, **kwargs)
     
+    def to_dict(self):
+        """Serialize the message the way the chat clients expect it"""
+        message_data = {
+            'id': self.id,
+            'user': self.user.username,
+            'content': self.content,
+            'message_type': self.message_type,
+            'timestamp': self.timestamp.isoformat(),
+        }
+        
+        # Add shared item data if applicable, from the in-process catalog
+        # rather than a join per message
+        if self.message_type == 'shared_item' and self.shared_item_id:
+            from .catalog import catalog
+            item = catalog.item(self.shared_item_id)
+            message_data['shared_item'] = {
+                'name': item.name,
+                'emoji': item.emoji,
+                'description': item.description
+            }
+        
+        return message_data
+    
     def __str__(self):
         return f"{self.user.username}: {self.content[:50]}"
@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class LocalOnlineBackend:
+    """Users ordered by last seen, in this process only.
+
+    Touching a user moves them to the end, so expired users are always at
+    the front and pruning stops at the first live one. Counts and lookups
+    are O(1) apart from that pruning. Good for a single process (the
+    default Daphne setup); use the Redis backend with several workers.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        self._last_seen = OrderedDict()
+
+    def touch(self, user_id, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._last_seen[user_id] = now
+            self._last_seen.move_to_end(user_id)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._last_seen.pop(user_id, None)
+
+    def _prune(self, now):
+        cutoff = now - self.window
+        while self._last_seen:
+            user_id, seen = next(iter(self._last_seen.items()))
+            if seen >= cutoff:
+                break
+            self._last_seen.popitem(last=False)
+
+    def is_online(self, user_id):
+        with self._lock:
+            seen = self._last_seen.get(user_id)
+        return seen is not None and seen >= time.time() - self.window
+
+    def count(self):
+        with self._lock:
+            self._prune(time.time())
+            return len(self._last_seen)
+
+    def online_user_ids(self):
+        with self._lock:
+            self._prune(time.time())
+            return list(self._last_seen)
+
+
+class RedisOnlineBackend:
+    """Sorted set of user ids scored by last seen, shared by every worker"""
+
+    def __init__(self, window, url, key='online_users'):
+        import redis
+        self.window = window
+        self.key = key
+        self.client = redis.Redis.from_url(url)
+
+    def touch(self, user_id, now=None):
+        now = time.time() if now is None else now
+        self.client.zadd(self.key, {user_id: now})
+
+    def remove(self, user_id):
+        self.client.zrem(self.key, user_id)
+
+    def _prune(self, pipe):
+        pipe.zremrangebyscore(self.key, '-inf', f'({time.time() - self.window}')
+
+    def is_online(self, user_id):
+        seen = self.client.zscore(self.key, user_id)
+        return seen is not None and seen >= time.time() - self.window
+
+    def count(self):
+        pipe = self.client.pipeline()
+        self._prune(pipe)
+        pipe.zcard(self.key)
+        return pipe.execute()[-1]
+
+    def online_user_ids(self):
+        pipe = self.client.pipeline()
+        self._prune(pipe)
+        pipe.zrange(self.key, 0, -1)
+        return [int(user_id) for user_id in pipe.execute()[-1]]
+
+
+def get_online_backend():
+    config = settings.PRESENCE_BACKEND
+    backend = import_string(config['BACKEND'])
+    return backend(window=settings.PRESENCE_ONLINE_WINDOW, **config.get('OPTIONS', {}))
+
+
+online_users = get_online_backend()
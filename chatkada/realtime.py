@@ -0,0 +1,102 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from .longpoll import waiters, room_key, user_key
+from .message_buffer import message_buffer
+from .versions import bump_version, room_version_key, match_version_key
+from .coin_progress import coin_progress_changed
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def room_group_name(room_id):
+    """Channel layer group that every connected member of a room joins"""
+    return f"chat_{room_id}"
+
+
+def user_group_name(user_id):
+    """Channel layer group for a user's own event stream"""
+    return f"user_{user_id}"
+
+
+def _group_send(group, event):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(group, event)
+    except Exception as e:
+        # Pushing is best effort, polling clients still get the message
+        logger.error(f'Error pushing to {group}: {str(e)}')
+
+
+def _deliver(room_id, event):
+    _group_send(room_group_name(room_id), event)
+    waiters.notify(room_key(room_id))
+
+
+def publish_chat_message(message):
+    """Push a saved ChatMessage to everyone connected to or long-polling its room"""
+    room_id = message.room.room_id
+    event = {
+        'type': 'chat.message',
+        'room_id': str(room_id),
+        'message': message.to_dict(),
+    }
+
+    def deliver():
+        # Buffer first so woken long-polls read the new message from it
+        if settings.MESSAGE_BUFFER_ENABLED:
+            message_buffer.append(room_id, message)
+        _deliver(room_id, event)
+
+    # Wait for the surrounding transaction so clients never see a rolled back message
+    bump_version(room_version_key(room_id))
+    transaction.on_commit(deliver)
+
+
+def publish_participant_count(room):
+    """Tell connected members that somebody joined or left"""
+    room_id = room.room_id
+    event = {
+        'type': 'chat.participants',
+        'room_id': str(room_id),
+        'participant_count': room.participant_count,
+    }
+    bump_version(room_version_key(room_id))
+    transaction.on_commit(lambda: _group_send(room_group_name(room_id), event))
+
+
+def publish_match(users):
+    """Wake any long-poll waiting on a match for these users"""
+    user_ids = [user.id for user in users]
+    for user_id in user_ids:
+        bump_version(match_version_key(user_id))
+
+    def notify():
+        for user_id in user_ids:
+            waiters.notify(user_key(user_id))
+
+    transaction.on_commit(notify)
+
+
+def publish_user_event(user_id, name, data):
+    """Send a typed event (e.g. 'coins') to one user's event stream"""
+    event = {
+        'type': 'user.event',
+        'event': name,
+        'data': data,
+    }
+    transaction.on_commit(lambda: _group_send(user_group_name(user_id), event))
+
+
+def publish_coin_progress(user_id, data):
+    """Send the new get_coin_progress payload after a coin or challenge change.
+
+    ``data`` must be freshly loaded (load_coin_progress), since it is also
+    written through to the cached snapshot.
+    """
+    coin_progress_changed(user_id, data)
+    publish_user_event(user_id, 'coins', data)
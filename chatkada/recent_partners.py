@@ -0,0 +1,88 @@
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from .models import UserChatHistory
+
+
+class RecentPartners:
+    """Who each queued user was last paired with, so the matcher can skip them.
+
+    Every user gets a tuple of at most ``per_user`` partner ids, newest
+    first, loaded from UserChatHistory once when they join the queue and
+    kept up to date as matches are made. Users themselves are kept in LRU
+    order and the least recently queued are dropped past ``max_users``, so
+    memory stays around ``max_users * per_user`` ints. Checking a pair is a
+    dict lookup and a scan of a short tuple, with no database work.
+    """
+
+    def __init__(self, per_user, max_users, history_days):
+        self.per_user = per_user
+        self.max_users = max_users
+        self.history_days = history_days
+        self._lock = threading.Lock()
+        self._partners = OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.per_user > 0
+
+    def seed(self, user_id):
+        """Load a user's recent partners, unless we already know them"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if user_id in self._partners:
+                self._partners.move_to_end(user_id)
+                return
+
+        since = timezone.now().date() - timedelta(days=self.history_days)
+        rows = UserChatHistory.objects.filter(
+            Q(user_id=user_id) | Q(chatted_with_id=user_id),
+            chat_date__gte=since
+        ).order_by('-chat_date', '-id').values_list('user_id', 'chatted_with_id')[:self.per_user * 2]
+        partners = []
+        for a, b in rows:
+            other = b if a == user_id else a
+            if other not in partners:
+                partners.append(other)
+
+        with self._lock:
+            self._store(user_id, tuple(partners[:self.per_user]))
+
+    def record(self, user_id, partner_id):
+        if not self.enabled:
+            return
+        with self._lock:
+            for a, b in ((user_id, partner_id), (partner_id, user_id)):
+                known = self._partners.get(a)
+                if known is None:
+                    # Not seeded here yet; seed() will load it from history
+                    continue
+                self._store(a, ((b,) + tuple(p for p in known if p != b))[:self.per_user])
+
+    def _store(self, user_id, partners):
+        self._partners[user_id] = partners
+        self._partners.move_to_end(user_id)
+        while len(self._partners) > self.max_users:
+            self._partners.popitem(last=False)
+
+    def get(self, user_id):
+        return self._partners.get(user_id, ())
+
+    def excludes(self, user_id, other_id):
+        """True if the two were paired recently (checked from both sides)"""
+        return other_id in self._partners.get(user_id, ()) or user_id in self._partners.get(other_id, ())
+
+    def clear(self):
+        with self._lock:
+            self._partners.clear()
+
+
+recent_partners = RecentPartners(
+    per_user=settings.STRANGER_RECENT_PARTNERS,
+    max_users=settings.STRANGER_RECENT_PARTNER_USERS,
+    history_days=settings.STRANGER_RECENT_PARTNER_DAYS,
+)
@@ -0,0 +1,214 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, When, Value
+from django.utils import timezone
+from .models import ChatRoom
+from .wait_estimator import wait_estimator
+
+logger = logging.getLogger(__name__)
+
+
+class PoolRoomLost(Exception):
+    """A pooled room was recycled between being handed out and claimed"""
+
+
+class RoomPool:
+    """Idle stranger rooms made ahead of time, so a match only has to claim one.
+
+    A background thread keeps about ``refill_interval`` seconds of rooms at
+    the recent match rate on hand (between ``min_size`` and ``max_size``),
+    created in one bulk INSERT. Claiming rooms for a batch of pairs is a
+    single conditional UPDATE that flips them from ``stranger_pool`` to
+    ``stranger``; the UUID, default fields and index entries were already
+    written off the request path.
+
+    Each process only claims rooms it created itself, so processes never
+    fight over a room. Rooms left idle for ``stale_after`` (a shrinking
+    pool, or a process that went away) are deleted on the next refill.
+    Rooms handed to a transaction that then rolls back go back into the
+    pool on the first refill after ``handout_grace`` seconds.
+    """
+
+    def __init__(self, refill_interval, min_size, max_size, stale_after, handout_grace=10):
+        self.refill_interval = refill_interval
+        self.min_size = min_size
+        self.max_size = max_size
+        self.stale_after = stale_after
+        self.handout_grace = handout_grace
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        # (pk, room_id) of idle rooms this process created, oldest first
+        self._idle = deque()
+        # pk -> (room_id, handed out at) for claims whose transaction hasn't committed
+        self._handed_out = {}
+        self._thread = None
+        self.claimed = 0
+        self.missed = 0
+        self.created = 0
+        self.recycled = 0
+        self.returned = 0
+
+    def start(self):
+        if self._thread is not None or self.refill_interval is None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='stranger-room-pool', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refill()
+            except Exception as e:
+                logger.error(f'Error refilling stranger room pool: {str(e)}')
+            finally:
+                connection.close_if_unusable_or_obsolete()
+            self._wake.wait(self.refill_interval)
+            self._wake.clear()
+
+    def target_size(self, now=None):
+        """Rooms needed to cover the next two refill intervals at the current rate"""
+        rooms_per_second = wait_estimator.matches.value(time.time() if now is None else now) / 2
+        wanted = math.ceil(rooms_per_second * (self.refill_interval or 1) * 2)
+        return max(self.min_size, min(self.max_size, wanted))
+
+    def refill(self):
+        """Drop stale rooms, then top the pool up to its target size"""
+        stale = ChatRoom.objects.filter(
+            room_type='stranger_pool',
+            created_at__lt=timezone.now() - timedelta(seconds=self.stale_after)
+        ).values_list('pk', flat=True)
+        stale_ids = set(stale)
+        if stale_ids:
+            ChatRoom.objects.filter(pk__in=stale_ids, room_type='stranger_pool').delete()
+            with self._lock:
+                self._idle = deque(room for room in self._idle if room[0] not in stale_ids)
+                for pk in stale_ids:
+                    self._handed_out.pop(pk, None)
+                self.recycled += len(stale_ids)
+        self.return_rolled_back()
+
+        with self._lock:
+            missing = self.target_size() - len(self._idle)
+        if missing <= 0:
+            return 0
+        rooms = ChatRoom.objects.bulk_create([
+            ChatRoom(name='Stranger Chat', room_type='stranger_pool', is_active=False)
+            for _ in range(missing)
+        ])
+        with self._lock:
+            self._idle.extend((room.pk, room.room_id) for room in rooms)
+            self.created += len(rooms)
+        return len(rooms)
+
+    def return_rolled_back(self, now=None):
+        """Put rooms whose claiming transaction rolled back into the pool again.
+
+        A claim that commits settles its rooms through on_commit; one still
+        unsettled after ``handout_grace`` seconds whose row is still
+        ``stranger_pool`` was rolled back. Returns how many came back.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            overdue = [
+                pk for pk, (_, handed_at) in self._handed_out.items()
+                if now - handed_at >= self.handout_grace
+            ]
+        if not overdue:
+            return 0
+        idle = set(ChatRoom.objects.filter(pk__in=overdue, room_type='stranger_pool').values_list('pk', flat=True))
+        with self._lock:
+            rooms = [(pk, self._handed_out.pop(pk)[0]) for pk in overdue if pk in self._handed_out]
+            back = [room for room in rooms if room[0] in idle]
+            # Oldest rooms go first again
+            self._idle.extendleft(reversed(back))
+            self.returned += len(back)
+        return len(back)
+
+    def _settle(self, ids):
+        with self._lock:
+            for pk in ids:
+                self._handed_out.pop(pk, None)
+            self.claimed += len(ids)
+
+    def claim(self, pairs, now):
+        """Turn idle rooms into live rooms for as many pairs as possible.
+
+        Returns the claimed rooms, in pair order; pairs past the end of the
+        list still need a room of their own. Runs in the caller's transaction;
+        the rooms count as used once it commits, and come back into the pool
+        (see return_rolled_back) if it doesn't.
+        """
+        handed_at = time.monotonic()
+        with self._lock:
+            taken = [self._idle.popleft() for _ in range(min(len(pairs), len(self._idle)))]
+            self.missed += len(pairs) - len(taken)
+            for pk, room_id in taken:
+                self._handed_out[pk] = (room_id, handed_at)
+        if len(taken) < len(pairs):
+            self._wake.set()
+        if not taken:
+            return []
+
+        ids = [pk for pk, _ in taken]
+        if len(ids) == 1:
+            created_by = pairs[0][0].pk
+        else:
+            created_by = Case(*[When(pk=pk, then=Value(user.pk)) for pk, (user, _) in zip(ids, pairs)])
+        name = f"Stranger Chat {now.strftime('%H:%M')}"
+        expires_at = now + timedelta(hours=1)
+        claimed = ChatRoom.objects.filter(pk__in=ids, room_type='stranger_pool').update(
+            room_type='stranger',
+            is_active=True,
+            name=name,
+            created_at=now,
+            expires_at=expires_at,
+            participant_count=2,
+            created_by_id=created_by,
+        )
+        if claimed != len(ids):
+            raise PoolRoomLost(f'claimed {claimed} of {len(ids)} pooled rooms')
+        transaction.on_commit(lambda: self._settle(ids))
+
+        return [
+            ChatRoom(
+                pk=pk,
+                room_id=room_id,
+                name=name,
+                room_type='stranger',
+                created_at=now,
+                expires_at=expires_at,
+                created_by=user,
+                participant_count=2,
+            )
+            for (pk, room_id), (user, _) in zip(taken, pairs)
+        ]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'idle': len(self._idle),
+                'handed_out': len(self._handed_out),
+                'target': self.target_size(),
+                'claimed': self.claimed,
+                'missed': self.missed,
+                'created': self.created,
+                'recycled': self.recycled,
+                'returned': self.returned,
+            }
+
+
+room_pool = RoomPool(
+    refill_interval=settings.STRANGER_ROOM_POOL_REFILL_SECONDS,
+    min_size=settings.STRANGER_ROOM_POOL_MIN,
+    max_size=settings.STRANGER_ROOM_POOL_MAX,
+    stale_after=settings.STRANGER_ROOM_POOL_STALE_SECONDS,
+)
@@ -0,0 +1,15 @@
+from channels.auth import AuthMiddlewareStack
+from django.urls import path
+from . import consumers
+
+websocket_urlpatterns = [
+    path('ws/chat/<uuid:room_id>/', consumers.ChatRoomConsumer.as_asgi()),
+]
+
+# Served by the ASGI app ahead of Django's own URLconf. Only these need
+# channels' session auth; Django authenticates everything else itself.
+http_urlpatterns = [
+    path('longpoll/chat-messages/<uuid:room_id>/', AuthMiddlewareStack(consumers.ChatMessagesLongPollConsumer.as_asgi())),
+    path('longpoll/match-status/', AuthMiddlewareStack(consumers.MatchStatusLongPollConsumer.as_asgi())),
+    path('events/', AuthMiddlewareStack(consumers.UserEventStream.as_asgi())),
+]
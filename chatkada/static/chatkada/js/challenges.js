@@ -1,54 +1,76 @@
 // Challenge tracking and coin progress system
 class ChallengeTracker {
     constructor() {
+        this.progressInterval = null;
         this.init();
     }
     
     init() {
-        this.updateCoinProgress();
         this.checkDailyLogin();
         
+        if (window.kadaEvents && window.kadaEvents.supported) {
+            // The event stream sends progress on connect and after every coin change
+            document.addEventListener('kada:coins', (e) => this.renderCoinProgress(e.detail));
+            document.addEventListener('kada:open', () => this.stopProgressPolling());
+            document.addEventListener('kada:error', () => this.startProgressPolling());
+        } else {
+            this.updateCoinProgress();
+            this.startProgressPolling();
+        }
+    }
+    
+    startProgressPolling() {
+        if (this.progressInterval) return;
         // Update progress every 30 seconds
-        setInterval(() => {
+        this.progressInterval = setInterval(() => {
             this.updateCoinProgress();
         }, 30000);
     }
     
+    stopProgressPolling() {
+        if (this.progressInterval) {
+            clearInterval(this.progressInterval);
+            this.progressInterval = null;
+        }
+    }
+    
     updateCoinProgress() {
         fetch('/get-coin-progress/')
             .then(response => response.json())
-            .then(data => {
-                // Update coin amount
-                document.getElementById('coin-amount').textContent = data.total_coins;
-                
-                // Update daily login indicator
-                const loginIndicator = document.getElementById('login-indicator');
-                if (data.daily_login_completed) {
-                    loginIndicator.classList.add('completed');
-                    loginIndicator.innerHTML = '<i class="fas fa-check-circle"></i>';
-                } else {
-                    loginIndicator.classList.remove('completed');
-                    loginIndicator.innerHTML = '<i class="fas fa-calendar-check"></i>';
-                }
-                
-                // Update friends challenge progress
-                const friendsIndicator = document.getElementById('friends-indicator');
-                const friendsCount = document.getElementById('friends-count');
-                
-                friendsCount.textContent = data.friends_progress;
-                
-                if (data.friends_challenge_completed) {
-                    friendsIndicator.classList.add('completed');
-                    friendsIndicator.innerHTML = '<i class="fas fa-check-circle"></i> 5/5';
-                } else {
-                    friendsIndicator.classList.remove('completed');
-                    const percentage = (data.friends_progress / 5) * 100;
-                    friendsIndicator.style.background = `linear-gradient(90deg, #4CAF50 ${percentage}%, transparent ${percentage}%)`;
-                }
-            })
+            .then(data => this.renderCoinProgress(data))
             .catch(error => console.error('Error updating coin progress:', error));
     }
     
+    renderCoinProgress(data) {
+        // Update coin amount
+        document.getElementById('coin-amount').textContent = data.total_coins;
+        
+        // Update daily login indicator
+        const loginIndicator = document.getElementById('login-indicator');
+        if (data.daily_login_completed) {
+            loginIndicator.classList.add('completed');
+            loginIndicator.innerHTML = '<i class="fas fa-check-circle"></i>';
+        } else {
+            loginIndicator.classList.remove('completed');
+            loginIndicator.innerHTML = '<i class="fas fa-calendar-check"></i>';
+        }
+        
+        // Update friends challenge progress
+        const friendsIndicator = document.getElementById('friends-indicator');
+        const friendsCount = document.getElementById('friends-count');
+        
+        friendsCount.textContent = data.friends_progress;
+        
+        if (data.friends_challenge_completed) {
+            friendsIndicator.classList.add('completed');
+            friendsIndicator.innerHTML = '<i class="fas fa-check-circle"></i> 5/5';
+        } else {
+            friendsIndicator.classList.remove('completed');
+            const percentage = (data.friends_progress / 5) * 100;
+            friendsIndicator.style.background = `linear-gradient(90deg, #4CAF50 ${percentage}%, transparent ${percentage}%)`;
+        }
+    }
+    
     checkDailyLogin() {
         // Check daily login on page load
         fetch('/check-daily-login/', {
@@ -0,0 +1,39 @@
+// One Server-Sent Events stream per page, shared by everything that used to poll.
+// Each SSE event is re-dispatched on document as `kada:<name>` with the JSON
+// payload in event.detail (message, participants, coins, online), plus
+// `kada:open` / `kada:error` for connection state.
+class KadaEvents {
+    constructor() {
+        this.source = null;
+        this.connected = false;
+        
+        if (!('EventSource' in window)) return;
+        
+        this.source = new EventSource('/events/');
+        
+        this.source.onopen = () => {
+            this.connected = true;
+            document.dispatchEvent(new CustomEvent('kada:open'));
+        };
+        
+        // EventSource reconnects by itself and sends Last-Event-ID
+        this.source.onerror = () => {
+            this.connected = false;
+            document.dispatchEvent(new CustomEvent('kada:error'));
+        };
+        
+        ['message', 'participants', 'coins', 'online'].forEach(name => {
+            this.source.addEventListener(name, (e) => {
+                document.dispatchEvent(new CustomEvent(`kada:${name}`, {
+                    detail: JSON.parse(e.data)
+                }));
+            });
+        });
+    }
+    
+    get supported() {
+        return this.source !== null;
+    }
+}
+
+window.kadaEvents = new KadaEvents();
@@ -1,8 +1,16 @@
 from celery import shared_task
 from django.utils import timezone
 from django.conf import settings
-from .models import ChatMessage
-from datetime import timedelta
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import F
+from .models import (
+    ChatMessage, ChallengeJob, DailyChallenge, UserProfile, CoinTransaction, CoinDailyTotal, StrangerChatQueue
+)
+from .coins import update_returning_all
+from .coin_progress import coin_progress_changed_many
+from .leaderboard import record_earnings
+from datetime import date, timedelta
 import logging
 
 logger = logging.getLogger(__name__)
@@ -54,3 +62,131 @@ def cleanup_expired_messages():
     except Exception as e:
         logger.error(f'Error during expired message cleanup: {str(e)}')
         return f'Error: {str(e)}'
+
+@shared_task
+def cleanup_inactive_users():
+    """
+    Mark users idle for 5 minutes offline and delete stale stranger queue entries
+    """
+    now = timezone.now()
+    inactive_count = UserProfile.objects.filter(
+        last_activity__lt=now - timedelta(minutes=5),
+        is_online=True
+    ).update(is_online=False, looking_for_stranger_chat=False)
+    
+    # Matching already ignores them; this only keeps the queue table small
+    expired_count, _ = StrangerChatQueue.objects.filter(joined_at__lt=now - StrangerChatQueue.TTL).delete()
+    
+    logger.info(f'Cleaned up {inactive_count} inactive users and {expired_count} expired queue entries')
+    return f'Cleaned up {inactive_count} inactive users and {expired_count} expired queue entries'
+
+def update_challenge_job(job_id, **changes):
+    # Outside the chunk transactions, so the admin sees progress as it's made
+    ChallengeJob.objects.filter(job_id=job_id).update(**changes)
+
+@shared_task
+def assign_daily_challenge(job_id, challenge_type, coins_earned, day):
+    """
+    Give every user a completed challenge for ``day`` and credit its coins.
+
+    Users are handled in chunks of CHALLENGE_ASSIGN_CHUNK_SIZE, one short
+    transaction each: a set-based INSERT of the challenges (users who
+    already have it are skipped by the unique constraint), then one UPDATE
+    of the balances and bulk inserts of the CoinTransactions and rollups.
+    Progress is written to the job's ChallengeJob row after every chunk.
+    """
+    day = date.fromisoformat(day)
+    chunk_size = settings.CHALLENGE_ASSIGN_CHUNK_SIZE
+    processed = assigned = 0
+    last_id = 0
+    ChallengeJob.objects.update_or_create(job_id=job_id, defaults={
+        'challenge_type': challenge_type,
+        'coins_earned': coins_earned,
+        'day': day,
+        'status': 'running',
+        'total': User.objects.count(),
+        'processed': 0,
+        'assigned': 0,
+    })
+    
+    try:
+        while True:
+            user_ids = list(
+                User.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:chunk_size]
+            )
+            if not user_ids:
+                break
+            with transaction.atomic():
+                awarded = claim_challenges(user_ids, challenge_type, day, coins_earned)
+                credit_challenges(awarded, challenge_type, coins_earned)
+            last_id = user_ids[-1]
+            processed += len(user_ids)
+            assigned += len(awarded)
+            update_challenge_job(job_id, processed=processed, assigned=assigned)
+    except Exception as e:
+        logger.error(f'Error assigning {challenge_type} challenges: {str(e)}')
+        update_challenge_job(job_id, status='failed', error=str(e))
+        return f'Error: {str(e)}'
+    
+    update_challenge_job(job_id, status='done', finished_at=timezone.now())
+    logger.info(f'Assigned {challenge_type} to {assigned} users')
+    return f'Assigned {challenge_type} to {assigned} users'
+
+def claim_challenges(user_ids, challenge_type, day, coins_earned):
+    """Insert the challenge for every user in the chunk that lacks it; returns who got it"""
+    # RETURNING needs SQLite 3.35+, the same gate as coins.update_returning
+    if connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert:
+        # INSERT ... SELECT straight from the user table; RETURNING says
+        # exactly which rows were new, even if a user claimed it meanwhile
+        quote = connection.ops.quote_name
+        challenges = DailyChallenge._meta
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {quote(challenges.db_table)} "
+                f"({quote('user_id')}, {quote('challenge_type')}, {quote('completed_date')}, {quote('coins_earned')}) "
+                f"SELECT {quote('id')}, %s, %s, %s FROM {quote(User._meta.db_table)} "
+                f"WHERE {quote('id')} >= %s AND {quote('id')} <= %s "
+                f"ON CONFLICT DO NOTHING RETURNING {quote('user_id')}",
+                [challenge_type, day, coins_earned, user_ids[0], user_ids[-1]]
+            )
+            return [row[0] for row in cursor.fetchall()]
+    
+    # Elsewhere, check then insert; a user claiming the same challenge in
+    # between would be credited twice
+    existing = set(DailyChallenge.objects.filter(
+        user_id__in=user_ids,
+        challenge_type=challenge_type,
+        completed_date=day
+    ).values_list('user_id', flat=True))
+    awarded = [user_id for user_id in user_ids if user_id not in existing]
+    DailyChallenge.objects.bulk_create([
+        DailyChallenge(user_id=user_id, challenge_type=challenge_type, completed_date=day, coins_earned=coins_earned)
+        for user_id in awarded
+    ], ignore_conflicts=True)
+    return awarded
+
+def credit_challenges(user_ids, challenge_type, coins_earned):
+    """Credit the same reward to many users with one UPDATE and bulk ledger rows"""
+    if not user_ids:
+        return
+    # Ledger rows only for the profiles the UPDATE actually wrote
+    user_ids = update_returning_all(
+        UserProfile.objects.filter(user_id__in=user_ids),
+        'user_id',
+        coins=F('coins') + coins_earned,
+        total_coins_earned=F('total_coins_earned') + coins_earned
+    )
+    label = dict(DailyChallenge.CHALLENGE_TYPES)[challenge_type]
+    coin_transactions = CoinTransaction.objects.bulk_create([
+        CoinTransaction(
+            user_id=user_id,
+            amount=coins_earned,
+            transaction_type=challenge_type,
+            description=f'Challenge assigned: {label}'
+        )
+        for user_id in user_ids
+    ])
+    # bulk_create skips the post_save rollup receiver
+    CoinDailyTotal.record(coin_transactions)
+    coin_progress_changed_many(user_ids)
+    record_earnings(coin_transactions)
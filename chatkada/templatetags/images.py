@@ -0,0 +1,68 @@
+import json
+from functools import lru_cache
+from django import template
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.templatetags.static import static
+from django.utils.html import format_html, format_html_join
+
+register = template.Library()
+
+
+@lru_cache(maxsize=None)
+def load_manifest():
+    """What build_image_derivatives wrote, or {} if it hasn't been run"""
+    path = finders.find(f'{settings.IMAGE_DERIVATIVES_DIR}/manifest.json')
+    if path is None:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def variants(path):
+    """The manifest's copies of a static image, or None to serve the original"""
+    entry = load_manifest().get(path)
+    if not entry:
+        return None
+    try:
+        return [
+            dict(variant, webp_url=static(variant['webp']), png_url=static(variant['png']))
+            for variant in entry['variants']
+        ]
+    except ValueError:
+        # Copies made after the last collectstatic aren't in its manifest yet
+        return None
+
+
+@register.simple_tag
+def responsive_image(path, alt='', sizes=None, **attrs):
+    """<picture> with WebP and PNG srcsets for an image in IMAGE_DERIVATIVES.
+
+    ``sizes`` defaults to the ``width`` attribute in pixels. Other keyword
+    arguments become attributes of the <img>. Falls back to a plain <img>
+    of the original when there are no copies.
+    """
+    attributes = format_html_join('', ' {}="{}"', attrs.items())
+    found = variants(path)
+    if not found:
+        return format_html('<img src="{}" alt="{}"{}>', static(path), alt, attributes)
+
+    if sizes is None:
+        sizes = f"{attrs['width']}px" if 'width' in attrs else '100vw'
+    webp = ', '.join(f"{variant['webp_url']} {variant['width']}w" for variant in found)
+    png = ', '.join(f"{variant['png_url']} {variant['width']}w" for variant in found)
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" alt="{}"{}></picture>',
+        webp, sizes, found[0]['png_url'], png, sizes, alt, attributes
+    )
+
+
+@register.simple_tag
+def image_variant(path, width, extension='png'):
+    """URL of the smallest copy at least ``width`` wide, else the original's"""
+    found = variants(path)
+    for variant in found or ():
+        if variant['width'] >= width:
+            return variant[f'{extension}_url']
+    return static(path)
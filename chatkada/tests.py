@@ -1,3 +1,1473 @@
-from django.test import TestCase
+from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.testing import ApplicationCommunicator, HttpCommunicator, WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, OperationalError
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.contrib.staticfiles import finders
+from django.core.management import call_command
+from django.template import Context, Template
+from io import StringIO
+from django.urls import reverse
+import json
+from importlib.util import find_spec
+from unittest import mock, skipUnless
+from PIL import Image
 
-# Create your tests here.
+from .message_buffer import MessageBuffer, message_buffer
+from .presence import PresenceRecorder, presence
+from .online import LocalOnlineBackend, online_users
+from .wait_estimator import WaitTimeEstimator
+from .recent_partners import RecentPartners, recent_partners
+from .room_pool import RoomPool
+from . import coins, leaderboard
+from .catalog import catalog
+from .tasks import assign_daily_challenge, cleanup_inactive_users
+from . import matchmaking
+from .models import (
+    ChatRoom, ChatMessage, UserProfile, StrangerChatQueue, UserChatHistory, Item, Purchase, CoinTransaction,
+    CoinDailyTotal, DailyChallenge, Inventory, ChallengeJob
+)
+from .views import get_recent_messages, get_messages_payload
+from .write_behind import ChatMessageWriter, create_chat_message
+from .routing import http_urlpatterns, websocket_urlpatterns
+import asyncio
+import os
+import random
+import shutil
+import threading
+import time
+from datetime import date, timedelta
+from django.utils import timezone
+
+
+class ChatRoomConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='chaya', password='test-pass-123')
+        self.outsider = User.objects.create_user(username='outsider', password='test-pass-123')
+        self.room = ChatRoom.objects.create(
+            name='Test Bench',
+            room_type='private_bench',
+            created_by=self.user
+        )
+        self.room.participants.add(self.user)
+
+    def communicator_for(self, user):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns),
+            f'/ws/chat/{self.room.room_id}/'
+        )
+        communicator.scope['user'] = user
+        return communicator
+
+    async def test_non_participant_is_rejected(self):
+        communicator = self.communicator_for(self.outsider)
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_sent_message_is_pushed_to_room(self):
+        communicator = self.communicator_for(self.user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        def send():
+            client = Client()
+            client.force_login(self.user)
+            return client.post(
+                '/send-chat-message/',
+                json.dumps({'room_id': str(self.room.room_id), 'content': 'namaskaram'}),
+                content_type='application/json'
+            ).json()
+
+        response = await sync_to_async(send)()
+        self.assertTrue(response['success'])
+
+        event = await communicator.receive_json_from()
+        self.assertEqual(event['type'], 'message')
+        self.assertEqual(event['message']['id'], response['message']['id'])
+        self.assertEqual(event['message']['content'], 'namaskaram')
+        await communicator.disconnect()
+
+
+class GetChatMessagesCursorTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='chaya', password='test-pass-123')
+        self.room = ChatRoom.objects.create(
+            name='Test Bench',
+            room_type='private_bench',
+            created_by=self.user
+        )
+        self.room.participants.add(self.user)
+        self.message_ids = [
+            ChatMessage.objects.create(user=self.user, room=self.room, content=f'msg {i}').id
+            for i in range(5)
+        ]
+        self.client.force_login(self.user)
+        self.url = reverse('get_chat_messages', kwargs={'room_id': self.room.room_id})
+
+    def test_since_returns_only_newer_messages(self):
+        data = self.client.get(self.url, {'since': self.message_ids[2]}).json()
+        self.assertEqual([m['id'] for m in data['messages']], self.message_ids[3:])
+
+    def test_empty_delta_is_minimal(self):
+        data = self.client.get(self.url, {'since': self.message_ids[-1]}).json()
+        self.assertEqual(data, {'success': True, 'messages': []})
+
+    def test_before_returns_older_messages_oldest_first(self):
+        data = self.client.get(self.url, {'before': self.message_ids[3]}).json()
+        self.assertEqual([m['id'] for m in data['messages']], self.message_ids[:3])
+        self.assertFalse(data['has_more'])
+
+
+class ConditionalPollTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='chaya', password='test-pass-123')
+        self.room = ChatRoom.objects.create(
+            name='Test Bench',
+            room_type='private_bench',
+            created_by=self.user
+        )
+        self.room.participants.add(self.user)
+        self.client.force_login(self.user)
+        self.url = reverse('get_chat_messages', kwargs={'room_id': self.room.room_id})
+
+    def test_unchanged_room_is_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # Only the session and user lookups, nothing about the room
+        self.assertFalse(any('chatkada_chatmessage' in q['sql'] for q in ctx.captured_queries))
+
+    def test_error_responses_have_no_etag(self):
+        response = self.client.get(self.url, {'since': 'soon'})
+        self.assertEqual(response.json()['error'], 'Invalid cursor')
+        self.assertFalse(response.has_header('ETag'))
+
+        outsider = User.objects.create(username='outsider')
+        self.client.force_login(outsider)
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()['error'], 'Access denied')
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_new_message_changes_the_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                '/send-chat-message/',
+                json.dumps({'room_id': str(self.room.room_id), 'content': 'hello'}),
+                content_type='application/json'
+            )
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['messages'][-1]['content'], 'hello')
+
+    def test_coin_progress_is_not_modified_until_coins_change(self):
+        url = reverse('get_coin_progress')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('check_daily_login'))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class EstimateChatDeliveryTests(TestCase):
+    def test_estimate_runs_and_leaves_nothing_behind(self):
+        out = StringIO()
+        call_command('estimate_chat_delivery', users=10, poll_interval=2, reconnect_interval=3600, stdout=out)
+        lines = dict(line.split(': ', 1) for line in out.getvalue().splitlines() if ': ' in line)
+        self.assertGreater(int(lines['Queries per poll of get_chat_messages']), 0)
+        self.assertGreater(int(lines['Queries per WebSocket connect']), 0)
+        self.assertIn('Push should save about', out.getvalue())
+        self.assertFalse(User.objects.filter(username='__bench_delivery__').exists())
+
+
+class ParticipantCountTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(username=f'user{i}', password='test-pass-123')
+            for i in range(3)
+        ]
+        self.room = ChatRoom.objects.create(
+            name='Test Bench',
+            room_type='stranger',
+            created_by=self.users[0],
+            max_users=2
+        )
+
+    def test_join_stops_at_max_users(self):
+        self.assertTrue(self.room.add_participant(self.users[0]))
+        self.assertTrue(self.room.add_participant(self.users[0]))
+        self.assertTrue(self.room.add_participant(self.users[1]))
+        self.assertFalse(self.room.add_participant(self.users[2]))
+        self.assertEqual(self.room.participant_count, 2)
+        self.assertTrue(self.room.is_full)
+
+    def test_leave_and_plain_m2m_changes_keep_the_count(self):
+        self.room.add_participant(self.users[0])
+        self.assertTrue(self.room.remove_participant(self.users[0]))
+        self.assertFalse(self.room.remove_participant(self.users[0]))
+        self.assertEqual(self.room.participant_count, 0)
+
+        self.room.participants.add(self.users[1], self.users[2])
+        self.assertEqual(self.room.participant_count, 2)
+        self.users[1].chat_rooms.clear()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.participant_count, 1)
+
+    def test_find_chat_joins_an_open_room(self):
+        self.room.add_participant(self.users[0])
+        self.client.force_login(self.users[1])
+        response = self.client.post(reverse('find_chat'), {'chat_type': 'stranger'})
+        self.assertRedirects(
+            response,
+            reverse('chat_room', kwargs={'room_id': self.room.room_id}),
+            fetch_redirect_response=False
+        )
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.participant_count, 2)
+
+
+class PresenceRecorderTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(username=f'user{i}', password='test-pass-123')
+            for i in range(2)
+        ]
+        self.recorder = PresenceRecorder(throttle=60, flush_interval=3600)
+
+    def test_repeat_requests_are_coalesced_into_one_update(self):
+        for _ in range(5):
+            for user in self.users:
+                self.recorder.touch(user.id)
+        self.assertFalse(UserProfile.objects.filter(is_online=True).exists())
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.recorder.flush(), 2)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(UserProfile.objects.filter(is_online=True).count(), 2)
+
+        stats = self.recorder.stats()
+        self.assertEqual(stats['throttled'], 8)
+        # Ten touches, one UPDATE of two rows
+        self.assertEqual((stats['writes'], stats['rows_written']), (1, 2))
+        self.assertEqual(stats['writes_avoided'], 9)
+
+    def test_profiles_created_at_flush_count_as_writes(self):
+        UserProfile.objects.filter(user=self.users[1]).delete()
+        for user in self.users:
+            self.recorder.touch(user.id)
+        self.recorder.flush()
+        stats = self.recorder.stats()
+        self.assertEqual((stats['writes'], stats['rows_written']), (2, 2))
+        self.assertEqual(stats['writes_avoided'], 0)
+
+    def test_exempt_view_is_not_recorded(self):
+        self.client.force_login(self.users[0])
+        with mock.patch('chatkada.middleware.presence', self.recorder):
+            self.client.get(reverse('get_online_status'))
+            self.assertEqual(self.recorder.stats()['touches'], 0)
+            self.client.get(reverse('get_coin_progress'))
+            self.assertEqual(self.recorder.stats()['touches'], 1)
+
+
+class LocalOnlineBackendTests(TestCase):
+    def test_counts_expire_after_the_window(self):
+        backend = LocalOnlineBackend(window=300)
+        now = time.time()
+        backend.touch(1, now=now - 400)
+        backend.touch(2, now=now - 100)
+        backend.touch(3, now=now)
+
+        self.assertEqual(backend.count(), 2)
+        self.assertFalse(backend.is_online(1))
+        self.assertTrue(backend.is_online(2))
+        self.assertEqual(sorted(backend.online_user_ids()), [2, 3])
+
+        # Coming back moves a user to the live end
+        backend.touch(2)
+        backend.remove(3)
+        self.assertEqual(backend.online_user_ids(), [2])
+
+    def test_online_status_reads_the_registry(self):
+        user = User.objects.create_user(username='chaya', password='test-pass-123')
+        backend = LocalOnlineBackend(window=300)
+        backend.touch(user.id)
+        backend.touch(user.id + 1000)
+        self.client.force_login(user)
+        with mock.patch('chatkada.views.online_users', backend):
+            data = self.client.get(reverse('get_online_status')).json()
+        self.assertEqual(data['online_users'], 1)
+        with mock.patch('chatkada.models.online_users', backend):
+            self.assertTrue(user.userprofile.is_currently_online())
+
+
+class LongPollTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='chaya', password='test-pass-123')
+        self.room = ChatRoom.objects.create(
+            name='Test Bench',
+            room_type='private_bench',
+            created_by=self.user
+        )
+        self.room.participants.add(self.user)
+        self.last_id = ChatMessage.objects.create(user=self.user, room=self.room, content='first').id
+
+    def communicator_for(self, path):
+        communicator = HttpCommunicator(URLRouter(http_urlpatterns), 'GET', path)
+        communicator.scope['user'] = self.user
+        return communicator
+
+    async def test_parked_request_returns_when_message_lands(self):
+        communicator = self.communicator_for(
+            f'/longpoll/chat-messages/{self.room.room_id}/?since={self.last_id}&timeout=10'
+        )
+        started = time.monotonic()
+        response_task = asyncio.ensure_future(communicator.get_response(timeout=15))
+        await asyncio.sleep(0.2)
+        self.assertFalse(response_task.done())
+
+        def send():
+            client = Client()
+            client.force_login(self.user)
+            client.post(
+                '/send-chat-message/',
+                json.dumps({'room_id': str(self.room.room_id), 'content': 'vannu'}),
+                content_type='application/json'
+            )
+
+        await sync_to_async(send)()
+        response = await response_task
+        data = json.loads(response['body'])
+        self.assertEqual([m['content'] for m in data['messages']], ['vannu'])
+        self.assertLess(time.monotonic() - started, 5)
+
+    async def test_times_out_with_empty_delta(self):
+        communicator = self.communicator_for(
+            f'/longpoll/chat-messages/{self.room.room_id}/?since={self.last_id}&timeout=0'
+        )
+        response = await communicator.get_response()
+        self.assertEqual(json.loads(response['body']), {'success': True, 'messages': []})
+
+    async def test_session_cookie_authenticates_the_request(self):
+        client = Client()
+        await sync_to_async(client.force_login)(self.user)
+        communicator = HttpCommunicator(
+            URLRouter(http_urlpatterns),
+            'GET',
+            f'/longpoll/chat-messages/{self.room.room_id}/?since={self.last_id}&timeout=0',
+            headers=[(b'cookie', f'sessionid={client.cookies["sessionid"].value}'.encode())]
+        )
+        response = await communicator.get_response()
+        self.assertEqual(response['status'], 200)
+        self.assertEqual(json.loads(response['body']), {'success': True, 'messages': []})
+
+
+class UserEventStreamTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='chaya', password='test-pass-123')
+        self.room = ChatRoom.objects.create(
+            name='Test Bench',
+            room_type='private_bench',
+            created_by=self.user
+        )
+        self.room.participants.add(self.user)
+        self.message_ids = [
+            ChatMessage.objects.create(user=self.user, room=self.room, content=f'msg {i}').id
+            for i in range(3)
+        ]
+
+    def open_stream(self, last_event_id):
+        communicator = ApplicationCommunicator(URLRouter(http_urlpatterns), {
+            'type': 'http',
+            'method': 'GET',
+            'path': '/events/',
+            'query_string': b'',
+            'headers': [(b'last-event-id', str(last_event_id).encode())],
+            'user': self.user,
+        })
+        return communicator
+
+    async def read_until(self, communicator, marker):
+        text = ''
+        while marker not in text:
+            chunk = await communicator.receive_output(timeout=5)
+            text += chunk.get('body', b'').decode()
+        return text
+
+    async def test_resume_replays_only_missed_messages_then_streams(self):
+        presence.forget(self.user.id)
+        communicator = self.open_stream(self.message_ids[0])
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        start = await communicator.receive_output(timeout=5)
+        self.assertEqual(start['status'], 200)
+
+        text = await self.read_until(communicator, 'event: online')
+        self.assertNotIn(f'id: {self.message_ids[0]}\n', text)
+        self.assertIn(f'id: {self.message_ids[1]}\n', text)
+        self.assertIn(f'id: {self.message_ids[2]}\n', text)
+        self.assertIn('event: coins', text)
+        # Events sent count as activity, not just heartbeats
+        self.assertTrue(online_users.is_online(self.user.id))
+
+        def send():
+            client = Client()
+            client.force_login(self.user)
+            return client.post(
+                '/send-chat-message/',
+                json.dumps({'room_id': str(self.room.room_id), 'content': 'live'}),
+                content_type='application/json'
+            ).json()
+
+        response = await sync_to_async(send)()
+        text = await self.read_until(communicator, '"live"')
+        self.assertIn(f'id: {response["message"]["id"]}\nevent: message', text)
+
+        await communicator.send_input({'type': 'http.disconnect'})
+        await communicator.wait(timeout=5)
+
+
+class MessageBufferTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='chaya', password='test-pass-123')
+        self.room = ChatRoom.objects.create(
+            name='Test Bench',
+            room_type='private_bench',
+            created_by=self.user
+        )
+        self.room.participants.add(self.user)
+
+    def make_message(self, content, room=None):
+        return ChatMessage.objects.create(user=self.user, room=room or self.room, content=content)
+
+    def test_warm_reads_skip_the_database(self):
+        first = self.make_message('one')
+        get_recent_messages(self.room)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client_post_message('two')
+
+        with self.assertNumQueries(0):
+            messages = get_recent_messages(self.room, since=first.id)
+        self.assertEqual([m['id'] for m in messages], [response['message']['id']])
+
+    def client_post_message(self, content):
+        self.client.force_login(self.user)
+        return self.client.post(
+            '/send-chat-message/',
+            json.dumps({'room_id': str(self.room.room_id), 'content': content}),
+            content_type='application/json'
+        ).json()
+
+    def test_writes_during_fill_are_kept(self):
+        buffer = MessageBuffer(room_capacity=10, max_bytes=1 << 20, ttl=timedelta(hours=1))
+        first = self.make_message('one')
+        late = self.make_message('two')
+
+        def loader():
+            # A write commits while the cold-start query is running
+            buffer.append(self.room.room_id, late)
+            return [first]
+
+        messages = buffer.get_or_fill(self.room.room_id, 0, loader)
+        self.assertEqual([m['id'] for m in messages], [first.id, late.id])
+        self.assertEqual(buffer.stats()['misses'], 1)
+
+    def test_cursor_older_than_buffer_is_a_miss(self):
+        buffer = MessageBuffer(room_capacity=2, max_bytes=1 << 20, ttl=timedelta(hours=1))
+        messages = [self.make_message(f'msg {i}') for i in range(3)]
+        buffer.get_or_fill(self.room.room_id, 0, lambda: messages[1:])
+        self.assertIsNone(buffer.get_since(self.room.room_id, messages[0].id))
+        self.assertEqual(len(buffer.get_since(self.room.room_id, messages[1].id)), 1)
+
+    def test_least_recently_used_room_is_evicted(self):
+        other_room = ChatRoom.objects.create(name='Other', room_type='private_bench', created_by=self.user)
+        message = self.make_message('x' * 500)
+        other_message = self.make_message('y' * 500, room=other_room)
+        buffer = MessageBuffer(room_capacity=10, max_bytes=800, ttl=timedelta(hours=1))
+
+        buffer.get_or_fill(self.room.room_id, 0, lambda: [message])
+        buffer.get_or_fill(other_room.room_id, 0, lambda: [other_message])
+
+        self.assertIsNone(buffer.get_since(self.room.room_id))
+        self.assertIsNotNone(buffer.get_since(other_room.room_id))
+        self.assertEqual(buffer.stats()['evictions'], 1)
+
+
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='chaya', password='test-pass-123')
+        self.room = ChatRoom.objects.create(
+            name='Test Bench',
+            room_type='stranger',
+            created_by=self.user
+        )
+        self.writer = ChatMessageWriter(batch_size=10, max_delay=0, start_thread=False)
+
+    def test_message_has_id_before_it_is_written(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            message = self.writer.submit(user=self.user, room=self.room, content='hi')
+        self.assertIsNotNone(message.id)
+        self.assertIsNotNone(message.expires_at)
+        self.assertFalse(ChatMessage.objects.filter(id=message.id).exists())
+
+        self.assertEqual(self.writer.flush(), 1)
+        self.assertTrue(ChatMessage.objects.filter(id=message.id, content='hi').exists())
+
+    def test_reserved_ids_do_not_collide_with_direct_inserts(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            queued = self.writer.submit(user=self.user, room=self.room, content='queued')
+        direct = ChatMessage.objects.create(user=self.user, room=self.room, content='direct')
+        self.assertGreater(direct.id, queued.id)
+        self.writer.flush()
+        self.assertEqual(self.room.chatmessage_set.count(), 2)
+
+    def test_system_messages_keep_the_cursor_in_order(self):
+        message_buffer.clear()
+        other = User.objects.create(username='other')
+        self.room.participants.add(self.user, other)
+        self.client.force_login(other)
+        with self.settings(CHAT_WRITE_BEHIND=True), \
+                mock.patch('chatkada.write_behind.message_writer', self.writer), \
+                self.captureOnCommitCallbacks(execute=True):
+            first = create_chat_message(user=self.user, room=self.room, content='first')
+            self.client.get(reverse('leave_chat', kwargs={'room_id': self.room.room_id}))
+            last = create_chat_message(user=self.user, room=self.room, content='last')
+        self.writer.flush()
+        message_buffer.clear()
+
+        leave = ChatMessage.objects.get(room=self.room, message_type='system')
+        self.assertEqual(
+            list(self.room.chatmessage_set.order_by('id').values_list('id', flat=True)),
+            [first.id, leave.id, last.id]
+        )
+        payload = get_messages_payload(self.room, since=leave.id)
+        self.assertEqual([m['content'] for m in payload['messages']], ['last'])
+
+    def test_unflushed_messages_are_served_from_the_buffer(self):
+        message_buffer.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            message = self.writer.submit(user=self.user, room=self.room, content='pending')
+        with self.settings(MESSAGE_BUFFER_ENABLED=True), \
+                mock.patch('chatkada.views.message_writer', self.writer):
+            self.assertEqual([m['id'] for m in get_recent_messages(self.room)], [message.id])
+        message_buffer.clear()
+
+
+class MatchmakingTests(TransactionTestCase):
+    def setUp(self):
+        recent_partners.clear()
+        # No password, hashing twenty of them would dominate the test
+        self.users = [User.objects.create(username=f'searcher{i}') for i in range(20)]
+        for user in self.users:
+            matchmaking.enqueue(user)
+        StrangerChatQueue.objects.update(joined_at=timezone.now() - timedelta(minutes=1))
+
+    def test_concurrent_searchers_are_never_double_matched(self):
+        barrier = threading.Barrier(len(self.users))
+
+        def search(user):
+            try:
+                barrier.wait()
+                matchmaking.find_match(user)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=search, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Anyone who lost every race pairs up on the next try
+        for user in self.users:
+            if StrangerChatQueue.objects.filter(user=user).exists():
+                matchmaking.find_match(user)
+
+        rooms = ChatRoom.objects.filter(room_type='stranger')
+        self.assertEqual(rooms.count(), len(self.users) // 2)
+        for room in rooms:
+            self.assertEqual(room.participants.count(), 2)
+            self.assertEqual(room.participant_count, 2)
+        for user in self.users:
+            self.assertEqual(user.chat_rooms.count(), 1)
+        self.assertFalse(StrangerChatQueue.objects.exists())
+
+    def test_partner_must_have_waited(self):
+        StrangerChatQueue.objects.update(joined_at=timezone.now())
+        self.assertIsNone(matchmaking.find_match(self.users[0]))
+        self.assertTrue(StrangerChatQueue.objects.filter(user=self.users[0]).exists())
+
+
+class BatchMatcherTests(TestCase):
+    def setUp(self):
+        recent_partners.clear()
+        self.users = [User.objects.create(username=f'searcher{i}') for i in range(13)]
+        for user in self.users:
+            matchmaking.enqueue(user)
+
+    def test_one_pass_pairs_the_whole_queue(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(matchmaking.match_queue(limit=500), 6)
+        # Bulk writes: the query count doesn't grow with the number of pairs
+        self.assertLessEqual(len(ctx.captured_queries), 12)
+
+        self.assertEqual(StrangerChatQueue.objects.get().user, self.users[-1])
+        rooms = ChatRoom.objects.filter(room_type='stranger')
+        self.assertEqual(rooms.count(), 6)
+        for room in rooms:
+            self.assertEqual(room.participants.count(), 2)
+            self.assertEqual(room.chatmessage_set.filter(message_type='system').count(), 1)
+
+    def test_waiting_user_learns_their_room(self):
+        matchmaking.match_queue(limit=500)
+        self.client.force_login(self.users[0])
+        data = self.client.get(reverse('check_match_status')).json()
+        self.assertEqual(data['status'], 'matched')
+        self.assertEqual(data['room_id'], str(self.users[0].chat_rooms.get().room_id))
+
+
+class CleanupInactiveUsersTests(TestCase):
+    def test_stale_queue_entries_are_swept_on_a_schedule(self):
+        self.assertEqual(
+            settings.CELERY_BEAT_SCHEDULE['cleanup-inactive-users']['task'],
+            'chatkada.tasks.cleanup_inactive_users'
+        )
+        self.assertIn('chatkada.tasks.cleanup_inactive_users', [job[1] for job in settings.CRONJOBS])
+
+        stale, fresh = [User.objects.create(username=name) for name in ('stale', 'fresh')]
+        matchmaking.enqueue(stale)
+        matchmaking.enqueue(fresh)
+        StrangerChatQueue.objects.filter(user=stale).update(
+            joined_at=timezone.now() - StrangerChatQueue.TTL - timedelta(seconds=1)
+        )
+        self.assertIn('1 expired queue entries', cleanup_inactive_users())
+        self.assertEqual(StrangerChatQueue.objects.get().user, fresh)
+
+
+class SimulateMatchmakingTests(TestCase):
+    def simulate(self, matcher):
+        out = StringIO()
+        call_command(
+            'simulate_matchmaking',
+            users=12, seed=3, matcher=matcher, min_partner_wait=2, timeout=30,
+            stdout=out
+        )
+        return out.getvalue().splitlines()
+
+    def test_seeded_runs_match_the_same_users(self):
+        first = self.simulate('batch')
+        self.assertIn('Matched (seen by client): 12  rooms: 6', first)
+        self.assertIn('Double-matched users: 0  rooms without two members: 0  client saw the wrong room: 0', first)
+        # The simulated clock makes the whole run repeatable, latencies included
+        second = self.simulate('batch')
+        self.assertEqual([line for line in first if not line.startswith('Queries')],
+                         [line for line in second if not line.startswith('Queries')])
+        self.assertFalse(User.objects.filter(username__startswith='__sim_').exists())
+
+    def test_request_path_pairs_on_search(self):
+        lines = self.simulate('request')
+        self.assertEqual(lines[:3], self.simulate('request')[:3])
+        self.assertIn('Matched (seen by client): 12  rooms: 6', lines)
+        self.assertIn('Double-matched users: 0  rooms without two members: 0  client saw the wrong room: 0', lines)
+
+
+class WaitTimeEstimatorTests(TestCase):
+    def setUp(self):
+        self.estimator = WaitTimeEstimator(window=60, half_life=60, queue_expiry=600)
+
+    def test_no_history_means_no_estimate(self):
+        self.estimator.arrived(1, now=0)
+        estimate = self.estimator.estimate(1, now=5)
+        self.assertEqual(estimate['queue_position'], 1)
+        self.assertIsNone(estimate['estimated_wait_seconds'])
+
+    def test_position_and_wait_follow_the_match_rate(self):
+        for user_id in range(1, 21):
+            self.estimator.arrived(user_id, now=0)
+        # Two users matched every second for ten seconds
+        for second in range(10):
+            self.estimator.matched([2 * second + 1, 2 * second + 2], now=second)
+        for user_id in range(21, 31):
+            self.estimator.arrived(user_id, now=10)
+
+        estimate = self.estimator.estimate(25, now=10)
+        self.assertEqual(estimate['queue_position'], 5)
+        # Roughly 2 users/s leave the queue, so position 5 is a few seconds off
+        self.assertGreater(estimate['estimated_wait_seconds'], 1)
+        self.assertLess(estimate['estimated_wait_seconds'], 6)
+        self.assertIsNotNone(estimate['typical_wait_seconds'])
+
+    def test_leaving_moves_everyone_up(self):
+        for user_id in (1, 2, 3):
+            self.estimator.arrived(user_id, now=0)
+        self.estimator.left(1)
+        self.assertEqual(self.estimator.estimate(3, now=1)['queue_position'], 2)
+
+    def test_leaving_from_the_middle_moves_those_behind_up(self):
+        for user_id in (1, 2, 3, 4):
+            self.estimator.arrived(user_id, now=0)
+        self.estimator.left(2)
+        self.estimator.matched([3], now=1)
+        self.assertEqual(self.estimator.estimate(1, now=1)['queue_position'], 1)
+        self.assertEqual(self.estimator.estimate(4, now=1)['queue_position'], 2)
+
+    def test_positions_survive_the_line_growing(self):
+        rng = random.Random(7)
+        waiting = []
+        for user_id in range(1, 1001):
+            self.estimator.arrived(user_id, now=0)
+            waiting.append(user_id)
+            # Every so often someone leaves out of turn
+            if rng.random() < 0.6:
+                self.estimator.left(waiting.pop(rng.randrange(len(waiting))))
+        for user_id in waiting[::37]:
+            expected = waiting.index(user_id) + 1
+            self.assertEqual(self.estimator.estimate(user_id, now=1)['queue_position'], expected)
+
+    def test_match_status_reports_the_estimate(self):
+        user = User.objects.create(username='patient')
+        matchmaking.enqueue(user)
+        self.client.force_login(user)
+        data = self.client.get(reverse('check_match_status')).json()
+        self.assertEqual(data['status'], 'waiting')
+        self.assertIn('queue_position', data)
+        self.assertIn('estimated_wait', data)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_find_chat_page_waits_on_the_match_status(self):
+        user = User.objects.create(username='searcher')
+        self.client.force_login(user)
+        response = self.client.get(reverse('find_chat'))
+        self.assertContains(response, 'id="find-stranger-form"')
+        self.assertContains(response, f'fetch("{reverse("find_stranger_chat")}"')
+        self.assertContains(response, f'fetch("{reverse("check_match_status")}")')
+        self.assertNotContains(response, '{% url')
+
+
+class RecentPartnerTests(TestCase):
+    def setUp(self):
+        recent_partners.clear()
+        self.users = [User.objects.create(username=f'regular{i}') for i in range(4)]
+        UserChatHistory.objects.create(user=self.users[0], chatted_with=self.users[1])
+
+    def test_seeded_once_from_history(self):
+        partners = RecentPartners(per_user=5, max_users=10, history_days=7)
+        with self.assertNumQueries(1):
+            partners.seed(self.users[1].id)
+            partners.seed(self.users[1].id)
+        self.assertTrue(partners.excludes(self.users[1].id, self.users[0].id))
+        partners.record(self.users[1].id, self.users[2].id)
+        self.assertEqual(partners.get(self.users[1].id), (self.users[2].id, self.users[0].id))
+
+    def test_lru_is_bounded(self):
+        partners = RecentPartners(per_user=2, max_users=2, history_days=7)
+        for user in self.users[:3]:
+            partners.seed(user.id)
+        self.assertEqual(partners.get(self.users[0].id), ())
+        self.assertEqual(len(partners._partners), 2)
+
+    def test_batch_matcher_skips_recent_partners(self):
+        # Queue order 0, 1, 2, 3: plain neighbour pairing would put 0 with 1 again
+        for user in self.users:
+            matchmaking.enqueue(user)
+        entries = list(StrangerChatQueue.objects.order_by('joined_at'))
+        with self.assertNumQueries(0):
+            pairs = matchmaking.pair_entries(entries)
+        self.assertEqual(
+            [(a.user_id, b.user_id) for a, b in pairs],
+            [(self.users[0].id, self.users[2].id), (self.users[1].id, self.users[3].id)]
+        )
+
+    def test_long_wait_accepts_a_recent_partner(self):
+        for user in self.users[:2]:
+            matchmaking.enqueue(user)
+        self.assertEqual(matchmaking.match_queue(limit=500), 0)
+        StrangerChatQueue.objects.update(joined_at=timezone.now() - matchmaking.RECENT_PARTNER_GRACE)
+        self.assertEqual(matchmaking.match_queue(limit=500), 1)
+
+    def test_abandoned_entries_are_not_matched(self):
+        for user in self.users[2:]:
+            matchmaking.enqueue(user)
+        StrangerChatQueue.objects.filter(user=self.users[2]).update(
+            joined_at=timezone.now() - StrangerChatQueue.TTL - timedelta(minutes=1)
+        )
+        StrangerChatQueue.objects.filter(user=self.users[3]).update(
+            joined_at=timezone.now() - matchmaking.MIN_PARTNER_WAIT
+        )
+        self.assertIsNone(matchmaking.pair(self.users[3]))
+        self.assertEqual(matchmaking.match_queue(limit=500), 0)
+
+        # Searching again restarts the wait
+        matchmaking.enqueue(self.users[2])
+        self.assertFalse(StrangerChatQueue.objects.get(user=self.users[2]).is_expired())
+
+
+@override_settings(STRANGER_ROOM_POOL=True)
+class RoomPoolTests(TestCase):
+    def setUp(self):
+        recent_partners.clear()
+        self.pool = RoomPool(refill_interval=None, min_size=3, max_size=10, stale_after=60)
+        # Sized from a match rate no other test has fed
+        estimator = WaitTimeEstimator(window=300, half_life=300, queue_expiry=600)
+        patcher = mock.patch('chatkada.room_pool.wait_estimator', estimator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.users = [User.objects.create(username=f'pooled{i}') for i in range(4)]
+        for user in self.users:
+            matchmaking.enqueue(user)
+
+    def test_matches_claim_pooled_rooms(self):
+        self.assertEqual(self.pool.refill(), 3)
+        pooled_ids = set(ChatRoom.objects.filter(room_type='stranger_pool').values_list('pk', flat=True))
+
+        with mock.patch('chatkada.matchmaking.room_pool', self.pool):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(matchmaking.match_queue(limit=500), 2)
+
+        rooms = ChatRoom.objects.filter(room_type='stranger')
+        self.assertEqual(set(rooms.values_list('pk', flat=True)) - pooled_ids, set())
+        for room in rooms:
+            self.assertTrue(room.is_active)
+            self.assertEqual(room.participants.count(), 2)
+            self.assertIn(room.created_by, room.participants.all())
+        self.assertEqual(ChatRoom.objects.filter(room_type='stranger_pool').count(), 1)
+        self.assertEqual(self.pool.stats()['claimed'], 2)
+
+    def test_rooms_come_back_after_a_rollback(self):
+        self.pool.refill()
+        with mock.patch('chatkada.matchmaking.room_pool', self.pool):
+            with mock.patch.object(ChatRoom.participants.through.objects, 'bulk_create', side_effect=RuntimeError):
+                with self.assertRaises(RuntimeError):
+                    matchmaking.match_queue(limit=500)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+        self.assertEqual(ChatRoom.objects.filter(room_type='stranger_pool').count(), 3)
+
+        self.assertEqual(self.pool.return_rolled_back(now=time.monotonic() + self.pool.handout_grace), 2)
+        self.assertEqual(self.pool.stats()['idle'], 3)
+        with mock.patch('chatkada.matchmaking.room_pool', self.pool):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(matchmaking.match_queue(limit=500), 2)
+        self.assertEqual(self.pool.stats()['claimed'], 2)
+        self.assertEqual(self.pool.stats()['handed_out'], 0)
+
+    def test_empty_pool_falls_back_to_insert(self):
+        with mock.patch('chatkada.matchmaking.room_pool', self.pool):
+            self.assertEqual(matchmaking.match_queue(limit=500), 2)
+        self.assertEqual(ChatRoom.objects.filter(room_type='stranger').count(), 2)
+        self.assertEqual(self.pool.stats()['missed'], 2)
+
+    def test_stale_rooms_are_recycled(self):
+        self.pool.refill()
+        ChatRoom.objects.filter(room_type='stranger_pool').update(created_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(self.pool.refill(), 3)
+        self.assertEqual(self.pool.stats()['recycled'], 3)
+        self.assertEqual(ChatRoom.objects.filter(room_type='stranger_pool').count(), 3)
+
+
+class CoinLedgerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='spender')
+        self.item = Item.objects.create(name='Chai', price=30, category='chai')
+        self.client.force_login(self.user)
+
+    def buy(self, quantity=1):
+        return self.client.post(
+            reverse('buy_item'),
+            json.dumps({'item_id': self.item.id, 'quantity': quantity}),
+            content_type='application/json'
+        ).json()
+
+    def test_purchase_debits_and_records_once(self):
+        self.assertEqual(self.buy(quantity=3)['coins'], 10)
+        self.assertEqual(self.buy()['message'], 'Not enough coins!')
+        self.assertEqual(UserProfile.objects.get(user=self.user).coins, 10)
+        self.assertEqual(Purchase.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(CoinTransaction.objects.get(user=self.user, transaction_type='purchase').amount, -90)
+        self.assertFalse(self.buy(quantity=-5)['success'])
+
+    def test_braces_in_item_names_are_stored_as_is(self):
+        self.item.name = 'Chai {special}'
+        self.item.save()
+        self.assertTrue(self.buy()['success'])
+        self.assertEqual(
+            CoinTransaction.objects.get(user=self.user, transaction_type='purchase').description,
+            'Bought 1x Chai {special}'
+        )
+
+    def test_daily_login_is_paid_once_and_keeps_the_streak(self):
+        UserProfile.objects.filter(user=self.user).update(
+            last_login_date=date.today() - timedelta(days=1),
+            login_streak=4
+        )
+        data = self.client.get(reverse('check_daily_login')).json()
+        self.assertEqual((data['total_coins'], data['streak']), (125, 5))
+        self.assertFalse(self.client.get(reverse('check_daily_login')).json()['success'])
+        self.assertEqual(
+            CoinTransaction.objects.get(user=self.user).description,
+            'Daily login bonus - Day 5'
+        )
+
+
+class CoinLedgerConcurrencyTests(TransactionTestCase):
+    def test_concurrent_purchases_never_overspend(self):
+        user = User.objects.create(username='rapid')
+        barrier = threading.Barrier(20)
+        spent = []
+
+        def spend():
+            barrier.wait()
+            try:
+                for _ in range(5):
+                    while True:
+                        try:
+                            coins.debit(user, 7, 'purchase', 'stress')
+                            spent.append(7)
+                            break
+                        except OperationalError:
+                            # SQLite's table lock; PostgreSQL would just wait
+                            continue
+            except coins.InsufficientCoins:
+                pass
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=spend) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # 100 coins buy exactly 14 sevens; none lost, none overspent
+        balance = UserProfile.objects.get(user=user).coins
+        self.assertEqual(len(spent), 14)
+        self.assertEqual(balance, 2)
+        self.assertEqual(CoinTransaction.objects.filter(user=user).count(), 14)
+
+
+class CoinDailyTotalTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='earner')
+        coins.credit(self.user, 25, 'daily_login', 'Daily login bonus')
+        coins.credit(self.user, 60, 'make_friends', 'Made 5 new friends')
+        coins.debit(self.user, 30, 'purchase', 'Bought 1x Chai')
+        coins.debit(self.user, 20, 'purchase', 'Bought 1x Vada')
+
+    def rollup(self):
+        return sorted(CoinDailyTotal.objects.values_list('transaction_type', 'total', 'count'))
+
+    def test_kept_up_to_date_as_coins_move(self):
+        self.assertEqual(
+            self.rollup(),
+            [('daily_login', 25, 1), ('make_friends', 60, 1), ('purchase', -50, 2)]
+        )
+        CoinTransaction.objects.filter(amount=-20).get().delete()
+        self.assertIn(('purchase', -30, 1), self.rollup())
+
+    def test_rebuild_matches_incremental(self):
+        incremental = self.rollup()
+        CoinDailyTotal.objects.all().delete()
+        call_command('rollup_coin_transactions', stdout=StringIO())
+        self.assertEqual(self.rollup(), incremental)
+
+    # Templates without a collectstatic manifest
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_coin_center_reads_the_rollup(self):
+        self.client.force_login(self.user)
+        leaderboard.rebuild()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('coin_center'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any('SUM(' in q['sql'] for q in ctx.captured_queries))
+        # Session, user, profile, challenges, daily reset, rollup, recent
+        # list, leaderboard usernames
+        self.assertLessEqual(len(ctx.captured_queries), 8)
+        self.assertEqual(response.context['daily_progress'][-1]['coins'], 85)
+        self.assertEqual(
+            sorted((s.transaction_type, s.total) for s in response.context['weekly_summary']),
+            [('daily_login', 25), ('make_friends', 60)]
+        )
+
+
+class CoinProgressSnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='poller')
+        self.client.force_login(self.user)
+        self.url = reverse('get_coin_progress')
+
+    def test_steady_state_poll_runs_no_app_queries(self):
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.client.get(self.url).json()
+        self.assertEqual(data['total_coins'], 100)
+        # Only the session and user lookups done by the auth middleware
+        self.assertFalse(any('chatkada_' in q['sql'] for q in ctx.captured_queries))
+
+    def test_ledger_writes_refresh_the_snapshot(self):
+        self.assertFalse(self.client.get(self.url).json()['daily_login_completed'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('check_daily_login'))
+        data = self.client.get(self.url).json()
+        self.assertTrue(data['daily_login_completed'])
+        self.assertEqual(data['total_coins'], 125)
+
+        # A ledger write with no event published still drops the snapshot
+        with self.captureOnCommitCallbacks(execute=True):
+            coins.debit(self.user, 25, 'purchase', 'Bought 1x Chai')
+        self.assertEqual(self.client.get(self.url).json()['total_coins'], 100)
+
+
+@override_settings(CHALLENGE_ASSIGN_CHUNK_SIZE=4)
+class AssignChallengeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = [User.objects.create(username=f'player{i}') for i in range(10)]
+        self.today = timezone.now().date()
+        # Already done today, so neither assigned nor credited again
+        DailyChallenge.objects.create(
+            user=self.users[3], challenge_type='make_friends', completed_date=self.today, coins_earned=60
+        )
+
+    def test_assigns_and_credits_in_bulk(self):
+        with CaptureQueriesContext(connection) as ctx:
+            assign_daily_challenge('job', 'make_friends', 15, self.today.isoformat())
+        # A fixed dozen or so per chunk, however many users it holds, plus
+        # setting up the job row
+        self.assertLessEqual(len(ctx.captured_queries), 3 * 13 + 6)
+
+        self.assertEqual(DailyChallenge.objects.filter(challenge_type='make_friends').count(), 10)
+        balances = dict(UserProfile.objects.values_list('user__username', 'coins'))
+        self.assertEqual(balances['player3'], 100)
+        self.assertEqual(balances['player0'], 115)
+        self.assertEqual(CoinTransaction.objects.filter(amount=15).count(), 9)
+        self.assertEqual(CoinDailyTotal.objects.get(user=self.users[0]).total, 15)
+
+        job = ChallengeJob.objects.get(job_id='job')
+        self.assertEqual((job.status, job.processed, job.assigned), ('done', 10, 9))
+        self.assertIsNotNone(job.finished_at)
+
+        # Running it again assigns nobody
+        assign_daily_challenge('again', 'make_friends', 15, self.today.isoformat())
+        self.assertEqual(ChallengeJob.objects.get(job_id='again').assigned, 0)
+        self.assertEqual(CoinTransaction.objects.filter(amount=15).count(), 9)
+
+    def test_assigns_without_returning_support(self):
+        with mock.patch.object(connection.features, 'can_return_columns_from_insert', False):
+            assign_daily_challenge('job', 'make_friends', 15, self.today.isoformat())
+        self.assertEqual(DailyChallenge.objects.filter(challenge_type='make_friends').count(), 10)
+        self.assertEqual(CoinTransaction.objects.filter(amount=15).count(), 9)
+        self.assertEqual(ChallengeJob.objects.get(job_id='job').assigned, 9)
+
+    def test_only_users_with_a_profile_get_ledger_rows(self):
+        UserProfile.objects.filter(user=self.users[5]).delete()
+        for returning in (True, False):
+            with mock.patch.object(connection.features, 'can_return_columns_from_insert', returning):
+                assign_daily_challenge('job', 'make_friends' if returning else 'daily_login', 15, self.today.isoformat())
+            self.assertFalse(CoinTransaction.objects.filter(user=self.users[5]).exists())
+        self.assertEqual(CoinTransaction.objects.filter(amount=15).count(), 8 + 9)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_admin_follows_the_job(self):
+        User.objects.filter(pk=self.users[0].pk).update(is_staff=True)
+        self.client.force_login(self.users[0])
+        response = self.client.post(
+            reverse('assign_challenge'),
+            {'challenge_type': 'daily_login', 'coins_earned': 10}
+        )
+        self.assertEqual(response.status_code, 302)
+        progress = self.client.get(response['Location'])
+        self.assertEqual(progress.context['job'].status, 'done')
+        self.assertEqual(progress.context['percent'], 100)
+
+    def test_only_staff_can_assign_or_follow_jobs(self):
+        self.client.force_login(self.users[1])
+        response = self.client.post(
+            reverse('assign_challenge'),
+            {'challenge_type': 'daily_login', 'coins_earned': 10}
+        )
+        self.assertRedirects(response, reverse('custom_admin_login'), fetch_redirect_response=False)
+        self.assertFalse(DailyChallenge.objects.filter(challenge_type='daily_login').exists())
+        response = self.client.get(reverse('challenge_job', kwargs={'job_id': 'job'}))
+        self.assertRedirects(response, reverse('custom_admin_login'), fetch_redirect_response=False)
+
+
+class RankedScoresTests(TestCase):
+    def test_rank_and_top_follow_score_changes(self):
+        board = leaderboard.RankedScores({1: 50, 2: 80, 3: 50})
+        self.assertEqual(board.top(3), [(2, 80), (1, 50), (3, 50)])
+        self.assertEqual(board.rank(3), (3, 50))
+        board.add(3, 40)
+        board.add(4, 10)
+        self.assertEqual(board.top(2), [(3, 90), (2, 80)])
+        self.assertEqual(board.rank(1), (3, 50))
+        self.assertEqual(board.rank(4), (4, 10))
+        self.assertIsNone(board.rank(5))
+
+
+class LeaderboardTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        coins.credit(self.alice, 100, 'daily_login', 'Daily login bonus')
+        # Boards are per process; start each test from this test's data
+        leaderboard.rebuild()
+
+    def test_credits_update_both_boards_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            coins.credit(self.bob, 150, 'make_friends', 'Made 5 new friends')
+            coins.debit(self.bob, 100, 'purchase', 'Bought 1x Chai')
+        for board in leaderboard.BOARDS:
+            key = leaderboard.board_key(board)
+            self.assertEqual(leaderboard.leaderboard.rank(key, self.bob.pk), (1, 150))
+            self.assertEqual(leaderboard.leaderboard.rank(key, self.alice.pk), (2, 100))
+            self.assertEqual(leaderboard.check(board), [])
+
+    def test_bulk_challenge_credits_are_ranked(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            assign_daily_challenge('job', 'make_friends', 200, date.today().isoformat())
+        self.assertEqual(leaderboard.leaderboard.rank('global', self.alice.pk), (1, 300))
+        self.assertEqual(leaderboard.check('global'), [])
+        self.assertEqual(leaderboard.check('weekly'), [])
+
+    def test_credits_while_a_board_loads_are_replayed(self):
+        board = leaderboard.LocalLeaderboard()
+        read = leaderboard.read_scores
+
+        def read_then_credit(key):
+            scores, watermark = read(key)
+            # Committed after the read, before the board goes live
+            board.add(key, [(self.bob.pk, watermark + 1, 30)])
+            return scores, watermark
+
+        with mock.patch('chatkada.leaderboard.read_scores', side_effect=read_then_credit):
+            self.assertEqual(board.rank('global', self.bob.pk), (2, 30))
+        board.add('global', [(self.bob.pk, 0, 90)])
+        self.assertEqual(board.top('global', 2), [(self.bob.pk, 120), (self.alice.pk, 100)])
+
+    def test_credits_committed_before_the_read_count_once(self):
+        board = leaderboard.LocalLeaderboard()
+        with self.captureOnCommitCallbacks() as callbacks:
+            coins.credit(self.bob, 30, 'make_friends', 'Made 5 new friends')
+        read = leaderboard.read_scores
+
+        def read_then_apply(key):
+            result = read(key)
+            # The credit is in the read, but its on_commit only runs now
+            for callback in callbacks:
+                callback()
+            return result
+
+        with mock.patch('chatkada.leaderboard.leaderboard', board), \
+                mock.patch('chatkada.leaderboard.read_scores', side_effect=read_then_apply):
+            self.assertEqual(board.rank('global', self.bob.pk), (2, 30))
+        self.assertEqual(board.rank(leaderboard.board_key('weekly'), self.bob.pk), (2, 30))
+
+    def test_check_finds_drift_and_rebuild_fixes_it(self):
+        UserProfile.objects.filter(user=self.bob).update(total_coins_earned=40)
+        self.assertEqual(leaderboard.check('global'), [(self.bob.pk, None, 40)])
+        leaderboard.rebuild(['global'])
+        self.assertEqual(leaderboard.check('global'), [])
+        self.assertEqual(leaderboard.leaderboard.rank('global', self.bob.pk), (2, 40))
+
+    def test_weekly_board_only_counts_this_week(self):
+        CoinDailyTotal.objects.create(
+            user=self.bob,
+            day=leaderboard.week_start() - timedelta(days=1),
+            transaction_type='make_friends',
+            total=500,
+            count=1
+        )
+        UserProfile.objects.filter(user=self.bob).update(total_coins_earned=500)
+        leaderboard.rebuild()
+        self.assertEqual(leaderboard.leaderboard.rank('global', self.bob.pk), (1, 500))
+        self.assertIsNone(leaderboard.leaderboard.rank(leaderboard.board_key('weekly'), self.bob.pk))
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_profile_shows_rank(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('profile'))
+        self.assertEqual(response.status_code, 200)
+        title, board = response.context['leaderboards'][0]
+        self.assertEqual(title, 'All Time')
+        self.assertEqual(board['me'], (1, 100))
+        self.assertEqual(board['top'][0]['username'], 'alice')
+        self.assertTrue(board['top'][0]['is_me'])
+
+
+@skipUnless(find_spec('fakeredis') and find_spec('lupa'), 'needs fakeredis with Lua (pip install "fakeredis[lua]")')
+class RedisLeaderboardTests(TestCase):
+    def setUp(self):
+        import fakeredis
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        coins.credit(self.alice, 100, 'daily_login', 'Daily login bonus')
+        with mock.patch('redis.Redis.from_url', return_value=fakeredis.FakeRedis()):
+            self.board = leaderboard.RedisLeaderboard('redis://fake')
+
+    def credit_during_read(self, credit):
+        read = leaderboard.read_scores
+
+        def read_then_credit(key):
+            result = read(key)
+            credit(key, result[1])
+            return result
+
+        return mock.patch('chatkada.leaderboard.read_scores', side_effect=read_then_credit)
+
+    def test_credits_are_only_kept_once_a_board_is_live(self):
+        self.board.add('global', [(self.bob.pk, 1, 500)])
+        self.assertEqual(self.board.client.keys('*'), [])
+        self.assertEqual(self.board.top('global', 5), [(self.alice.pk, 100)])
+        self.board.add('global', [(self.bob.pk, 2, 30), (self.alice.pk, 2, 5)])
+        self.assertEqual(self.board.top('global', 5), [(self.alice.pk, 105), (self.bob.pk, 30)])
+
+    def test_pending_credits_above_the_watermark_are_replayed(self):
+        def credit(key, watermark):
+            # One already in the read, one committed after it
+            self.board.add(key, [(self.alice.pk, watermark, 100), (self.bob.pk, watermark + 1, 30)])
+
+        with self.credit_during_read(credit):
+            self.assertEqual(self.board.rank('global', self.bob.pk), (2, 30))
+        self.assertEqual(self.board.rank('global', self.alice.pk), (1, 100))
+        self.assertEqual(
+            sorted(self.board.client.keys('*')),
+            [b'leaderboard:global', b'leaderboard:global:loaded']
+        )
+
+    def test_empty_board_is_read_once(self):
+        key = 'weekly:2000-01-03'
+        with mock.patch('chatkada.leaderboard.read_scores', wraps=leaderboard.read_scores) as read:
+            self.assertEqual(self.board.top(key, 5), [])
+            self.assertIsNone(self.board.rank(key, self.bob.pk))
+            self.assertEqual(self.board.size(key), 0)
+        self.assertEqual(read.call_count, 1)
+
+        self.board.add(key, [(self.bob.pk, 1, 30)])
+        self.assertEqual(self.board.top(key, 5), [(self.bob.pk, 30)])
+        # Created after the load, it still expires with the week
+        self.assertGreater(self.board.client.ttl(f'leaderboard:{key}'), 0)
+
+    def test_load_keeps_a_board_that_went_live_meanwhile(self):
+        def rebuild(key, watermark):
+            self.board.load(key, {self.bob.pk: 5}, watermark)
+
+        with self.credit_during_read(rebuild):
+            self.assertEqual(self.board.top('global', 5), [(self.bob.pk, 5)])
+        self.assertEqual(
+            sorted(self.board.client.keys('*')),
+            [b'leaderboard:global', b'leaderboard:global:loaded']
+        )
+
+
+
+class CoinDailyTotalMigrationTests(TransactionTestCase):
+    before = [('chatkada', '0005_chatroom_stranger_pool')]
+    after = [('chatkada', '0006_coindailytotal')]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_existing_transactions_are_rolled_up(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        apps = executor.loader.project_state(self.before).apps
+        user = apps.get_model('auth', 'User').objects.create(username='veteran')
+        CoinTransaction = apps.get_model('chatkada', 'CoinTransaction')
+        for amount, transaction_type in [(25, 'daily_login'), (25, 'daily_login'), (-30, 'purchase')]:
+            CoinTransaction.objects.create(user=user, amount=amount, transaction_type=transaction_type)
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+        apps = executor.loader.project_state(self.after).apps
+        totals = apps.get_model('chatkada', 'CoinDailyTotal').objects.values_list('transaction_type', 'total', 'count')
+        self.assertEqual(sorted(totals), [('daily_login', 50, 2), ('purchase', -30, 1)])
+
+
+class InventoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='sharer')
+        self.item = Item.objects.create(name='Chai', price=10, category='chai')
+        self.room = ChatRoom.objects.create(name='Bench', room_type='private_bench', created_by=self.user)
+        self.room.add_participant(self.user)
+        self.client.force_login(self.user)
+
+    def buy(self, quantity):
+        return self.client.post(
+            reverse('buy_item'),
+            json.dumps({'item_id': self.item.id, 'quantity': quantity}),
+            content_type='application/json'
+        ).json()
+
+    def share(self):
+        return self.client.post(
+            reverse('send_chat_message'),
+            json.dumps({
+                'room_id': str(self.room.room_id),
+                'message_type': 'shared_item',
+                'shared_item_id': self.item.id
+            }),
+            content_type='application/json'
+        ).json()
+
+    def test_purchases_and_shares_move_one_row(self):
+        self.buy(2)
+        self.buy(1)
+        self.assertEqual(self.share()['remaining_quantity'], 2)
+        self.assertEqual(
+            list(Inventory.objects.values_list('owned', 'remaining', 'shared')),
+            [(3, 2, 1)]
+        )
+
+    def test_cannot_share_more_than_bought(self):
+        self.buy(1)
+        self.assertTrue(self.share()['success'])
+        self.assertFalse(self.share()['success'])
+        self.assertEqual(Inventory.objects.get().remaining, 0)
+
+    def test_failed_share_message_keeps_the_item(self):
+        self.buy(1)
+        with mock.patch('chatkada.views.create_chat_message', side_effect=RuntimeError('database went away')):
+            self.assertFalse(self.share()['success'])
+        self.assertEqual(list(Inventory.objects.values_list('remaining', 'shared')), [(1, 0)])
+        self.assertFalse(ChatMessage.objects.filter(message_type='shared_item').exists())
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_profile_reads_the_inventory(self):
+        self.buy(2)
+        self.share()
+        response = self.client.get(reverse('profile'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.context['total_purchases'], response.context['total_shared']), (2, 1))
+        self.assertEqual([entry.remaining for entry in response.context['available_items']], [1])
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='hungry')
+        self.chai = Item.objects.create(name='Chai', price=10, category='chai')
+        self.vada = Item.objects.create(name='Vada', price=15, category='snacks')
+        self.client.force_login(self.user)
+
+    def checkout(self, *lines):
+        return self.client.post(
+            reverse('checkout'),
+            json.dumps({'items': [{'item_id': item.id, 'quantity': quantity} for item, quantity in lines]}),
+            content_type='application/json'
+        ).json()
+
+    def test_buys_the_whole_cart_at_once(self):
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.checkout((self.chai, 2), (self.vada, 1), (self.chai, 1))
+        self.assertEqual((data['coins'], data['spent']), (55, 45))
+        self.assertEqual(
+            sorted(Purchase.objects.values_list('item__name', 'quantity', 'total_price')),
+            [('Chai', 3, 30), ('Vada', 1, 15)]
+        )
+        self.assertEqual(
+            sorted(CoinTransaction.objects.filter(transaction_type='purchase').values_list('amount', flat=True)),
+            [-30, -15]
+        )
+        self.assertEqual(CoinDailyTotal.objects.get(transaction_type='purchase').total, -45)
+        self.assertEqual(dict(Inventory.objects.values_list('item__name', 'remaining')), {'Chai': 3, 'Vada': 1})
+        # A fixed number of statements (savepoints included), not a round per line
+        self.assertLessEqual(len(ctx.captured_queries), 20)
+
+    def test_nothing_is_written_when_the_cart_fails(self):
+        self.assertEqual(self.checkout((self.chai, 10), (self.vada, 1))['message'], 'Not enough coins!')
+        self.vada.available = False
+        self.vada.save()
+        self.assertFalse(self.checkout((self.chai, 1), (self.vada, 1))['success'])
+        self.assertFalse(self.checkout((self.chai, 0))['success'])
+        self.assertFalse(self.checkout()['success'])
+        self.assertEqual(UserProfile.objects.get(user=self.user).coins, 100)
+        self.assertFalse(Purchase.objects.exists())
+        self.assertFalse(CoinTransaction.objects.filter(transaction_type='purchase').exists())
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class CatalogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        catalog.invalidate()
+        self.user = User.objects.create(username='browser')
+        self.chai = Item.objects.create(name='Chai', price=10, category='chai')
+        Item.objects.create(name='Halwa', price=20, category='sweets', available=False)
+        self.client.force_login(self.user)
+
+    def item_queries(self, ctx):
+        return [q for q in ctx.captured_queries if 'chatkada_item' in q['sql']]
+
+    def test_menu_is_served_without_catalog_queries(self):
+        self.assertEqual([item.name for item in self.client.get(reverse('kada')).context['chai_items']], ['Chai'])
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('kada'))
+        self.assertContains(response, 'Chai')
+        self.assertNotContains(response, 'Halwa')
+        self.assertEqual(self.item_queries(ctx), [])
+
+    def test_item_edits_bump_the_version(self):
+        before = self.client.get(reverse('kada')).context['catalog_version']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chai.name = 'Masala Chai'
+            self.chai.save()
+        response = self.client.get(reverse('kada'))
+        self.assertNotEqual(response.context['catalog_version'], before)
+        self.assertContains(response, 'Masala Chai')
+
+    def test_shared_item_messages_read_the_catalog(self):
+        room = ChatRoom.objects.create(name='Bench', room_type='private_bench', created_by=self.user)
+        ChatMessage.objects.create(
+            user=self.user, room=room, content='shared Chai', message_type='shared_item', shared_item=self.chai
+        )
+        catalog.snapshot()
+        with CaptureQueriesContext(connection) as ctx:
+            messages = get_recent_messages(room)
+        self.assertEqual(messages[0]['shared_item']['name'], 'Chai')
+        self.assertEqual(self.item_queries(ctx), [])
+
+
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    IMAGE_DERIVATIVES={'chatkada/img/favicon-32x32.png': [16, 64]},
+    IMAGE_DERIVATIVES_DIR='chatkada/img/test-derived'
+)
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        from .templatetags.images import load_manifest
+        self.addCleanup(load_manifest.cache_clear)
+        call_command('build_image_derivatives', stdout=StringIO())
+        self.output = finders.find('chatkada/img/test-derived')
+        self.addCleanup(shutil.rmtree, self.output)
+        load_manifest.cache_clear()
+
+    def render(self, source):
+        return Template('{% load images %}' + source).render(Context())
+
+    def test_builds_copies_without_upscaling(self):
+        with open(os.path.join(self.output, 'manifest.json')) as f:
+            entry = json.load(f)['chatkada/img/favicon-32x32.png']
+        self.assertEqual([variant['width'] for variant in entry['variants']], [16, 32])
+        for variant in entry['variants']:
+            with Image.open(finders.find(variant['webp'])) as image:
+                self.assertEqual((image.format, image.width), ('WEBP', variant['width']))
+
+    def test_tags_use_the_copies(self):
+        html = self.render("{% responsive_image 'chatkada/img/favicon-32x32.png' alt='Icon' width=16 %}")
+        self.assertIn('type="image/webp"', html)
+        self.assertIn('/static/chatkada/img/test-derived/favicon-32x32-16w.webp 16w', html)
+        self.assertIn('sizes="16px"', html)
+        self.assertEqual(
+            self.render("{% image_variant 'chatkada/img/favicon-32x32.png' 20 %}"),
+            '/static/chatkada/img/test-derived/favicon-32x32-32w.png'
+        )
+        # Images without copies are served as they are
+        self.assertEqual(
+            self.render("{% responsive_image 'chatkada/img/favicon.ico' alt='Icon' %}"),
+            '<img src="/static/chatkada/img/favicon.ico" alt="Icon">'
+        )
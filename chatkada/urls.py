@@ -1,7 +1,6 @@
 from django.urls import path
 from django.contrib.auth import views as auth_views
 from . import views
-from .views import create_superuser_view
 urlpatterns = [
     path('', views.home, name='home'),
     path('register/', views.register, name='register'),
@@ -10,6 +9,7 @@ urlpatterns = [
     path('kada/', views.kada, name='kada'),
     path('profile/', views.profile, name='profile'),
     path('buy-item/', views.buy_item, name='buy_item'),
+    path('kada/checkout/', views.checkout, name='checkout'),
     
     # Chat URLs - make sure these match your template references
     path('find-chat/', views.find_chat, name='find_chat'),
@@ -25,7 +25,7 @@ urlpatterns = [
     path('get-coin-progress/', views.get_coin_progress, name='get_coin_progress'),
     path('get-online-status/', views.get_online_status, name='get_online_status'),
     path('find-stranger/', views.find_stranger_chat, name='find_stranger_chat'),
-    path("create-superuser/", create_superuser_view),
+    path('check-match-status/', views.check_match_status, name='check_match_status'),
     # Item management for admin
     path('custom-admin/login/', views.custom_admin_login, name='custom_admin_login'),
     path('custom-admin/', views.custom_admin_dashboard, name='custom_admin_dashboard'),
@@ -36,4 +36,9 @@ urlpatterns = [
     # Challenge management for admin
     path('custom-admin/challenges/', views.manage_challenges, name='manage_challenges'),
     path('custom-admin/challenges/assign/', views.assign_challenge, name='assign_challenge'),
+    path('custom-admin/challenges/jobs/<str:job_id>/', views.challenge_job, name='challenge_job'),
+    path('custom-admin/message-buffer/', views.message_buffer_stats, name='message_buffer_stats'),
+    path('custom-admin/presence/', views.presence_stats, name='presence_stats'),
+    path('custom-admin/matchmaking/', views.matchmaking_stats, name='matchmaking_stats'),
+    path('custom-admin/leaderboard/', views.leaderboard_stats, name='leaderboard_stats'),
 ]
\ No newline at end of file
@@ -0,0 +1,46 @@
+import uuid
+from django.core.cache import cache
+from django.db import transaction
+
+# Tokens expire so changes made without a bump (admin edits, cleanup jobs)
+# still reach clients within this many seconds
+VERSION_TTL = 300
+
+
+def room_version_key(room_id):
+    return f"ver:room:{room_id}"
+
+
+def coins_version_key(user_id):
+    return f"ver:coins:{user_id}"
+
+
+def match_version_key(user_id):
+    return f"ver:match:{user_id}"
+
+
+def catalog_version_key():
+    return "ver:catalog"
+
+
+def get_version(key):
+    """Current version token for a resource, for building an ETag.
+
+    A missing token just means "changed": a new one is stored and the
+    client gets one full response.
+    """
+    token = cache.get(key)
+    if token is None:
+        token = uuid.uuid4().hex[:12]
+        if not cache.add(key, token, VERSION_TTL):
+            token = cache.get(key) or token
+    return token
+
+
+def bump_version(key):
+    """Mark a resource as changed once the current transaction commits.
+
+    Bumping after commit, and reading the token before the data, means a
+    response can never be tagged with a version newer than its body.
+    """
+    transaction.on_commit(lambda: cache.delete(key))
@@ -5,23 +5,56 @@ from django.contrib.auth.models import User
 from django.contrib import messages
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.utils import timezone
-from django.db.models import Q, Count, Sum
+from django.db.models import Q, F, Case, When, Value
 from django.db import transaction
 from django.urls import reverse
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.dateparse import parse_datetime
 from datetime import date, timedelta
 from .models import (
     Item, Purchase, ChatMessage, UserProfile, ChatRoom, 
-    BenchInvite, DailyChallenge, CoinTransaction, UserChatHistory,
+    BenchInvite, DailyChallenge, ChallengeJob, CoinTransaction, CoinDailyTotal, UserChatHistory,
     StrangerChatQueue
 )
 from .forms import SimpleUserCreationForm
+from .message_buffer import message_buffer
+from .write_behind import create_chat_message, message_writer
+from .presence import presence, presence_exempt
+from .online import online_users
+from . import cart, coins, inventory, matchmaking
+from .room_pool import room_pool
+from .wait_estimator import wait_estimator, describe_wait
+from .coin_progress import get_coin_progress_payload, load_coin_progress
+from . import leaderboard
+from .catalog import catalog
+from .versions import (
+    get_version, room_version_key, coins_version_key, match_version_key
+)
+from .realtime import (
+    publish_chat_message, publish_participant_count, publish_coin_progress
+)
 import json
 import uuid
+
+# Messages returned per page by get_chat_messages
+MESSAGE_PAGE_SIZE = 50
+
+# How long after a match check_match_status still reports it to a user who was dequeued
+MATCH_NOTICE_WINDOW = timedelta(minutes=2)
+
+# check_match_status shows a wait timer and expires searches, so a waiting
+# user's ETag also changes every this many seconds
+MATCH_STATUS_ETAG_SECONDS = 30
 # views.py
-from django.http import HttpResponse
 from django.contrib.auth.models import User
 
+def home(request):
+    return render(request, 'home.html')
+
 def register(request):
     if request.method == 'POST':
         form = SimpleUserCreationForm(request.POST)
@@ -69,21 +102,22 @@ def register(request):
 @login_required
 def custom_logout(request):
     username = request.user.username
+    presence.forget(request.user.id)
     logout(request)
     messages.success(request, f'Goodbye {username}! You have been logged out successfully.')
     return redirect('home')
 
 @login_required
 def kada(request):
-    items = Item.objects.filter(available=True)
-    chai_items = items.filter(category='chai')
-    snack_items = items.filter(category='snacks')
-    sweet_items = items.filter(category='sweets')
+    # The menu comes from the in-process catalog; the rendered fragment is
+    # cached per catalog version
+    menu = catalog.snapshot()
     
     context = {
-        'chai_items': chai_items,
-        'snack_items': snack_items,
-        'sweet_items': sweet_items,
+        'catalog_version': menu.version,
+        'chai_items': menu.menu['chai'],
+        'snack_items': menu.menu['snacks'],
+        'sweet_items': menu.menu['sweets'],
         'user_coins': request.user.userprofile.coins
     }
     return render(request, 'kada.html', context)
@@ -97,46 +131,41 @@ def profile(request):
 @login_required
 def check_daily_login(request):
     """Check and reward daily login bonus"""
-    profile = request.user.userprofile
     today = date.today()
-    
-    # Check if user already got login bonus today
-    if profile.last_login_date != today:
-        # Award daily login bonus
-        coins_earned = 25
-        profile.coins += coins_earned
-        profile.total_coins_earned += coins_earned
-        profile.last_login_date = today
-        
-        # Update streak
-        if profile.last_login_date == today - timedelta(days=1):
-            profile.login_streak += 1
-        else:
-            profile.login_streak = 1
-        
-        profile.save()
-        
-        # Record challenge completion
-        DailyChallenge.objects.get_or_create(
-            user=request.user,
-            challenge_type='daily_login',
-            completed_date=today,
-            defaults={'coins_earned': coins_earned}
-        )
-        
-        # Record transaction
-        CoinTransaction.objects.create(
-            user=request.user,
-            amount=coins_earned,
-            transaction_type='daily_login',
-            description=f'Daily login bonus - Day {profile.login_streak}'
+    coins_earned = 25
+    
+    with transaction.atomic():
+        # One conditional UPDATE, so two tabs can't both claim today's bonus
+        row = coins.credit(
+            request.user,
+            coins_earned,
+            'daily_login',
+            lambda row: f"Daily login bonus - Day {row['login_streak']}",
+            when=~Q(last_login_date=today),
+            returning=('coins', 'login_streak'),
+            login_streak=Case(
+                When(last_login_date=today - timedelta(days=1), then=F('login_streak') + 1),
+                default=Value(1)
+            ),
+            last_login_date=today
         )
+        if row is not None:
+            # Record challenge completion
+            DailyChallenge.objects.get_or_create(
+                user=request.user,
+                challenge_type='daily_login',
+                completed_date=today,
+                defaults={'coins_earned': coins_earned}
+            )
+    
+    if row is not None:
+        publish_coin_progress(request.user.id, load_coin_progress(request.user.id))
         
         return JsonResponse({
             'success': True,
             'coins_earned': coins_earned,
-            'total_coins': profile.coins,
-            'streak': profile.login_streak,
+            'total_coins': row['coins'],
+            'streak': row['login_streak'],
             'message': f'Daily login bonus: +{coins_earned} coins! 🎉'
         })
     
@@ -155,14 +184,8 @@ def record_chat_friend(request):
         
         try:
             friend = User.objects.get(username=friend_username)
-            profile = request.user.userprofile
             today = date.today()
             
-            # Reset daily count if it's a new day
-            if profile.friends_challenge_date != today:
-                profile.daily_friends_made = 0
-                profile.friends_challenge_date = today
-            
             # Record this chat interaction
             chat_record, created = UserChatHistory.objects.get_or_create(
                 user=request.user,
@@ -171,58 +194,60 @@ def record_chat_friend(request):
             )
             
             if created:
-                profile.daily_friends_made += 1
-                profile.save()
+                # Counted in the database; the count restarts on a new day
+                friends_made = coins.update_profile(
+                    request.user,
+                    returning=('daily_friends_made',),
+                    daily_friends_made=Case(
+                        When(friends_challenge_date=today, then=F('daily_friends_made') + 1),
+                        default=Value(1)
+                    ),
+                    friends_challenge_date=today
+                )['daily_friends_made']
                 
                 # Check if challenge completed (5 new friends)
-                if profile.daily_friends_made >= 5:
-                    # Check if already rewarded today
-                    challenge_exists = DailyChallenge.objects.filter(
-                        user=request.user,
-                        challenge_type='make_friends',
-                        completed_date=today
-                    ).exists()
-                    
-                    if not challenge_exists:
-                        coins_earned = 60
-                        profile.coins += coins_earned
-                        profile.total_coins_earned += coins_earned
-                        profile.save()
-                        
-                        # Record challenge completion
-                        DailyChallenge.objects.create(
+                if friends_made >= 5:
+                    coins_earned = 60
+                    with transaction.atomic():
+                        # The unique (user, type, date) row is the claim, so
+                        # the reward is paid at most once a day
+                        challenge, challenge_created = DailyChallenge.objects.get_or_create(
                             user=request.user,
                             challenge_type='make_friends',
                             completed_date=today,
-                            coins_earned=coins_earned
-                        )
-                        
-                        # Record transaction
-                        CoinTransaction.objects.create(
-                            user=request.user,
-                            amount=coins_earned,
-                            transaction_type='make_friends',
-                            description='Made 5 new friends in stranger chat!'
+                            defaults={'coins_earned': coins_earned}
                         )
+                        if challenge_created:
+                            row = coins.credit(
+                                request.user,
+                                coins_earned,
+                                'make_friends',
+                                'Made 5 new friends in stranger chat!'
+                            )
+                    
+                    if challenge_created:
+                        publish_coin_progress(request.user.id, load_coin_progress(request.user.id))
                         
                         return JsonResponse({
                             'success': True,
                             'challenge_completed': True,
                             'coins_earned': coins_earned,
-                            'total_coins': profile.coins,
-                            'friends_count': profile.daily_friends_made,
+                            'total_coins': row['coins'],
+                            'friends_count': friends_made,
                             'message': 'Challenge completed! Made 5 new friends: +60 coins! 🎉'
                         })
                 
+                publish_coin_progress(request.user.id, load_coin_progress(request.user.id))
                 return JsonResponse({
                     'success': True,
-                    'friends_count': profile.daily_friends_made,
-                    'message': f'New friend added! Progress: {profile.daily_friends_made}/5'
+                    'friends_count': friends_made,
+                    'message': f'New friend added! Progress: {friends_made}/5'
                 })
             
+            profile = request.user.userprofile
             return JsonResponse({
                 'success': True,
-                'friends_count': profile.daily_friends_made,
+                'friends_count': profile.daily_friends_made if profile.friends_challenge_date == today else 0,
                 'message': 'Already chatted with this friend today'
             })
             
@@ -238,58 +263,50 @@ def coin_center(request):
     today = date.today()
     
     # Get today's challenges status
-    daily_login_completed = DailyChallenge.objects.filter(
-        user=request.user,
-        challenge_type='daily_login',
-        completed_date=today
-    ).exists()
-    
-    friends_challenge_completed = DailyChallenge.objects.filter(
+    completed_today = set(DailyChallenge.objects.filter(
         user=request.user,
-        challenge_type='make_friends',
         completed_date=today
-    ).exists()
+    ).values_list('challenge_type', flat=True))
+    daily_login_completed = 'daily_login' in completed_today
+    friends_challenge_completed = 'make_friends' in completed_today
     
     # Reset daily friends count if new day
     if profile.friends_challenge_date != today:
         profile.daily_friends_made = 0
         profile.friends_challenge_date = today
-        profile.save()
+        profile.save(update_fields=['daily_friends_made', 'friends_challenge_date'])
     
-    # Weekly coin summary (last 7 days)
+    # The last 7 days of earnings, from the daily rollup in one range read
     week_ago = today - timedelta(days=7)
-    weekly_transactions = CoinTransaction.objects.filter(
+    daily_totals = CoinDailyTotal.objects.filter(
         user=request.user,
-        timestamp__gte=week_ago,
-        amount__gt=0  # Only positive transactions
+        day__gte=week_ago,
+        total__gt=0  # Only earnings
     )
     
-    weekly_summary = weekly_transactions.values('transaction_type').annotate(
-        total_coins=Sum('amount'),
-        count=Count('id')
-    )
+    # Weekly coin summary
+    weekly = {}
+    earned_on = {}
+    for rollup in daily_totals:
+        summary = weekly.setdefault(
+            rollup.transaction_type,
+            CoinDailyTotal(transaction_type=rollup.transaction_type)
+        )
+        summary.total += rollup.total
+        summary.count += rollup.count
+        earned_on[rollup.day] = earned_on.get(rollup.day, 0) + rollup.total
+    weekly_summary = list(weekly.values())
     
     # Recent transactions (last 10)
     recent_transactions = CoinTransaction.objects.filter(
         user=request.user
     )[:10]
     
-    # Daily progress this week
-    daily_progress = []
-    for i in range(7):
-        day = today - timedelta(days=i)
-        day_transactions = CoinTransaction.objects.filter(
-            user=request.user,
-            timestamp__date=day,
-            amount__gt=0
-        ).aggregate(total=Sum('amount'))
-        
-        daily_progress.append({
-            'date': day,
-            'coins': day_transactions['total'] or 0
-        })
-    
-    daily_progress.reverse()  # Show oldest to newest
+    # Daily progress this week, oldest to newest
+    daily_progress = [
+        {'date': day, 'coins': earned_on.get(day, 0)}
+        for day in (today - timedelta(days=i) for i in range(6, -1, -1))
+    ]
     
     context = {
         'profile': profile,
@@ -299,43 +316,23 @@ def coin_center(request):
         'weekly_summary': weekly_summary,
         'recent_transactions': recent_transactions,
         'daily_progress': daily_progress,
-        'login_streak': profile.login_streak
+        'login_streak': profile.login_streak,
+        # Top earners and the user's own rank, read from the in-memory boards
+        'leaderboards': leaderboard.standings(request.user)
     }
     
     return render(request, 'coin_center.html', context)
 
+def coin_progress_etag(request):
+    # The payload resets at midnight, so the day is part of the version
+    return f"{get_version(coins_version_key(request.user.id))}-{date.today().isoformat()}"
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=coin_progress_etag)
 def get_coin_progress(request):
     """API endpoint for coin progress (for navigation bar)"""
-    profile = request.user.userprofile
-    today = date.today()
-    
-    # Check challenge status
-    daily_login_completed = DailyChallenge.objects.filter(
-        user=request.user,
-        challenge_type='daily_login',
-        completed_date=today
-    ).exists()
-    
-    friends_challenge_completed = DailyChallenge.objects.filter(
-        user=request.user,
-        challenge_type='make_friends',
-        completed_date=today
-    ).exists()
-    
-    # Reset friends count if new day
-    if profile.friends_challenge_date != today:
-        profile.daily_friends_made = 0
-        profile.friends_challenge_date = today
-        profile.save()
-    
-    return JsonResponse({
-        'total_coins': profile.coins,
-        'daily_login_completed': daily_login_completed,
-        'friends_progress': profile.daily_friends_made,
-        'friends_challenge_completed': friends_challenge_completed,
-        'login_streak': profile.login_streak
-    })
+    return JsonResponse(get_coin_progress_payload(request.user))
 
 @login_required
 @csrf_exempt
@@ -345,32 +342,45 @@ def buy_item(request):
         item_id = data.get('item_id')
         quantity = data.get('quantity', 1)
         
+        try:
+            quantity = int(quantity)
+        except (TypeError, ValueError):
+            quantity = 0
+        if quantity < 1:
+            return JsonResponse({'success': False, 'message': 'Invalid quantity'})
+        
         try:
             item = Item.objects.get(id=item_id)
-            user_profile = request.user.userprofile
             total_price = item.price * quantity
             
-            if user_profile.coins >= total_price:
-                user_profile.coins -= total_price
-                user_profile.save()
-                
-                Purchase.objects.create(
-                    user=request.user,
-                    item=item,
-                    quantity=quantity,
-                    total_price=total_price
-                )
-                
-                return JsonResponse({
-                    'success': True,
-                    'message': f'Enjoyed {item.name}! {item.emoji}',
-                    'coins': user_profile.coins
-                })
-            else:
+            try:
+                with transaction.atomic():
+                    # Debit and purchase commit together, or not at all
+                    row = coins.debit(
+                        request.user,
+                        total_price,
+                        'purchase',
+                        f'Bought {quantity}x {item.name}'
+                    )
+                    Purchase.objects.create(
+                        user=request.user,
+                        item=item,
+                        quantity=quantity,
+                        total_price=total_price
+                    )
+                    inventory.add(request.user, item, quantity)
+            except coins.InsufficientCoins:
                 return JsonResponse({
                     'success': False,
                     'message': 'Not enough coins!'
                 })
+            publish_coin_progress(request.user.id, load_coin_progress(request.user.id))
+            
+            return JsonResponse({
+                'success': True,
+                'message': f'Enjoyed {item.name}! {item.emoji}',
+                'coins': row['coins']
+            })
         except Item.DoesNotExist:
             return JsonResponse({
                 'success': False,
@@ -379,6 +389,32 @@ def buy_item(request):
     
     return JsonResponse({'success': False, 'message': 'Invalid request'})
 
+@login_required
+@csrf_exempt
+def checkout(request):
+    """Buy every line of a cart at once: {"items": [{"item_id": 1, "quantity": 2}, ...]}"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request'})
+    
+    try:
+        data = json.loads(request.body)
+        quantities = cart.parse_lines(data.get('items'))
+        balance, purchases = cart.checkout(request.user, quantities)
+    except (ValueError, AttributeError):
+        return JsonResponse({'success': False, 'message': 'Invalid request'})
+    except cart.InvalidCart as e:
+        return JsonResponse({'success': False, 'message': str(e)})
+    except coins.InsufficientCoins:
+        return JsonResponse({'success': False, 'message': 'Not enough coins!'})
+    publish_coin_progress(request.user.id, load_coin_progress(request.user.id))
+    
+    return JsonResponse({
+        'success': True,
+        'message': f'Enjoyed {sum(quantities.values())} items! ☕',
+        'coins': balance,
+        'spent': sum(purchase.total_price for purchase in purchases)
+    })
+
 # ========== NEW ADVANCED CHAT FEATURES ==========
 
 @login_required
@@ -399,26 +435,27 @@ def find_chat(request):
                 # User already has a stranger chat, redirect to it
                 return redirect('chat_room', room_id=existing_stranger_chat.room_id)
             
-            # Find an available stranger chat room
-            available_room = ChatRoom.objects.filter(
+            # Find an available stranger chat room (range scan on chatroom_open_idx)
+            open_rooms = ChatRoom.objects.filter(
                 room_type='stranger',
-                is_active=True
-            ).annotate(
-                participant_count=Count('participants')
-            ).filter(
-                participant_count__lt=4
+                is_active=True,
+                participant_count__lt=F('max_users')
             ).exclude(
                 participants=request.user
-            ).first()
+            )[:3]
+            
+            # The seat is claimed atomically, so try the next room if this one just filled up
+            available_room = next((room for room in open_rooms if room.add_participant(request.user)), None)
             
             if available_room:
-                available_room.participants.add(request.user)
-                ChatMessage.objects.create(
+                join_message = create_chat_message(
                     room=available_room,
                     user=request.user,
                     message_type='system',
                     content=f"{request.user.username} joined the chat"
                 )
+                publish_chat_message(join_message)
+                publish_participant_count(available_room)
                 return redirect('chat_room', room_id=available_room.room_id)
             else:
                 # Create new stranger room
@@ -428,7 +465,7 @@ def find_chat(request):
                     created_by=request.user,
                     expires_at=timezone.now() + timedelta(hours=1)  # Add expiration
                 )
-                new_room.participants.add(request.user)
+                new_room.add_participant(request.user)
                 return redirect('chat_room', room_id=new_room.room_id)
         
         elif chat_type == 'private_bench':
@@ -445,7 +482,7 @@ def find_chat(request):
                 room_type='private_bench',
                 created_by=request.user
             )
-            new_room.participants.add(request.user)
+            new_room.add_participant(request.user)
             
             messages.success(request, f'Private bench "{bench_name}" created successfully!')
             return redirect('chat_room', room_id=new_room.room_id)
@@ -487,7 +524,7 @@ def chat_room(request, room_id):
     room = get_object_or_404(ChatRoom, room_id=room_id, is_active=True)
     
     # Check if user is participant
-    if request.user not in room.participants.all():
+    if not room.has_participant(request.user):
         messages.error(request, 'You are not a participant in this room.')
         return redirect('find_chat')
     
@@ -497,18 +534,14 @@ def chat_room(request, room_id):
         expires_at__lt=timezone.now()
     ).update(is_deleted=True)
     
-    # Get non-expired messages
-    chat_messages = ChatMessage.objects.filter(
-        room=room,
-        is_deleted=False,
-        expires_at__gt=timezone.now()
-    ).select_related('user', 'shared_item').order_by('timestamp')[:50]
+    # Latest non-expired messages, oldest first
+    chat_messages = [
+        dict(message, timestamp=parse_datetime(message['timestamp']))
+        for message in get_recent_messages(room)
+    ]
     
-    # Get shareable items user has purchased
-    shareable_items = Purchase.objects.filter(
-        user=request.user,
-        item__can_be_shared=True
-    ).select_related('item')
+    # Get shareable items user still holds
+    shareable_items = inventory.holdings(request.user, shareable_only=True)
     
     # Get invite link if user is room creator and it's a private bench
     invite_link = None
@@ -555,7 +588,7 @@ def send_chat_message(request):
             room = get_object_or_404(ChatRoom, room_id=room_id)
             
             # Check if user is in the room
-            if request.user not in room.participants.all():
+            if not room.has_participant(request.user):
                 return JsonResponse({'success': False, 'error': 'You are not in this chat room'})
             
             # Handle item sharing
@@ -563,12 +596,13 @@ def send_chat_message(request):
                 return handle_item_sharing(request, room, shared_item_id)
             
             # Create regular text message
-            message = ChatMessage.objects.create(
+            message = create_chat_message(
                 user=request.user,
                 room=room,
                 content=content,
                 message_type=message_type
             )
+            publish_chat_message(message)
             
             return JsonResponse({
                 'success': True,
@@ -587,54 +621,47 @@ def send_chat_message(request):
     return JsonResponse({'success': False, 'error': 'Invalid request method'})
 
 def handle_item_sharing(request, room, shared_item_id):
-    """Handle sharing items from user's purchases"""
+    """Handle sharing items from user's inventory"""
     try:
-        # Find a purchase with remaining quantity for this item
-        purchase = Purchase.objects.filter(
-            user=request.user,
-            item_id=shared_item_id,
-            remaining_quantity__gt=0
-        ).first()
-        
-        if not purchase:
-            return JsonResponse({
-                'success': False, 
-                'error': 'You don\'t have this item to share or you\'ve used all of them'
-            })
-        
-        # Share the item (decreases remaining_quantity)
-        if purchase.share_item():
+        # The item only leaves the inventory if its message is written too
+        with transaction.atomic():
+            # One conditional UPDATE, so two tabs can't share the same last item
+            remaining = inventory.share(request.user, shared_item_id)
+            
+            if remaining is None:
+                return JsonResponse({
+                    'success': False, 
+                    'error': 'You don\'t have this item to share or you\'ve used all of them'
+                })
+            
+            item = catalog.item(shared_item_id)
+            
             # Create chat message for shared item
-            message = ChatMessage.objects.create(
+            message = create_chat_message(
                 user=request.user,
                 room=room,
-                content=f"shared {purchase.item.name}",
+                content=f"shared {item.name}",
                 message_type='shared_item',
-                shared_item=purchase.item,
-                shared_purchase=purchase
+                shared_item=item
             )
-            
-            return JsonResponse({
-                'success': True,
-                'message': {
-                    'id': message.id,
-                    'user': message.user.username,
-                    'content': f"shared {purchase.item.name} {purchase.item.emoji}",
-                    'message_type': 'shared_item',
-                    'shared_item': {
-                        'name': purchase.item.name,
-                        'emoji': purchase.item.emoji,
-                        'description': purchase.item.description
-                    },
-                    'timestamp': message.timestamp.isoformat(),
+            publish_chat_message(message)
+        
+        return JsonResponse({
+            'success': True,
+            'message': {
+                'id': message.id,
+                'user': message.user.username,
+                'content': f"shared {item.name} {item.emoji}",
+                'message_type': 'shared_item',
+                'shared_item': {
+                    'name': item.name,
+                    'emoji': item.emoji,
+                    'description': item.description
                 },
-                'remaining_quantity': purchase.remaining_quantity
-            })
-        else:
-            return JsonResponse({
-                'success': False,
-                'error': 'Failed to share item'
-            })
+                'timestamp': message.timestamp.isoformat(),
+            },
+            'remaining_quantity': remaining
+        })
             
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)})
@@ -642,100 +669,131 @@ def handle_item_sharing(request, room, shared_item_id):
 @login_required
 def get_shareable_items(request):
     """Get user's purchasable items that can be shared"""
-    purchases = Purchase.objects.filter(
-        user=request.user,
-        remaining_quantity__gt=0
-    ).select_related('item')
-    
     shareable_items = []
-    for purchase in purchases:
+    for entry in inventory.holdings(request.user, shareable_only=True):
         shareable_items.append({
-            'id': purchase.item.id,
-            'name': purchase.item.name,
-            'emoji': purchase.item.emoji,
-            'description': purchase.item.description,
-            'remaining_quantity': purchase.remaining_quantity,
-            'purchase_id': purchase.id
+            'id': entry.item.id,
+            'name': entry.item.name,
+            'emoji': entry.item.emoji,
+            'description': entry.item.description,
+            'remaining_quantity': entry.remaining
         })
     
     return JsonResponse({'shareable_items': shareable_items})
 
+def live_messages(room):
+    # Every cursor below is a range scan on the (room, is_deleted, id) index
+    return ChatMessage.objects.filter(
+        room=room,
+        is_deleted=False
+    ).select_related('user')
+
+def load_buffered_messages(room):
+    messages = list(live_messages(room).order_by('-id')[:settings.MESSAGE_BUFFER_ROOM_SIZE])
+    # Write-behind messages are already live but may not be in the table yet
+    return messages + message_writer.pending_for(room.room_id)
+
+def get_recent_messages(room, since=0):
+    """Serialized messages newer than ``since`` (the newest page when 0), oldest first"""
+    if settings.MESSAGE_BUFFER_ENABLED:
+        cached = message_buffer.get_or_fill(
+            room.room_id,
+            since,
+            lambda: load_buffered_messages(room)
+        )
+        if cached is not None:
+            return cached[:MESSAGE_PAGE_SIZE] if since > 0 else cached[-MESSAGE_PAGE_SIZE:]
+    
+    if since > 0:
+        page = list(live_messages(room).filter(id__gt=since).order_by('id')[:MESSAGE_PAGE_SIZE])
+    else:
+        page = list(live_messages(room).order_by('-id')[:MESSAGE_PAGE_SIZE])
+        page.reverse()
+    return [msg.to_dict() for msg in page]
+
+def get_messages_payload(room, since=0, before=0):
+    """Build the get_chat_messages response body for a room and cursor"""
+    if before > 0:
+        # Scrollback is rare, so it always reads the database
+        page = list(live_messages(room).filter(id__lt=before).order_by('-id')[:MESSAGE_PAGE_SIZE])
+        page.reverse()
+        messages_data = [msg.to_dict() for msg in page]
+    else:
+        messages_data = get_recent_messages(room, since)
+        if since > 0 and not messages_data:
+            # Nothing new - keep the common poll as small as possible
+            return {'success': True, 'messages': []}
+    
+    return {
+        'success': True,
+        'messages': messages_data,
+        'has_more': len(messages_data) == MESSAGE_PAGE_SIZE,
+        'room_info': {
+            'name': room.get_display_name(),
+            'type': room.room_type,
+            'participant_count': room.participant_count
+        }
+    }
+
+def chat_messages_etag(request, room_id):
+    # No ETag for requests answered with an error instead of the room's messages
+    try:
+        since = int(request.GET.get('since') or 0)
+        before = int(request.GET.get('before') or 0)
+    except ValueError:
+        return None
+    if not ChatRoom.participants.through.objects.filter(
+        chatroom__room_id=room_id,
+        user_id=request.user.pk
+    ).exists():
+        return None
+    return f"{get_version(room_version_key(room_id))}-{since}-{before}"
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=chat_messages_etag)
 def get_chat_messages(request, room_id):
+    """Return room messages using id cursors.
+
+    ``?since=<id>`` returns messages newer than that id (oldest first) and
+    ``?before=<id>`` returns the page older than it for scrollback. With no
+    cursor the newest page is returned.
+    """
     try:
         room = get_object_or_404(ChatRoom, room_id=room_id)
         
         # Check if user is in the room
-        if request.user not in room.participants.all():
+        if not room.has_participant(request.user):
             return JsonResponse({'success': False, 'error': 'Access denied'})
         
-        # Get non-deleted messages
-        messages = ChatMessage.objects.filter(
-            room=room,
-            is_deleted=False
-        ).select_related('user', 'shared_item').order_by('-timestamp')[:50]
-        
-        messages_data = []
-        for msg in reversed(messages):
-            message_data = {
-                'id': msg.id,
-                'user': msg.user.username,
-                'content': msg.content,
-                'message_type': msg.message_type,
-                'timestamp': msg.timestamp.isoformat(),
-            }
-            
-            # Add shared item data if applicable
-            if msg.message_type == 'shared_item' and msg.shared_item:
-                message_data['shared_item'] = {
-                    'name': msg.shared_item.name,
-                    'emoji': msg.shared_item.emoji,
-                    'description': msg.shared_item.description
-                }
-            
-            messages_data.append(message_data)
+        try:
+            since = int(request.GET.get('since') or 0)
+            before = int(request.GET.get('before') or 0)
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Invalid cursor'})
         
-        return JsonResponse({
-            'success': True,
-            'messages': messages_data,
-            'room_info': {
-                'name': room.get_display_name(),
-                'type': room.room_type,
-                'participant_count': room.participants.count()
-            }
-        })
+        return JsonResponse(get_messages_payload(room, since=since, before=before))
         
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)})
 
 @login_required
 def profile(request):
-    # Get user's purchases with remaining quantities
+    # What the user holds of each item, one row per item
+    holdings = list(inventory.holdings(request.user))
+    
+    # Latest purchases only; the totals come from the inventory
     purchases = Purchase.objects.filter(
         user=request.user
-    ).select_related('item').order_by('-timestamp')
-    
-    # Group purchases by item and sum quantities
-    purchase_summary = {}
-    for purchase in purchases:
-        item_id = purchase.item.id
-        if item_id not in purchase_summary:
-            purchase_summary[item_id] = {
-                'item': purchase.item,
-                'total_purchased': 0,
-                'total_remaining': 0,
-                'total_shared': 0,
-                'purchases': []
-            }
-        
-        purchase_summary[item_id]['total_purchased'] += purchase.quantity
-        purchase_summary[item_id]['total_remaining'] += purchase.remaining_quantity
-        purchase_summary[item_id]['total_shared'] += (purchase.quantity - purchase.remaining_quantity)
-        purchase_summary[item_id]['purchases'].append(purchase)
+    ).select_related('item').order_by('-timestamp')[:20]
     
     context = {
         'purchases': purchases,
-        'purchase_summary': purchase_summary.values()
+        'inventory': holdings,
+        'available_items': [entry for entry in holdings if entry.remaining > 0 and entry.item.can_be_shared],
+        'total_purchases': sum(entry.owned for entry in holdings),
+        'total_shared': sum(entry.shared for entry in holdings),
+        'leaderboards': leaderboard.standings(request.user, limit=5)
     }
     return render(request, 'profile.html', context)
 
@@ -783,7 +841,8 @@ def accept_invitation(request, invitation_id):
     
     room = invitation.room
     
-    if room.participants.count() >= room.max_users:
+    # Add user to room, if there is still a seat
+    if not room.add_participant(request.user):
         messages.error(request, 'This chat room is full.')
         return redirect('find_chat')
     
@@ -791,11 +850,8 @@ def accept_invitation(request, invitation_id):
     invitation.status = 'accepted'
     invitation.save()
     
-    # Add user to room
-    room.participants.add(request.user)
-    
     # Send system message
-    ChatMessage.objects.create(
+    create_chat_message(
         room=room,
         user=request.user,
         message_type='system',
@@ -826,21 +882,21 @@ def leave_chat(request, room_id):
     """Leave a chat room"""
     room = get_object_or_404(ChatRoom, room_id=room_id)
     
-    if request.user in room.participants.all():
-        room.participants.remove(request.user)
-        
+    if room.remove_participant(request.user):
         # Send system message
-        ChatMessage.objects.create(
+        leave_message = create_chat_message(
             room=room,
             user=request.user,
             message_type='system',
             content=f"{request.user.username} left the chat"
         )
+        publish_chat_message(leave_message)
+        publish_participant_count(room)
         
         # If room is empty, deactivate it
-        if room.participants.count() == 0:
+        if room.participant_count == 0:
             room.is_active = False
-            room.save()
+            room.save(update_fields=['is_active'])
     
     messages.info(request, 'You left the chat room.')
     return redirect('find_chat')
@@ -892,12 +948,69 @@ def cleanup_expired_content(request):
         'message': f'Cleaned up {deleted_count} expired messages and {rooms_deleted} empty rooms'
     })
 
+@login_required
+def message_buffer_stats(request):
+    """Hit/miss counters for the in-process message buffer"""
+    if not request.user.is_staff:
+        return JsonResponse({'success': False, 'message': 'Not authorized'})
+    
+    return JsonResponse({
+        'success': True,
+        'enabled': settings.MESSAGE_BUFFER_ENABLED,
+        'stats': message_buffer.stats()
+    })
+
+@login_required
+def presence_stats(request):
+    """How many last_activity writes the presence throttle is saving"""
+    if not request.user.is_staff:
+        return JsonResponse({'success': False, 'message': 'Not authorized'})
+    
+    return JsonResponse({
+        'success': True,
+        'throttle_seconds': settings.PRESENCE_THROTTLE_SECONDS,
+        'stats': presence.stats()
+    })
+
+@login_required
+def matchmaking_stats(request):
+    """Stranger queue arrival/match rates and time-to-match quantiles"""
+    if not request.user.is_staff:
+        return JsonResponse({'success': False, 'message': 'Not authorized'})
+    
+    return JsonResponse({
+        'success': True,
+        'window_seconds': settings.MATCH_RATE_WINDOW,
+        'stats': wait_estimator.stats(),
+        'room_pool': room_pool.stats()
+    })
+
+@login_required
+def leaderboard_stats(request):
+    """Check the leaderboards against the database; POST rebuilds them first"""
+    if not request.user.is_staff:
+        return JsonResponse({'success': False, 'message': 'Not authorized'})
+    
+    # The local backend lives in each web process, so this has to run here
+    # rather than in the rebuild_leaderboard command
+    rebuilt = leaderboard.rebuild() if request.method == 'POST' else None
+    boards = {}
+    for board in leaderboard.BOARDS:
+        mismatches = leaderboard.check(board)
+        boards[board] = {
+            'users': leaderboard.leaderboard.size(leaderboard.board_key(board)),
+            'mismatches': len(mismatches),
+            'sample': mismatches[:20],
+        }
+    
+    return JsonResponse({'success': True, 'rebuilt': rebuilt, 'boards': boards})
+
 @login_required
 def toggle_chat_availability(request):
     """Toggle user's availability for chat invitations"""
     profile = request.user.userprofile
     profile.is_available_for_chat = not profile.is_available_for_chat
-    profile.save()
+    profile.save(update_fields=['is_available_for_chat'])
     
     status = "available" if profile.is_available_for_chat else "unavailable"
     messages.success(request, f'Chat availability set to {status}.')
@@ -958,10 +1071,7 @@ def find_stranger_chat(request):
     in_queue = StrangerChatQueue.objects.filter(user=request.user).exists()
     
     # Get online users count (excluding current user)
-    online_users_count = UserProfile.objects.filter(
-        is_online=True,
-        last_activity__gte=timezone.now() - timedelta(minutes=5)
-    ).exclude(user=request.user).count()
+    online_users_count = count_online_users(exclude_user=request.user)
     
     context = {
         'in_queue': in_queue,
@@ -972,115 +1082,52 @@ def find_stranger_chat(request):
 
 def handle_stranger_chat_request(request):
     """Handle stranger chat matching with comprehensive error handling"""
-    profile = request.user.userprofile
-    profile.looking_for_stranger_chat = True
-    profile.save()
+    UserProfile.objects.filter(user=request.user).update(looking_for_stranger_chat=True)
     
     try:
-        with transaction.atomic():
-            # Clean up expired queue entries
-            StrangerChatQueue.objects.filter(
-                joined_at__lt=timezone.now() - timedelta(minutes=10)
-            ).delete()
-            
-            # Check if user already in queue
-            queue_entry, created = StrangerChatQueue.objects.get_or_create(
-                user=request.user,
-                defaults={'connection_attempts': 0}
-            )
-            
-            if not created:
-                queue_entry.connection_attempts += 1
-                queue_entry.last_attempt = timezone.now()
-                queue_entry.save()
-            
-            # Find available online users
-            available_users = find_available_online_users(request.user)
-            
-            if not available_users:
-                return handle_no_users_available(request, queue_entry)
-            
-            # Try to match with another user in queue
-            matched_user = find_queue_match(request.user)
-            
-            if matched_user:
-                return create_stranger_chat_room(request, matched_user)
-            else:
-                return wait_for_match(request, queue_entry, available_users)
+        # Entries older than StrangerChatQueue.TTL are never matched, so stale
+        # ones need no sweep here; the cleanup_inactive_users task deletes
+        # them every 5 minutes
+        queue_entry = matchmaking.enqueue(request.user)
+        if settings.STRANGER_ROOM_POOL:
+            room_pool.start()
+        
+        if settings.STRANGER_BATCH_MATCHER:
+            # The matcher pairs us; the client learns the room from check_match_status
+            matchmaking.batch_matcher.start()
+            matchmaking.batch_matcher.wake()
+            chat_room = None
+        else:
+            chat_room = matchmaking.find_match(request.user)
+        
+        if chat_room:
+            messages.success(request, f'Connected with a stranger! Enjoy your chat! ☕')
+            return redirect('chat_room', room_id=chat_room.room_id)
+        
+        online_count = count_online_users(exclude_user=request.user)
+        if not online_count:
+            return handle_no_users_available(request, queue_entry)
+        
+        return wait_for_match(request, queue_entry, online_count)
                 
     except Exception as e:
         return handle_connection_error(request, str(e))
 
-def find_available_online_users(current_user):
-    """Find users who are online and available for stranger chat"""
-    return User.objects.filter(
-        userprofile__is_online=True,
-        userprofile__is_available_for_chat=True,
-        userprofile__last_activity__gte=timezone.now() - timedelta(minutes=5)
-    ).exclude(
-        id=current_user.id
-    ).exclude(
-        # Exclude users already in active chats
-        chat_rooms__room_type='stranger',
-        chat_rooms__is_active=True
-    )
-
-def find_queue_match(current_user):
-    """Find another user in the stranger chat queue to match with"""
-    return StrangerChatQueue.objects.filter(
-        joined_at__lt=timezone.now() - timedelta(seconds=30)  # Wait 30 seconds before matching
-    ).exclude(user=current_user).first()
-
-def create_stranger_chat_room(request, matched_user_queue):
-    """Create a chat room for matched strangers"""
-    matched_user = matched_user_queue.user
-    
-    # Create chat room
-    chat_room = ChatRoom.objects.create(
-        name=f"Stranger Chat {timezone.now().strftime('%H:%M')}",
-        room_type='stranger',
-        created_by=request.user,
-        expires_at=timezone.now() + timedelta(hours=1)
-    )
-    
-    # Add both users to the room
-    chat_room.participants.add(request.user, matched_user)
-    
-    # Remove both users from queue
-    StrangerChatQueue.objects.filter(
-        user__in=[request.user, matched_user]
-    ).delete()
-    
-    # Update profiles
-    for user in [request.user, matched_user]:
-        profile = user.userprofile
-        profile.looking_for_stranger_chat = False
-        profile.save()
-    
-    # Send system messages
-    ChatMessage.objects.create(
-        room=chat_room,
-        user=request.user,
-        message_type='system',
-        content=f"Connected with {matched_user.username}! Say hello! 👋"
-    )
-    
-    messages.success(request, f'Connected with a stranger! Enjoy your chat! ☕')
-    return redirect('chat_room', room_id=chat_room.room_id)
-
-def wait_for_match(request, queue_entry, available_users):
+def wait_for_match(request, queue_entry, online_count):
     """Handle waiting state when no immediate match is available"""
     wait_time = (timezone.now() - queue_entry.joined_at).total_seconds()
     
     if wait_time > 300:  # 5 minutes
         return handle_timeout(request, queue_entry)
     
+    estimate = wait_estimator.estimate(request.user.id)
     return JsonResponse({
         'status': 'waiting',
-        'message': f'Looking for strangers... {len(available_users)} users online',
+        'message': f'Looking for strangers... {online_count} users online',
         'wait_time': int(wait_time),
-        'online_count': len(available_users),
-        'estimated_wait': '30-60 seconds'
+        'online_count': online_count,
+        'estimated_wait': describe_wait(estimate['estimated_wait_seconds']),
+        **estimate
     })
 
 def handle_no_users_available(request, queue_entry):
@@ -1110,18 +1157,23 @@ def handle_no_users_available(request, queue_entry):
 
 def handle_timeout(request, queue_entry):
     """Handle search timeout"""
+    return JsonResponse(expire_search(request.user, queue_entry))
+
+def expire_search(user, queue_entry):
+    """Drop a user's queue entry after too long a wait"""
     queue_entry.delete()
+    wait_estimator.left(user.id)
     
-    profile = request.user.userprofile
+    profile = user.userprofile
     profile.looking_for_stranger_chat = False
-    profile.save()
+    profile.save(update_fields=['looking_for_stranger_chat'])
     
-    return JsonResponse({
+    return {
         'status': 'timeout',
         'message': 'Search timed out. No strangers found.',
         'suggestion': 'Try again or create a private bench',
         'action': 'timeout'
-    })
+    }
 
 def handle_connection_error(request, error_message):
     """Handle connection errors"""
@@ -1137,62 +1189,95 @@ def handle_connection_error(request, error_message):
 def cancel_stranger_search(request):
     """Cancel stranger chat search"""
     StrangerChatQueue.objects.filter(user=request.user).delete()
+    wait_estimator.left(request.user.id)
     
     profile = request.user.userprofile
     profile.looking_for_stranger_chat = False
-    profile.save()
+    profile.save(update_fields=['looking_for_stranger_chat'])
     
     messages.info(request, 'Search cancelled.')
     return redirect('find_chat')
 
+def match_status_etag(request):
+    bucket = int(timezone.now().timestamp()) // MATCH_STATUS_ETAG_SECONDS
+    return f"{get_version(match_version_key(request.user.id))}-{bucket}"
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=match_status_etag)
 def check_match_status(request):
     """API endpoint to check if a match has been found"""
-    try:
-        queue_entry = StrangerChatQueue.objects.get(user=request.user)
-        
-        # Check if user has been matched (removed from queue but has active chat)
-        active_chat = ChatRoom.objects.filter(
-            participants=request.user,
+    return JsonResponse(get_match_status(request.user))
+
+def get_match_status(user):
+    """Where a searching user stands, shared by the poll and long-poll endpoints"""
+    queue_entry = StrangerChatQueue.objects.filter(user=user).first()
+    
+    if queue_entry is None:
+        # Matching removes both users from the queue, so the partner who
+        # didn't make the request finds out through the fresh room instead
+        recent_chat = ChatRoom.objects.filter(
+            participants=user,
             room_type='stranger',
             is_active=True,
-            created_at__gte=queue_entry.joined_at
-        ).first()
+            created_at__gte=timezone.now() - MATCH_NOTICE_WINDOW
+        ).order_by('-created_at').first()
         
-        if active_chat:
-            return JsonResponse({
+        if recent_chat:
+            return {
                 'status': 'matched',
-                'room_id': str(active_chat.room_id),
+                'room_id': str(recent_chat.room_id),
                 'message': 'Match found! Redirecting to chat...'
-            })
-        
-        # Still waiting
-        wait_time = (timezone.now() - queue_entry.joined_at).total_seconds()
-        online_count = find_available_online_users(request.user).count()
-        
-        if wait_time > 300:  # 5 minutes timeout
-            return handle_timeout(request, queue_entry)
-        
-        return JsonResponse({
-            'status': 'waiting',
-            'wait_time': int(wait_time),
-            'online_count': online_count,
-            'message': f'Searching... {online_count} users online'
-        })
+            }
         
-    except StrangerChatQueue.DoesNotExist:
-        return JsonResponse({
+        return {
             'status': 'not_searching',
             'message': 'Not currently searching'
-        })
+        }
+    
+    # Check if user has been matched (removed from queue but has active chat)
+    active_chat = ChatRoom.objects.filter(
+        participants=user,
+        room_type='stranger',
+        is_active=True,
+        created_at__gte=queue_entry.joined_at
+    ).first()
+    
+    if active_chat:
+        return {
+            'status': 'matched',
+            'room_id': str(active_chat.room_id),
+            'message': 'Match found! Redirecting to chat...'
+        }
+    
+    # Still waiting
+    wait_time = (timezone.now() - queue_entry.joined_at).total_seconds()
+    
+    if wait_time > 300:  # 5 minutes timeout
+        return expire_search(user, queue_entry)
+    
+    online_count = count_online_users(exclude_user=user)
+    estimate = wait_estimator.estimate(user.id)
+    
+    return {
+        'status': 'waiting',
+        'wait_time': int(wait_time),
+        'online_count': online_count,
+        'message': f'Searching... {online_count} users online',
+        'estimated_wait': describe_wait(estimate['estimated_wait_seconds']),
+        **estimate
+    }
+
+def online_status_etag(request):
+    return f"online-{online_users.count()}"
 
+# A background counter on every page, not a sign the user is doing anything
+@presence_exempt
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=online_status_etag)
 def get_online_status(request):
-    from .models import UserProfile
-    online_users = UserProfile.objects.filter(
-        is_online=True,
-        last_activity__gte=timezone.now() - timezone.timedelta(minutes=5)
-    ).exclude(user=request.user).count()
+    online_users = count_online_users(exclude_user=request.user)
     in_queue = False  # Alternatively, check StrangerChatQueue for the user
     return JsonResponse({
         "online_users": online_users,
@@ -1200,8 +1285,16 @@ def get_online_status(request):
         "timestamp": timezone.now().isoformat(),
     })
 
+def count_online_users(exclude_user=None):
+    """Users active within the last 5 minutes, from the presence registry"""
+    count = online_users.count()
+    if exclude_user is not None and online_users.is_online(exclude_user.id):
+        count -= 1
+    return count
+
 #for custom admin dashboard
 from .forms import ItemForm, AssignChallengeForm
+from .tasks import assign_daily_challenge
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login
 
@@ -1272,25 +1365,37 @@ def manage_challenges(request):
 
 @login_required
 def assign_challenge(request):
+    if not request.user.is_staff:
+        return redirect('custom_admin_login')
     if request.method == "POST":
         form = AssignChallengeForm(request.POST)
         if form.is_valid():
-            challenge_type = form.cleaned_data["challenge_type"]
-            coins_earned = form.cleaned_data["coins_earned"]
-            today = timezone.now().date()
-            created = 0
-            for user in User.objects.all():
-                challenges = DailyChallenge.objects.filter(user=user, challenge_type=challenge_type, completed_date=today)
-                if not challenges.exists():
-                    DailyChallenge.objects.create(
-                        user=user,
-                        challenge_type=challenge_type,
-                        completed_date=today,
-                        coins_earned=coins_earned,
-                    )
-                    created += 1
-            messages.success(request, f"Assigned {challenge_type} to {created} users for today.")
-            return redirect('manage_challenges')
+            job_id = uuid.uuid4().hex
+            ChallengeJob.objects.create(
+                job_id=job_id,
+                challenge_type=form.cleaned_data["challenge_type"],
+                coins_earned=form.cleaned_data["coins_earned"],
+                day=timezone.now().date()
+            )
+            # Runs on a Celery worker (inline when no broker is configured)
+            assign_daily_challenge.delay(
+                job_id,
+                form.cleaned_data["challenge_type"],
+                form.cleaned_data["coins_earned"],
+                timezone.now().date().isoformat()
+            )
+            return redirect('challenge_job', job_id=job_id)
     else:
         form = AssignChallengeForm()
     return render(request, "custom_admin/assign_challenges.html", {"form": form})
+
+@login_required
+def challenge_job(request, job_id):
+    """Progress of a challenge assignment job"""
+    if not request.user.is_staff:
+        return redirect('custom_admin_login')
+    job = get_object_or_404(ChallengeJob, job_id=job_id)
+    percent = None
+    if job.total:
+        percent = int(job.processed * 100 / job.total)
+    return render(request, "custom_admin/challenge_job.html", {"job": job, "percent": percent})
@@ -0,0 +1,257 @@
+import bisect
+import math
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+
+class DecayingRate:
+    """Events per second, exponentially weighted over ``window`` seconds.
+
+    Until a full window has passed the weights are divided by the part of
+    the window seen so far, so a fresh process isn't biased towards zero.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._weight = 0.0
+        self._at = None
+        self._started = None
+
+    def add(self, now, count=1):
+        if self._started is None:
+            self._started = now
+        self._weight = self._decayed(now) + count
+        self._at = now
+
+    def _decayed(self, now):
+        if self._at is None:
+            return 0.0
+        return self._weight * math.exp(-(now - self._at) / self.window)
+
+    def value(self, now):
+        if self._started is None:
+            return 0.0
+        elapsed = max(now - self._started, 1.0)
+        return self._decayed(now) / (self.window * (1 - math.exp(-elapsed / self.window)))
+
+
+class DecayingHistogram:
+    """Streaming quantile sketch: log-spaced buckets whose counts fade.
+
+    Each bucket is 1.5x wider than the last, so quantiles are within about
+    25% of the true value; old samples lose half their weight every
+    ``half_life`` seconds. Adding and querying are O(number of buckets).
+    """
+
+    def __init__(self, half_life, smallest=0.25, largest=900):
+        self.half_life = half_life
+        self.edges = []
+        edge = smallest
+        while edge < largest:
+            self.edges.append(edge)
+            edge *= 1.5
+        self.counts = [0.0] * (len(self.edges) + 1)
+        self._at = None
+
+    def _decay(self, now):
+        if self._at is not None and now > self._at:
+            factor = 0.5 ** ((now - self._at) / self.half_life)
+            self.counts = [count * factor for count in self.counts]
+        self._at = now
+
+    def add(self, now, value):
+        self._decay(now)
+        self.counts[bisect.bisect_left(self.edges, value)] += 1
+
+    def quantile(self, now, q):
+        self._decay(now)
+        total = sum(self.counts)
+        if total < 1:
+            return None
+        target = q * total
+        seen = 0.0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.edges[min(index, len(self.edges) - 1)]
+        return self.edges[-1]
+
+
+class TicketLine:
+    """The tickets still waiting, counted in a Fenwick tree.
+
+    Tickets are handed out in increasing order and indexed from the oldest
+    one still waiting, so the number ahead of a ticket is O(log n) however
+    many have left out of turn. Adding, removing and counting are
+    O(log n); the tree is rebuilt, O(n), when a new ticket doesn't fit.
+    """
+
+    def __init__(self):
+        self._base = 1
+        self._present = bytearray(64)
+        self._tree = [0] * 65
+
+    def _index(self, ticket):
+        return ticket - self._base + 1
+
+    def _update(self, index, delta):
+        while index < len(self._tree):
+            self._tree[index] += delta
+            index += index & -index
+
+    def _rebuild(self, ticket):
+        live = [self._base + i for i, present in enumerate(self._present) if present]
+        self._base = live[0] if live else ticket
+        size = 64
+        while size < 2 * (ticket - self._base + 1):
+            size *= 2
+        self._present = bytearray(size)
+        self._tree = [0] * (size + 1)
+        for live_ticket in live:
+            self._present[live_ticket - self._base] = 1
+            self._tree[live_ticket - self._base + 1] = 1
+        for index in range(1, size + 1):
+            parent = index + (index & -index)
+            if parent <= size:
+                self._tree[parent] += self._tree[index]
+
+    def add(self, ticket):
+        if self._index(ticket) > len(self._present):
+            self._rebuild(ticket)
+        self._present[ticket - self._base] = 1
+        self._update(self._index(ticket), 1)
+
+    def remove(self, ticket):
+        index = self._index(ticket)
+        if 1 <= index <= len(self._present) and self._present[index - 1]:
+            self._present[index - 1] = 0
+            self._update(index, -1)
+
+    def ahead(self, ticket):
+        """How many waiting tickets are lower than this one"""
+        index = min(self._index(ticket) - 1, len(self._present))
+        count = 0
+        while index > 0:
+            count += self._tree[index]
+            index -= index & -index
+        return count
+
+
+class WaitTimeEstimator:
+    """Rolling stranger-queue statistics fed by queue and match events.
+
+    Tracks arrival and match rates, a quantile sketch of time-to-match and
+    each waiting user's place in line, so ``estimate`` answers without
+    touching the database. Like the message buffer it only sees its own
+    process, which is where the batch matcher runs.
+    """
+
+    def __init__(self, window, half_life, queue_expiry):
+        self.queue_expiry = queue_expiry
+        self.arrivals = DecayingRate(window)
+        self.matches = DecayingRate(window)
+        self.waits = DecayingHistogram(half_life)
+        self._lock = threading.Lock()
+        # user_id -> (ticket, arrived at), in arrival order
+        self._waiting = OrderedDict()
+        self._line = TicketLine()
+        self._next_ticket = 0
+
+    def arrived(self, user_id, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            if user_id in self._waiting:
+                return
+            self._next_ticket += 1
+            self._waiting[user_id] = (self._next_ticket, now)
+            self._line.add(self._next_ticket)
+            self.arrivals.add(now)
+
+    def matched(self, user_ids, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._waiting.pop(user_id, None)
+                if entry is not None:
+                    self._line.remove(entry[0])
+                    self.waits.add(now, now - entry[1])
+            self.matches.add(now, len(user_ids))
+
+    def left(self, user_id):
+        """User cancelled or timed out"""
+        with self._lock:
+            entry = self._waiting.pop(user_id, None)
+            if entry is not None:
+                self._line.remove(entry[0])
+
+    def _prune(self, now):
+        # Entries swept by cleanup jobs never tell us they left
+        while self._waiting:
+            user_id, (ticket, arrived_at) = next(iter(self._waiting.items()))
+            if now - arrived_at < self.queue_expiry:
+                break
+            self._waiting.popitem(last=False)
+            self._line.remove(ticket)
+
+    def estimate(self, user_id, now=None):
+        """Queue position and expected remaining wait (seconds) for a user"""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._prune(now)
+            entry = self._waiting.get(user_id)
+            if entry is not None:
+                position = 1 + self._line.ahead(entry[0])
+                waited = now - entry[1]
+            else:
+                position = len(self._waiting) + 1
+                waited = 0.0
+            match_rate = self.matches.value(now)
+            typical = self.waits.quantile(now, 0.5)
+            slow = self.waits.quantile(now, 0.9)
+
+        if match_rate > 0:
+            # Users leave the queue at match_rate, oldest first
+            remaining = position / match_rate
+        elif typical is not None:
+            remaining = max(typical - waited, 0)
+        else:
+            remaining = None
+        return {
+            'queue_position': position,
+            'estimated_wait_seconds': None if remaining is None else int(math.ceil(remaining)),
+            'typical_wait_seconds': None if typical is None else int(math.ceil(typical)),
+            'slow_wait_seconds': None if slow is None else int(math.ceil(slow)),
+        }
+
+    def stats(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._prune(now)
+            return {
+                'waiting': len(self._waiting),
+                'arrivals_per_minute': round(self.arrivals.value(now) * 60, 1),
+                'matched_per_minute': round(self.matches.value(now) * 60, 1),
+                'p50_wait_seconds': self.waits.quantile(now, 0.5),
+                'p90_wait_seconds': self.waits.quantile(now, 0.9),
+            }
+
+
+wait_estimator = WaitTimeEstimator(
+    window=settings.MATCH_RATE_WINDOW,
+    half_life=settings.MATCH_RATE_WINDOW,
+    queue_expiry=600,
+)
+
+
+def describe_wait(seconds):
+    """Short human label for an estimated wait"""
+    if seconds is None:
+        return 'unknown'
+    if seconds < 10:
+        return 'a few seconds'
+    if seconds < 60:
+        return f'about {int(round(seconds, -1))} seconds'
+    minutes = int(round(seconds / 60))
+    return f"about {minutes} minute{'s' if minutes != 1 else ''}"
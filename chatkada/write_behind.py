@@ -0,0 +1,211 @@
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+
+class IdAllocator:
+    """Hands out ChatMessage ids ahead of the INSERT by reserving blocks
+    from the table's own sequence, so rows created the normal way never
+    collide with them.
+
+    A row inserted the normal way lands after the reserved block, ahead of
+    ids the block has yet to hand out, and clients read rooms by ``id >
+    since``. So while the writer is on, every chat message has to go
+    through create_chat_message() / create_chat_messages().
+    """
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self._ids = deque()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def supported():
+        return connection.vendor in ('postgresql', 'sqlite')
+
+    def next_id(self):
+        with self._lock:
+            if not self._ids:
+                self._ids.extend(self._reserve(self.block_size))
+            return self._ids.popleft()
+
+    def _reserve(self, count):
+        table = ChatMessage._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                    [table, count]
+                )
+                return [row[0] for row in cursor.fetchall()]
+
+            # SQLite AUTOINCREMENT tables keep their counter in sqlite_sequence
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM "{table}"')
+                start = cursor.fetchone()[0]
+                cursor.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)",
+                    [table, start + count]
+                )
+            else:
+                start = row[0]
+                cursor.execute(
+                    "UPDATE sqlite_sequence SET seq = %s WHERE name = %s",
+                    [start + count, table]
+                )
+            return list(range(start + 1, start + count + 1))
+
+
+class ChatMessageWriter:
+    """Write-behind persistence for chat messages.
+
+    ``submit`` gives the message its id and timestamp straight away so it
+    can be delivered, and queues the row. A background thread writes the
+    queue with ``bulk_create`` every ``max_delay`` seconds, or sooner once
+    ``batch_size`` rows are waiting. At most ``max_delay`` worth of messages
+    is lost if the process dies; a normal exit flushes whatever is left.
+
+    ``bulk_create`` re-stamps ``timestamp`` (auto_now_add), so the stored
+    time can trail the delivered one by up to ``max_delay``. Ordering is by
+    id everywhere, so nothing depends on the two matching.
+    """
+
+    def __init__(self, batch_size, max_delay, start_thread=True):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.start_thread = start_thread
+        self.ids = IdAllocator(block_size=batch_size)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._wake = threading.Event()
+        self._thread = None
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+
+    def submit(self, **fields):
+        """Build a ChatMessage, give it an id and queue it for writing"""
+        return self.queue(ChatMessage(**fields))
+
+    def queue(self, message):
+        """Give an unsaved ChatMessage its id and queue it for writing.
+
+        The row is queued once the surrounding transaction commits, so a
+        rolled back room never gets messages written for it.
+        """
+        now = timezone.now()
+        message.id = self.ids.next_id()
+        message.timestamp = now
+        # Same rule as ChatMessage.save(), without looking the room up again
+        if not message.expires_at and message.room.room_type == 'stranger':
+            message.expires_at = now + timedelta(hours=24)
+        transaction.on_commit(lambda: self._append(message))
+        return message
+
+    def _append(self, message):
+        with self._lock:
+            self._pending.append(message)
+            pending = len(self._pending)
+        if self.start_thread:
+            self._ensure_thread()
+        if pending >= self.batch_size:
+            self._wake.set()
+
+    def pending_for(self, room_id):
+        """Queued messages for a room (by ChatRoom.room_id) that aren't in the DB yet"""
+        with self._lock:
+            return [m for m in self._pending if m.room.room_id == room_id]
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                ChatMessage.objects.bulk_create(batch)
+            except Exception as e:
+                # Don't let one bad row (e.g. a deleted room) sink the batch
+                logger.error(f'Batched message write failed, retrying one by one: {str(e)}')
+                batch = self._write_individually(batch)
+            self.written += len(batch)
+            self.batches += 1
+            return len(batch)
+
+    def _write_individually(self, batch):
+        written = []
+        for message in batch:
+            try:
+                with transaction.atomic():
+                    ChatMessage.objects.bulk_create([message])
+                written.append(message)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f'Dropping chat message {message.id}: {str(e)}')
+        return written
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='chat-write-behind', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.max_delay)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f'Error in chat write-behind thread: {str(e)}')
+            finally:
+                connection.close_if_unusable_or_obsolete()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'pending': pending,
+            'written': self.written,
+            'batches': self.batches,
+            'failed': self.failed,
+        }
+
+
+message_writer = ChatMessageWriter(
+    batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+    max_delay=settings.CHAT_WRITE_BEHIND_MAX_DELAY_MS / 1000,
+)
+
+
+def write_behind_enabled():
+    return settings.CHAT_WRITE_BEHIND and IdAllocator.supported()
+
+
+def create_chat_message(**fields):
+    """Create a chat message, through the write-behind queue when it is enabled"""
+    if write_behind_enabled():
+        return message_writer.submit(**fields)
+    return ChatMessage.objects.create(**fields)
+
+
+def create_chat_messages(messages):
+    """bulk_create() for unsaved ChatMessages, through the queue when it is enabled"""
+    if write_behind_enabled():
+        return [message_writer.queue(message) for message in messages]
+    return ChatMessage.objects.bulk_create(messages)
@@ -13,4 +13,23 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chayakada.settings')
 
-application = get_asgi_application()
+# Initialize Django before importing anything that touches the models
+django_asgi_app = get_asgi_application()
+
+from channels.auth import AuthMiddlewareStack
+from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.security.websocket import AllowedHostsOriginValidator
+from django.urls import re_path
+
+from chatkada.routing import http_urlpatterns, websocket_urlpatterns
+
+application = ProtocolTypeRouter({
+    # Long-poll and SSE endpoints first (each with its own auth), everything
+    # else goes straight to Django
+    'http': URLRouter(
+        http_urlpatterns + [re_path(r'', django_asgi_app)]
+    ),
+    'websocket': AllowedHostsOriginValidator(
+        AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+    ),
+})
@@ -37,12 +37,14 @@ ALLOWED_HOSTS = config("ALLOWED_HOSTS", default="localhost,127.0.0.1", cast=lamb
 # Application definition
 
 INSTALLED_APPS = [
+    'daphne',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'channels',
     'chatkada',
     'django_crontab',
 ]
@@ -78,6 +80,113 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'chayakada.wsgi.application'
+ASGI_APPLICATION = 'chayakada.asgi.application'
+
+# Channels (WebSocket push). Redis lets every worker reach every socket,
+# the in-memory layer is only good for a single dev process.
+REDIS_URL = config("REDIS_URL", default=None)
+
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [REDIS_URL]},
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+    }
+
+# Version tokens behind the polling endpoints' ETags (chatkada/versions.py)
+# live here, so every worker must share the same cache in production
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+
+# Longest a long-poll request is held open before answering "nothing new"
+LONG_POLL_TIMEOUT = config("LONG_POLL_TIMEOUT", default=25, cast=int)
+
+# Server-Sent Events stream (/events/)
+SSE_HEARTBEAT_INTERVAL = config("SSE_HEARTBEAT_INTERVAL", default=15, cast=int)
+SSE_RETRY_MS = 3000
+SSE_REPLAY_LIMIT = 200
+
+# In-process ring buffer of recent messages per room (chatkada/message_buffer.py).
+# It only sees writes from its own process, so turn it off when running
+# more than one worker.
+MESSAGE_BUFFER_ENABLED = config("MESSAGE_BUFFER_ENABLED", default=True, cast=bool)
+MESSAGE_BUFFER_ROOM_SIZE = 50
+MESSAGE_BUFFER_MAX_BYTES = config("MESSAGE_BUFFER_MAX_BYTES", default=16 * 1024 * 1024, cast=int)
+MESSAGE_BUFFER_TTL = 3600
+
+# Write-behind for chat messages (chatkada/write_behind.py): messages are
+# delivered straight away and inserted in batches. Up to MAX_DELAY_MS of
+# messages can be lost if the process is killed, so it is off by default.
+# Use it together with the message buffer, which serves unflushed messages.
+CHAT_WRITE_BEHIND = config("CHAT_WRITE_BEHIND", default=False, cast=bool)
+CHAT_WRITE_BEHIND_BATCH_SIZE = config("CHAT_WRITE_BEHIND_BATCH_SIZE", default=200, cast=int)
+CHAT_WRITE_BEHIND_MAX_DELAY_MS = config("CHAT_WRITE_BEHIND_MAX_DELAY_MS", default=50, cast=int)
+
+# Presence (chatkada/presence.py): a user's last_activity is written at most
+# once per THROTTLE_SECONDS, and pending stamps go out in one UPDATE every
+# FLUSH_INTERVAL seconds. Requests under PRESENCE_EXEMPT_PATHS don't count.
+PRESENCE_THROTTLE_SECONDS = config("PRESENCE_THROTTLE_SECONDS", default=60, cast=int)
+PRESENCE_FLUSH_INTERVAL = config("PRESENCE_FLUSH_INTERVAL", default=10, cast=int)
+PRESENCE_EXEMPT_PATHS = ['/static/', '/favicon.ico', '/health/']
+
+# Who is online right now (chatkada/online.py), answered without SQL.
+# The local backend only sees its own process.
+PRESENCE_ONLINE_WINDOW = 300
+if REDIS_URL:
+    PRESENCE_BACKEND = {
+        "BACKEND": "chatkada.online.RedisOnlineBackend",
+        "OPTIONS": {"url": REDIS_URL},
+    }
+else:
+    PRESENCE_BACKEND = {"BACKEND": "chatkada.online.LocalOnlineBackend"}
+
+# Top-earner boards (chatkada/leaderboard.py), kept up to date as coins are
+# credited. The local backend only sees its own process's credits.
+if REDIS_URL:
+    LEADERBOARD_BACKEND = {
+        "BACKEND": "chatkada.leaderboard.RedisLeaderboard",
+        "OPTIONS": {"url": REDIS_URL},
+    }
+else:
+    LEADERBOARD_BACKEND = {"BACKEND": "chatkada.leaderboard.LocalLeaderboard"}
+
+# Stranger matching (chatkada/matchmaking.py). With the batch matcher on, a
+# background thread pairs the whole queue every INTERVAL_MS instead of each
+# search trying to find its own partner.
+STRANGER_BATCH_MATCHER = config("STRANGER_BATCH_MATCHER", default=True, cast=bool)
+STRANGER_MATCH_INTERVAL_MS = config("STRANGER_MATCH_INTERVAL_MS", default=300, cast=int)
+STRANGER_MATCH_BATCH_SIZE = 500
+# Strangers aren't paired again with any of their last N partners (0 turns
+# this off). Partners are remembered for this many users per process and
+# seeded from this many days of chat history.
+STRANGER_RECENT_PARTNERS = config("STRANGER_RECENT_PARTNERS", default=20, cast=int)
+STRANGER_RECENT_PARTNER_USERS = 50000
+STRANGER_RECENT_PARTNER_DAYS = 7
+# Matches claim rooms from a pool of idle ones made in the background,
+# sized to REFILL_SECONDS x 2 of the recent match rate within MIN..MAX.
+# Rooms idle for STALE_SECONDS are deleted and replaced. Off by default:
+# it only pays off once room INSERTs show up in match latency.
+STRANGER_ROOM_POOL = config("STRANGER_ROOM_POOL", default=False, cast=bool)
+STRANGER_ROOM_POOL_REFILL_SECONDS = 5
+STRANGER_ROOM_POOL_MIN = 10
+STRANGER_ROOM_POOL_MAX = 500
+STRANGER_ROOM_POOL_STALE_SECONDS = 1800
+# Seconds of history behind the queue's wait-time estimates
+MATCH_RATE_WINDOW = 300
 
 STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 # Database
@@ -140,6 +249,17 @@ USE_TZ = True
 STATIC_URL = "/static/"
 STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 
+# Resized WebP and PNG copies of large static images, written next to the
+# originals (under IMAGE_DERIVATIVES_DIR) by the build_image_derivatives
+# command before collectstatic, and picked by {% responsive_image %}.
+# Widths are the sizes the image is shown at, for 1x to 3x screens.
+IMAGE_DERIVATIVES_DIR = "chatkada/img/derived"
+IMAGE_DERIVATIVES = {
+    "chatkada/img/chaya_kada_logo.png": [80, 160, 240],
+    "chatkada/img/chaya_kada_cup.png": [48, 64, 96, 144],
+}
+IMAGE_DERIVATIVE_QUALITY = 80
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -148,11 +268,20 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CRONJOBS = [
     ('0 * * * *', 'chatkada.management.commands.cleanup_expired_messages.Command'),  # Every hour
+    ('*/5 * * * *', 'chatkada.tasks.cleanup_inactive_users'),  # Every 5 minutes
 ]
 
 LOGOUT_REDIRECT_URL = '/logout/'
 
 
+# Background jobs (chatkada/tasks.py). Without a broker, tasks run inline in
+# the request that queued them; set CELERY_BROKER_URL and run
+# `celery -A chayakada worker` to move them off the web process.
+CELERY_BROKER_URL = config("CELERY_BROKER_URL", default=None)
+CELERY_TASK_ALWAYS_EAGER = CELERY_BROKER_URL is None
+# Users credited per transaction by assign_daily_challenge
+CHALLENGE_ASSIGN_CHUNK_SIZE = 1000
+
 CELERY_BEAT_SCHEDULE = {
     'cleanup-old-messages': {
         'task': 'chatkada.tasks.cleanup_old_chat_messages',
@@ -163,4 +292,8 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'chatkada.tasks.cleanup_expired_messages',
         'schedule': crontab(minute='*/30'),  # Every 30 minutes
     },
+    'cleanup-inactive-users': {
+        'task': 'chatkada.tasks.cleanup_inactive_users',
+        'schedule': crontab(minute='*/5'),  # Every 5 minutes; also drops stale queue entries
+    },
 }